@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Autocomplete - completions for the search box (/api/complete): titles of notes, headers
+and @tags that start with what you typed.
+
+All completions are kept in a list sorted by their lower-cased text, so completions of
+a prefix are next to each other (it's a trie flattened to a list, found with bisect). The best
+ones (the biggest weight) of every prefix of one or two characters, which have the most
+completions, are found when the list is made, the best ones of recent prefixes are kept in
+a cache (LRU).
+
+Like the search index (see search_index.py), there are three kinds of completions:
+
+- Completer - in memory, made of notes (Headers of their sections),
+- CompletionsFile - a file written by write_completions next to the search index, together
+  with it, and opened with mmap, so a server does not make the list of all completions when
+  it starts,
+- CompleterSegments - a CompletionsFile without notes changed since it was written and
+  a Completer of these notes.
+
+The file (all numbers little-endian)::
+
+    header     'GBAC', version, generation, number of completions, prefixes and notes,
+               offsets of the tables below
+    entries    key (offset, length in strings), text, md (offset, length), weight, kind;
+               sorted by utf-8 of keys (lower-cased texts)
+    prefixes   prefix (offset, length), start and number of its best completions in top;
+               sorted by utf-8 of prefixes
+    top        uint32 entry numbers, the best MAX_K completions of every short prefix
+    notes      md (offset, length), start and number of its weights in weights; sorted by md
+    weights    pairs of uint32 (entry number, weight), what a note adds to completions, so
+               a changed note can be taken away
+    strings    utf-8 of keys, texts, notes and prefixes
+
+Usage::
+
+    c = Completer()
+    c.add_notes([(u'rna', make_headers(text, u'rna'))])
+    c.build()
+    c.complete(u'rn')  # [{'text': u'RNA structure', 'kind': 'header', 'url': ...}]
+"""
+import os
+import mmap
+import heapq
+import array
+import struct
+import bisect
+import urllib
+import threading
+from collections import OrderedDict
+
+from engine.search_index import IndexFormatError, get_tokens
+
+import logging
+logger = logging.getLogger('geekbook')
+
+TOP_K = 10  # completions by default
+MAX_K = 50
+CACHE_SIZE = 1000  # prefixes
+PRECOMPUTED = 2  # the best completions of all prefixes of this length and shorter are made at once
+
+KINDS = ['note', 'header', 'tag']
+
+MAGIC = b'GBAC'
+VERSION = 1
+HEAD = struct.Struct('<4sIIIIIQQQQQQ')
+ENTRY = struct.Struct('<IIIIIIIB')
+PREFIX = struct.Struct('<IIII')
+NOTE = struct.Struct('<IIII')
+
+
+def get_note_completions(md, headers):
+    """Get completions of one note, (text, kind) -> weight. A note weighs as many as it has
+    sections (+ 1), a header as many times as it is used, a tag as many sections as it is in."""
+    completions = {(md, 'note'): len(headers) + 1}
+    for h in headers:
+        if h.name.strip():
+            key = (h.name, 'header')
+            completions[key] = completions.get(key, 0) + 1
+        for tag in set(t for t in get_tokens(h) if t.startswith('@')):
+            key = (tag, 'tag')
+            completions[key] = completions.get(key, 0) + 1
+    return completions
+
+
+def quote(text):
+    """Quote text for a part of an url, also / ? # and %."""
+    return urllib.quote(text.encode('utf-8'), safe='')
+
+
+def get_url(text, kind, md):
+    """Get the url of a completion, md is the note of a header if it's used only in one note
+    (None otherwise)."""
+    if kind == 'note':
+        return '/view/' + quote(text) + '.html'
+    if kind == 'header':
+        if md:
+            return '/view/' + quote(md) + '.html#' + quote(text.replace(' ', '-'))
+        return '/search/' + quote(u'"' + text + u'"')
+    return '/search/' + quote(text)
+
+
+def rank(item):
+    """The biggest weight first, then the shortest text."""
+    weight, text, kind, md = item
+    return (-weight, len(text), text)
+
+
+class Completions(object):
+    """Completions - complete() with a cache of recent prefixes, for any kind of completions
+    that gives get_items(prefix, k), the best k items (weight, text, kind, md)."""
+    count = 0
+
+    def __init__(self):
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def complete(self, prefix, k=TOP_K):
+        """Get the best k completions of prefix, a list of dicts of text, kind, url, weight."""
+        prefix = prefix.lower()
+        k = max(1, min(k, MAX_K))
+        with self.lock:
+            if (prefix, k) in self.cache:
+                completions = self.cache.pop((prefix, k))
+                self.cache[(prefix, k)] = completions  # the newest now
+                return completions
+        completions = [{'text': text, 'kind': kind, 'url': get_url(text, kind, md),
+                        'weight': weight} for weight, text, kind, md in self.get_items(prefix, k)]
+        with self.lock:
+            self.cache[(prefix, k)] = completions
+            if len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return completions
+
+
+class Completer(Completions):
+    """Completer class, in memory
+
+    Attributes:
+
+      keys - lower-cased texts of completions, sorted
+      items - (weight, text, kind, md) for every key
+      top - prefix -> the best MAX_K items, for short prefixes
+      cache - (prefix, k) -> completions, for recent prefixes
+    """
+
+    def __init__(self):
+        Completions.__init__(self)
+        self.keys = []
+        self.items = []
+        self.top = {}
+        self._new = {}  # (text, kind) -> [weight, md], before build()
+
+    def add(self, text, kind, md, weight=1):
+        """Add a completion of a note (md), the same one added again gets a bigger weight."""
+        key = (text, kind)
+        if key in self._new:
+            item = self._new[key]
+            item[0] += weight
+            if item[1] != md:
+                item[1] = None  # of more notes
+        else:
+            self._new[key] = [weight, md]
+
+    def add_notes(self, notes):
+        """Add completions of notes, a list of (md, list of Headers)."""
+        for md, headers in notes:
+            for (text, kind), weight in get_note_completions(md, headers).items():
+                self.add(text, kind, md, weight)
+
+    def build(self):
+        """Sort completions, find the best ones for short prefixes."""
+        entries = sorted((text.lower(), (weight, text, kind, md))
+                         for (text, kind), (weight, md) in self._new.items())
+        self._new = {}
+        self.keys = [e[0] for e in entries]
+        self.items = [e[1] for e in entries]
+        self.count = len(self.keys)
+        self.cache.clear()
+        self.top = {}
+        groups = {}
+        for key, item in entries:
+            for n in range(PRECOMPUTED + 1):
+                if len(key) >= n:
+                    groups.setdefault(key[:n], []).append(item)
+        for prefix, items in groups.items():
+            self.top[prefix] = heapq.nsmallest(MAX_K, items, key=rank)
+
+    def get_range(self, prefix):
+        """Get (lo, hi) of items of the prefix."""
+        return (bisect.bisect_left(self.keys, prefix),
+                bisect.bisect_left(self.keys, prefix + u'￿'))
+
+    def get_items(self, prefix, k=TOP_K):
+        if prefix in self.top:
+            return self.top[prefix][:k]
+        lo, hi = self.get_range(prefix)
+        return heapq.nsmallest(k, self.items[lo:hi], key=rank)
+
+
+def write_completions(path, notes, generation=0):
+    """Write a CompletionsFile.
+
+    Args:
+
+       path (str): the file, it's written to path.tmp and renamed
+       notes: list of (md, list of Headers), sorted by md
+       generation (int): saved in the file, the same as of the search index written with it
+    """
+    c = Completer()
+    weights = []
+    for md, headers in notes:
+        completions = get_note_completions(md, headers)
+        weights.append((md, completions))
+        for (text, kind), weight in completions.items():
+            c.add(text, kind, md, weight)
+    c.build()
+
+    strings = bytearray()
+    offsets = {}
+
+    def add_string(text):
+        data = (text or u'').encode('utf-8')
+        if data not in offsets:
+            offsets[data] = len(strings)
+            strings.extend(data)
+        return offsets[data], len(data)
+
+    # sorted by utf-8, it's the same as sorted by unicode (but not with a narrow python
+    # build and characters beyond ￿)
+    order = sorted(range(c.count), key=lambda i: c.keys[i].encode('utf-8'))
+    numbers = {}  # (text, kind) -> entry number
+    entries = bytearray()
+    for i in order:
+        weight, text, kind, md = c.items[i]
+        numbers[(text, kind)] = len(numbers)
+        entries.extend(ENTRY.pack(*add_string(c.keys[i]) + add_string(text) + add_string(md) +
+                                  (weight, KINDS.index(kind))))
+    prefixes = bytearray()
+    top = array.array('I')
+    for prefix in sorted(c.top, key=lambda p: p.encode('utf-8')):
+        items = c.top[prefix]
+        prefixes.extend(PREFIX.pack(*add_string(prefix) + (len(top), len(items))))
+        top.extend(numbers[(text, kind)] for weight, text, kind, md in items)
+    notes_table = bytearray()
+    note_weights = array.array('I')
+    for md, completions in weights:
+        notes_table.extend(NOTE.pack(*add_string(md) + (len(note_weights) // 2,
+                                                        len(completions))))
+        for key, weight in sorted(completions.items()):
+            note_weights.extend((numbers[key], weight))
+
+    tables = [entries, prefixes, bytearray(top.tostring()), notes_table,
+              bytearray(note_weights.tostring()), strings]
+    table_offsets = []
+    offset = HEAD.size
+    for table in tables:
+        table_offsets.append(offset)
+        offset += len(table)
+    head = HEAD.pack(*[MAGIC, VERSION, generation, c.count, len(prefixes) // PREFIX.size,
+                       len(weights)] + table_offsets)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(head)
+        for table in tables:
+            f.write(table)
+    os.rename(tmp, path)
+
+
+class CompletionsFile(Completions):
+    """CompletionsFile - completions written by write_completions, opened with mmap. Only
+    the header is read when it's opened, a prefix reads its entries (or its best ones, for
+    short prefixes).
+
+    Raises IndexFormatError if the file is not a completions file or of another version.
+    """
+
+    def __init__(self, path):
+        Completions.__init__(self)
+        with open(path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise IndexFormatError('%s is empty' % path)
+        if len(self.mm) < HEAD.size:
+            raise IndexFormatError('%s is not a completions file' % path)
+        (magic, version, self.generation, self.count, self.n_prefixes, self.n_notes,
+         self._entries, self._prefixes, self._top, self._notes, self._weights,
+         self._strings) = HEAD.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise IndexFormatError('%s is not a completions file' % path)
+        if version != VERSION:
+            raise IndexFormatError('%s is of version %i, not %i' % (path, version, VERSION))
+        self.path = path
+
+    def close(self):
+        self.mm.close()
+
+    def _get_string(self, offset, length):
+        start = self._strings + offset
+        return self.mm[start:start + length]
+
+    def _bisect(self, table, size, n, key):
+        """Get the position of the first row >= key (utf-8) of a sorted table."""
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_string(*struct.unpack_from('<II', self.mm, table + mid * size)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, table, size, n, key):
+        """Get the row of the key in a sorted table, None if there is no such key."""
+        i = self._bisect(table, size, n, key)
+        if i < n:
+            row = struct.unpack_from('<II', self.mm, table + i * size)
+            if self._get_string(*row) == key:
+                return i
+        return None
+
+    def get_range(self, prefix):
+        """Get (lo, hi) of entries of the prefix."""
+        prefix = prefix.encode('utf-8')
+        return (self._bisect(self._entries, ENTRY.size, self.count, prefix),
+                self._bisect(self._entries, ENTRY.size, self.count, prefix + b'\xff'))
+
+    def get_entry(self, i):
+        """Get the item (weight, text, kind, md) of an entry."""
+        (key, key_length, text, text_length, md, md_length, weight,
+         kind) = ENTRY.unpack_from(self.mm, self._entries + i * ENTRY.size)
+        return (weight, self._get_string(text, text_length).decode('utf-8'), KINDS[kind],
+                self._get_string(md, md_length).decode('utf-8') or None)
+
+    def find(self, text, kind):
+        """Get the number of the entry of a completion, None if there is no such entry."""
+        key = text.lower().encode('utf-8')
+        lo = self._bisect(self._entries, ENTRY.size, self.count, key)
+        hi = self._bisect(self._entries, ENTRY.size, self.count, key + b'\x00')  # the same key
+        for i in range(lo, hi):
+            weight, t, k, md = self.get_entry(i)
+            if t == text and k == kind:
+                return i
+        return None
+
+    def get_top(self, prefix):
+        """Get entry numbers of the best MAX_K completions of a short prefix (or all of them,
+        if there are fewer), None if they are not kept for this prefix."""
+        i = self._find(self._prefixes, PREFIX.size, self.n_prefixes, prefix.encode('utf-8'))
+        if i is None:
+            return None
+        start, n = PREFIX.unpack_from(self.mm, self._prefixes + i * PREFIX.size)[2:]
+        offset = self._top + start * 4
+        return array.array('I', self.mm[offset:offset + n * 4])
+
+    def get_note(self, md):
+        """Get what a note adds to completions, a list of (entry number, weight)."""
+        i = self._find(self._notes, NOTE.size, self.n_notes, md.encode('utf-8'))
+        if i is None:
+            return []
+        start, n = NOTE.unpack_from(self.mm, self._notes + i * NOTE.size)[2:]
+        offset = self._weights + start * 8
+        values = array.array('I', self.mm[offset:offset + n * 8])
+        return zip(values[::2], values[1::2])
+
+    def get_items(self, prefix, k=TOP_K):
+        top = self.get_top(prefix)
+        if top is not None:
+            return [self.get_entry(i) for i in top[:k]]
+        return heapq.nsmallest(k, (self.get_entry(i) for i in range(*self.get_range(prefix))),
+                               key=rank)
+
+
+class CompleterSegments(Completions):
+    """CompleterSegments - a CompletionsFile (base) without what changed notes added to it and
+    a Completer of these notes as they are now (delta), completed as one.
+
+    The best completions of a short prefix are taken from the best ones of the base, if
+    they are still the best with changed notes taken away; otherwise (and for longer prefixes)
+    all completions of the prefix are looked at.
+    """
+
+    def __init__(self, base, delta, changed=()):
+        """changed - md of notes changed or removed since the base was written."""
+        Completions.__init__(self)
+        self.base = base
+        self.delta = delta
+        self.removed = {}  # entry number of the base -> weight of changed notes in it
+        for md in changed:
+            for i, weight in base.get_note(md):
+                self.removed[i] = self.removed.get(i, 0) + weight
+        self.count = base.count + delta.count
+
+    def _get_base(self, i):
+        """Get the item of an entry of the base without changed notes."""
+        weight, text, kind, md = self.base.get_entry(i)
+        return weight - self.removed.get(i, 0), text, kind, md
+
+    def get_items(self, prefix, k=TOP_K):
+        top = self.base.get_top(prefix)
+        best = self._merge(prefix, k, top)
+        if top is not None and len(top) == MAX_K and \
+                (len(best) < k or rank(best[-1]) > rank(self.base.get_entry(top[-1]))):
+            # entries not in top of the base can be better now, look at all of them
+            best = self._merge(prefix, k, None)
+        return best
+
+    def _merge(self, prefix, k, top):
+        """Get the best k items of the base (its top entries of the prefix, or all if top is
+        None) and the delta."""
+        numbers = top if top is not None else range(*self.base.get_range(prefix))
+        items = {}
+        for i in numbers:
+            weight, text, kind, md = self._get_base(i)
+            items[(text, kind)] = (weight, text, kind, md)
+        lo, hi = self.delta.get_range(prefix)
+        for weight, text, kind, md in self.delta.items[lo:hi]:
+            old = items.get((text, kind))
+            if old is None and top is not None:  # maybe not one of the best of the base
+                i = self.base.find(text, kind)
+                old = self._get_base(i) if i is not None else None
+            if old and old[0] > 0:
+                weight += old[0]
+                md = md if old[3] == md else None
+            items[(text, kind)] = (weight, text, kind, md)
+        return heapq.nsmallest(k, [item for item in items.values() if item[0] > 0], key=rank)
+
+
+def make_completer(notes):
+    """Make a Completer of notes, a list of (md, list of Headers)."""
+    c = Completer()
+    c.add_notes(notes)
+    c.build()
+    return c
+
+
+# main
+if __name__ == '__main__':
+    import sys
+    import time
+    from engine.searcher import Db
+    t = time.time()
+    db = Db()
+    db.load()
+    c = db.completer
+    print('%i completions in %.3f s' % (c.count, time.time() - t))
+    for prefix in sys.argv[1:] or [u'@', u'a']:
+        t = time.time()
+        completions = c.complete(prefix.decode('utf-8'))
+        print('%s (%.2f ms)' % (prefix, (time.time() - t) * 1000))
+        for x in completions:
+            print('  %-40s %-6s %4i %s' % (x['text'], x['kind'], x['weight'], x['url']))
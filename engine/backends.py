@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Backends - Markdown engines that compile notes into html, pick one in conf.py
+(MARKDOWN_BACKEND):
+
+- markdown - Python-Markdown with GitHub Flavored Markdown (py-gfm), default, geekbook is made
+  with it,
+- cmarkgfm - cmark-gfm, the C library of GitHub (``pip install cmarkgfm``), much faster,
+- markdown-it - markdown-it-py (``pip install markdown-it-py``, Python 3 only).
+
+Code blocks of all of them are highlighted by pygments, the same way as with Python-Markdown.
+The fast backends are not 100% the same as Python-Markdown, to see how your notes look with
+them run the conformance test::
+
+    python -m engine.backends              # all backends, notes/ and examples/
+    python -m engine.backends -v test.md   # with diffs
+
+"""
+import re
+import time
+
+import markdown
+from markdown.extensions.codehilite import CodeHilite
+from mdx_gfm import GithubFlavoredMarkdownExtension
+
+import logging
+logger = logging.getLogger('geekbook')
+
+
+def highlight(code, lang=None):
+    """Highlight code (as fenced code of Python-Markdown with GFM does)."""
+    return CodeHilite(code, lang=lang or None, css_class='highlight', guess_lang=False).hilite()
+
+
+def unescape(html):
+    return html.replace('&quot;', '"').replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+
+TEXT = re.compile(r'>[^<]*<')
+
+
+def unescape_quotes(html):
+    """Python-Markdown does not escape " in text (only in attributes)."""
+    return TEXT.sub(lambda m: m.group(0).replace('&quot;', '"'), html)
+
+
+class Backend(object):
+    """Base class. Subclasses implement ``convert(text)`` that gets markdown of a note and
+    returns html, and set ``name`` (as in MARKDOWN_BACKEND)."""
+    name = None
+
+
+class PythonMarkdown(Backend):
+    """Python-Markdown, one converter, reset before every note."""
+    name = 'markdown'
+
+    def __init__(self):
+        self.md = markdown.Markdown(extensions=[GithubFlavoredMarkdownExtension()])
+
+    def convert(self, text):
+        return self.md.reset().convert(text)
+
+
+class CmarkGfm(Backend):
+    """cmark-gfm, with the extensions of GFM except tagfilter (we want iframes of youtube)."""
+    name = 'cmarkgfm'
+
+    EXTENSIONS = ['table', 'strikethrough', 'autolink', 'tasklist']
+    CODE = re.compile(r'<pre lang="(?P<lang>[^"]*)"><code>(?P<code>.*?)</code></pre>', re.DOTALL)
+    # checkboxes as Python-Markdown makes them
+    CHECKBOXES = [('<input type="checkbox" checked="" disabled="" />',
+                   '<input checked="checked" disabled="disabled" type="checkbox" />'),
+                  ('<input type="checkbox" disabled="" />',
+                   '<input disabled="disabled" type="checkbox" />')]
+
+    def __init__(self):
+        import cmarkgfm
+        from cmarkgfm.cmark import Options
+        self.cmarkgfm = cmarkgfm
+        # nl2br of GFM is HARDBREAKS, raw html is UNSAFE
+        self.options = Options.CMARK_OPT_UNSAFE | Options.CMARK_OPT_HARDBREAKS | \
+            Options.CMARK_OPT_GITHUB_PRE_LANG
+
+    def convert(self, text):
+        html = self.cmarkgfm.markdown_to_html_with_extensions(text.expandtabs(4), self.options,
+                                                             self.EXTENSIONS)
+        html = self.CODE.sub(lambda m: highlight(unescape(m.group('code')), m.group('lang')), html)
+        for old, new in self.CHECKBOXES:
+            html = html.replace(old, new)
+        return unescape_quotes(html)
+
+
+class MarkdownIt(Backend):
+    """markdown-it-py, CommonMark with tables, strikethrough and new lines as <br />."""
+    name = 'markdown-it'
+
+    def __init__(self):
+        from markdown_it import MarkdownIt
+        self.md = MarkdownIt('commonmark', {'breaks': True, 'html': True})
+        self.md.enable(['table', 'strikethrough'])
+        self.md.add_render_rule('fence', self.fence)
+
+    @staticmethod
+    def fence(renderer, tokens, idx, options, env):
+        token = tokens[idx]
+        lang = token.info.strip().split(' ')[0] if token.info else None
+        return highlight(token.content, lang)
+
+    def convert(self, text):
+        return unescape_quotes(self.md.render(text.expandtabs(4)))
+
+
+BACKENDS = dict((b.name, b) for b in [PythonMarkdown, CmarkGfm, MarkdownIt])
+
+
+def get_backend(name):
+    """Get a new Backend by name, see BACKENDS."""
+    if name not in BACKENDS:
+        raise ValueError('unknown MARKDOWN_BACKEND %s, use one of: %s' % (
+            name, ', '.join(sorted(BACKENDS))))
+    try:
+        return BACKENDS[name]()
+    except ImportError as e:
+        raise ImportError('MARKDOWN_BACKEND %s is not installed (%s)' % (name, e))
+
+
+def get_tag(line):
+    """Get the first tag of a line of html, e.g. li for <li>[ ] ..., or 'text'."""
+    m = re.match(r'\s*<(/?\w+)', line)
+    return m.group(1) if m else 'text'
+
+
+# main
+if __name__ == '__main__':
+    # conformance test: compile notes with every backend and compare the html with
+    # Python-Markdown (after preprocessing of geekbook, as it's done in Page)
+    import os
+    import glob
+    import codecs
+    import difflib
+    import argparse
+    from collections import Counter
+    from engine.conf import PATH, PATH_TO_MD
+    from engine.page import PREPROCESSOR
+    from engine.preprocessing import Context
+
+    parser = argparse.ArgumentParser(description='Compare html of Markdown backends')
+    parser.add_argument('files', nargs='*', help='notes, by default notes/ and examples/')
+    parser.add_argument('-b', '--backend', action='append', help='backend to test, by default all')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show diffs')
+    args = parser.parse_args()
+
+    files = args.files or sorted(glob.glob(PATH_TO_MD + '*.md') +
+                                 glob.glob(PATH + '/examples/*.md'))
+    texts = []
+    for fn in files:
+        if not os.path.exists(fn):
+            fn = PATH_TO_MD + fn
+        with codecs.open(fn, encoding='utf-8', errors='replace') as f:
+            texts.append((os.path.basename(fn), PREPROCESSOR.process(f.read(), Context())))
+
+    reference = PythonMarkdown()
+    t0 = time.time()
+    expected = [reference.convert(text) for fn, text in texts]
+    print('%-12s %8.3f s' % (reference.name, time.time() - t0))
+
+    for name in args.backend or sorted(BACKENDS):
+        if name == reference.name:
+            continue
+        try:
+            backend = get_backend(name)
+        except ImportError as e:
+            print('%-12s skipped, %s' % (name, e))
+            continue
+        t0 = time.time()
+        htmls = [backend.convert(text) for fn, text in texts]
+        wall = time.time() - t0
+        same = 0
+        tags = Counter()  # what is different, by the first tag of lines
+        for (fn, text), html, exp in zip(texts, htmls, expected):
+            if html == exp:
+                same += 1
+                continue
+            # blank lines between blocks are not important
+            a = [l for l in exp.split('\n') if l.strip()]
+            b = [l for l in html.split('\n') if l.strip()]
+            diff = [l for l in difflib.unified_diff(a, b, fn, name, lineterm='', n=0)
+                    if not l.startswith('@@')][2:]
+            if not diff:
+                same += 1
+                continue
+            tags.update(get_tag(l[1:]) for l in diff if l.startswith('-'))
+            print('  %-40s %i lines differ' % (fn, len([l for l in diff if l.startswith('-')])))
+            if args.verbose:
+                print('\n'.join('    ' + l for l in diff))
+        print('%-12s %8.3f s, %i/%i notes the same, different: %s' % (
+            name, wall, same, len(texts),
+            ', '.join('<%s> %i' % t for t in tags.most_common()) or '-'))
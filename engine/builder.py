@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Builder - compile many notes at once (``geekbookapp.py --update``).
+
+Notes are compiled in a pool of processes (``--jobs N``), each worker runs exactly the same
+Page.compile() & Page.save() as the serial mode, so you get the same html. The main process
+collects the results, remembers them in the manifest and reports notes that failed, one
+broken note does not stop the whole build.
+"""
+import time
+import traceback
+import multiprocessing
+
+from engine.page import Page, get_converter
+from engine.manifest import get_manifest
+from engine.preprocessing import clear_cache
+from engine.theme import get_theme_head
+
+import logging
+logger = logging.getLogger('geekbook')
+
+
+def compile_note(fn):
+    """Compile and save one note (used by workers).
+
+    Returns:
+
+       tuple: (fn, st, md_hash, html_hash, deps, error), error is None or a traceback as str
+    """
+    try:
+        p = Page(fn)
+        if p.md is None:
+            return fn, None, None, None, None, 'file removed'
+        p.compile()
+        p.save(record=False)
+        return fn, p.st, p.md_hash, p.html_hash, p.deps, None
+    except Exception:
+        return fn, None, None, None, None, traceback.format_exc()
+
+
+def get_jobs(jobs):
+    """0 (or less) means use all CPUs."""
+    if jobs < 1:
+        return multiprocessing.cpu_count()
+    return jobs
+
+
+def build(files, jobs=1):
+    """Compile files, with jobs processes.
+
+    Returns:
+
+       list: of (fn, error) for notes that failed
+    """
+    jobs = get_jobs(jobs)
+    t0 = time.time()
+    clear_cache()
+    head = get_theme_head()
+    head.check()  # the theme could be changed since the last build
+    head.get()  # read the theme (and fingerprint its files) once, workers get it from us
+    get_converter()  # and the Markdown converter too
+    if jobs == 1 or len(files) < 2:
+        results = [compile_note(fn) for fn in files]
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(files)))
+        try:
+            results = pool.map(compile_note, files, chunksize=max(1, len(files) // (jobs * 4)))
+        finally:
+            pool.close()
+            pool.join()
+
+    manifest = get_manifest()
+    failed = []
+    compiled = []
+    for fn, st, md_hash, html_hash, deps, error in results:
+        if error:
+            failed.append((fn, error))
+        else:
+            manifest.update(fn, st, md_hash, html_hash, deps)
+            compiled.append(fn)
+    if compiled:
+        manifest.log_pages(compiled)  # flask checks its pages (see engine/pages.py)
+    manifest.commit()
+
+    wall = time.time() - t0
+    done = len(files) - len(failed)
+    for fn, error in failed:
+        logger.error('failed --> %s\n%s' % (fn, error))
+    logger.info('compiled %i notes in %.2f s (%.1f notes/s, %i jobs), %i failed' % (
+        done, wall, done / wall if wall else 0, jobs, len(failed)))
+    return failed
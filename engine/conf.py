@@ -7,7 +7,9 @@ PATH = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
 PATH_TO_MD = PATH + '/notes/'
 PATH_TO_HTML = PATH + "/engine/data/html/"
-PATH_TO_ORIG = PATH + "/engine/data/orig/"
+PATH_TO_MANIFEST = PATH + "/engine/data/manifest.sqlite"
+PATH_TO_SEARCH_INDEX = PATH + "/engine/data/search.idx"
+PATH_TO_COMPLETIONS = PATH + "/engine/data/complete.idx"  # written with the search index
 
 IMG_PREFIX = 'imgs/'  # keep / at the end  # ![](imgs/<file> this 'imgs' is IMG_PREFIX
 PATH_TO_IMG = PATH + '/notes/'
@@ -18,6 +20,23 @@ AI_WRITER = False
 
 SCREENSHOT_INBOX = None
 
+# Markdown engine: markdown (Python-Markdown, default), cmarkgfm or markdown-it
+# see engine/backends.py, python -m engine.backends shows how your notes look with them
+MARKDOWN_BACKEND = 'markdown'
+
+# index.html gets the table of notes page by page from flask (/api/notes),
+# use it if you have thousands of notes
+LAZY_INDEX = False
+
+# server of flask: flask (the development server, one process), waitress (threads),
+# gunicorn (processes, not on Windows) or gevent (one process, pages reload themselves when
+# their note is compiled again, see engine/webserverasync.py); pip install waitress / gunicorn / gevent
+SERVER = 'flask'
+SERVER_WORKERS = 4  # threads of waitress, processes of gunicorn
+
+# flask keeps pages (html and its gzip/brotli copies) in memory, up to this many MB
+PAGE_CACHE_MB = 64
+
 # find files plugin off/on
 FIND_FILES_PLUGIN = False
 
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Live reload - tell open pages that their note was compiled again (Server-Sent Events).
+
+geekbookapp.py compiles a note and logs it in the manifest with a new generation of pages
+(the ``pages_log`` table, see engine/manifest.py). One thread of flask (a greenlet with gevent,
+see webserverasync.py) checks the manifest file (see engine.manifest.get_manifest_stamp) and
+when it's changed, it takes only notes logged after the generation it saw last time. Every open
+page listens on /events and gets::
+
+    event: rebuilt
+    data: test
+
+and reloads itself if it shows this note. Pages wait for events without doing anything
+(a comment is sent now and then to keep the connection), so with gevent thousands of open
+pages are only thousands of sockets and small greenlets, and the manifest is checked by one
+thread, not by every page.
+
+Usage::
+
+    rebuilds = Rebuilds()
+    for event in rebuilds.stream():  # lines of text/event-stream, forever
+        ...
+"""
+import time
+import threading
+
+from engine.conf import PATH_TO_MANIFEST
+from engine.manifest import Manifest, ManifestError, get_manifest_stamp
+
+import logging
+logger = logging.getLogger('geekbook')
+
+POLL = 0.5  # seconds between checks of the manifest
+KEEP_ALIVE = 15  # seconds between comments sent to pages waiting for events
+MAX_EVENTS = 100  # events kept for pages that come back after a moment
+
+
+class Rebuilds(object):
+    """Rebuilds class
+
+    Attributes:
+
+      path - of the manifest
+      generation - of pages at the last check
+      events - (number, md) of the last MAX_EVENTS rebuilt notes
+      number - of the last event
+    """
+
+    def __init__(self, path=PATH_TO_MANIFEST, on_rebuilt=None):
+        """on_rebuilt is called (without arguments) when notes are rebuilt, before pages are
+        told about it."""
+        self.path = path
+        self.on_rebuilt = on_rebuilt
+        self.generation = None
+        self.events = []
+        self.number = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def check(self):
+        """Find notes compiled since the last check, wake up pages waiting for events."""
+        try:
+            manifest = Manifest(self.path, readonly=True)
+        except ManifestError as e:  # nothing built yet
+            logger.debug('livereload: %s' % e)
+            self.generation = None
+            return
+        try:
+            generation = manifest.get_generation('pages')
+            log = []
+            if self.generation is not None and generation != self.generation:
+                log = manifest.get_pages_log(self.generation)
+        finally:
+            manifest.close()
+        rebuilt = sorted(set(fn for g, fn in log))
+        if rebuilt:
+            if self.on_rebuilt:
+                self.on_rebuilt()
+            with self.cond:
+                for fn in rebuilt:
+                    self.number += 1
+                    self.events.append((self.number, fn.replace('.md', '')))
+                del self.events[:-MAX_EVENTS]
+                self.cond.notify_all()
+            logger.info('livereload: rebuilt %s' % ', '.join(rebuilt))
+        self.generation = generation
+
+    def watch(self):
+        stamp = None
+        awake = time.time()
+        while True:
+            new = get_manifest_stamp(self.path)
+            if new != stamp:
+                try:
+                    self.check()
+                    stamp = new
+                except Exception:
+                    logger.exception('livereload: checking the manifest failed')
+            if time.time() - awake > KEEP_ALIVE:  # pages send a keep-alive
+                with self.cond:
+                    self.cond.notify_all()
+                awake = time.time()
+            time.sleep(POLL)
+
+    def start(self):
+        """Start watching the manifest (once)."""
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.watch)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stream(self, allowed=None, last=None):
+        """Get events for a page, as lines of text/event-stream, forever. Only notes for which
+        allowed(md) is True, if allowed is given, and after the event number last (the page
+        sends it as Last-Event-ID when it comes back), new events only by default."""
+        self.start()
+        if last is None or not 0 <= last <= self.number:
+            last = self.number
+        yield 'retry: 2000\n\n'
+        while True:
+            with self.cond:
+                if self.number == last:
+                    # no timeout, wait(timeout) of python 2 wakes up every 50 ms to check
+                    self.cond.wait()  # watch() wakes us up at least every KEEP_ALIVE
+                events = [e for e in self.events if e[0] > last]
+                last = self.number
+            if not events:
+                yield ': keep-alive\n\n'
+            for number, md in events:
+                if allowed is None or allowed(md):
+                    yield 'id: %i\nevent: rebuilt\ndata: %s\n\n' % (number, md)
+
+
+# main
+if __name__ == '__main__':
+    # python -m engine.livereload, and compile a note
+    logging.basicConfig(level=logging.INFO)
+    for event in Rebuilds().stream():
+        print(event.strip())
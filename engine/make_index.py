@@ -2,39 +2,89 @@
 
 """geekbook - make index
 
-Get the list of md with sys.stdint.read() and generate html index.html.
+Get the list of md and generate html index.html.
 The top of the html file is defined here, see the html variable.
-The second part is generated in the loop, per md make a link in the index.html.
+The second part is a table, per md a row with a link in the index.html.
+
+Rows (title, description and mtime of notes) are kept in memory and in the manifest, so
+only changed notes are read again. index.html is written to a tmp file and renamed, so the
+browser never gets a half written index.
+
+With thousands of notes use LAZY_INDEX = True (conf.py), index.html is then only an empty
+table that gets the rows page by page from /api/notes of flask (see Notes).
 """
 
 import os
 import time
 import re
+import threading
 
 from engine.conf import PATH_TO_HTML, PATH_TO_TEMPLATE, PATH_HOMEPAGE, PATH_TO_MD, PATH_TO_TEMPLATE_HTML  # noqa
+from engine.conf import PATH_TO_MANIFEST, LAZY_INDEX
+from engine.theme import get_head
+from engine.manifest import Manifest, ManifestError, get_manifest, get_manifest_stamp
+from engine.pages import write_page
 FLASK_BASED = True
 
+# the table of LAZY_INDEX, rows come from /api/notes (see Notes.query)
+LAZY_TABLE = """
+              <table id="notes_table" class="display compact hover">
+                  <thead>
+                      <tr>
+                          <th>Title</th>
+                          <th>Description</th>
+                          <th>Last update</th>
+                      </tr>
+                  </thead>
+              </table>
+              <script type="text/javascript">
+               $(document).ready(function () {
+                   $('#notes_table').DataTable({
+                       "serverSide": true,
+                       "ajax": "/api/notes",
+                       "order": [[2, "desc"]],
+                       "searchDelay": 300,
+                       "lengthMenu": [[20, 50, 100], [20, 50, 100]],
+                       "columns": [
+                           {"data": "title", "render": function (title) {
+                               return '<a class="index_list_a" href="/view/' + title + '.html">' + title + '</a>';
+                           }},
+                           {"data": "desc"},
+                           {"data": "mtime", "render": function (mtime, type, row) {
+                               return '<small><center class="index_date">' + row.date + '</center></small>';
+                           }}
+                       ]
+                   });
+               });
+              </script>
+"""
+
 
 class Index(object):
-    def __init__(self):
-        pass
+    """Index class
 
-    def update(self, list_md):
-        """Update the index page
+    Attributes:
 
-        :param list_md: is a list of your md files"""
+      rows - fn -> (mtime, size, desc, html of the row)
+    """
+    def __init__(self):
+        self.rows = None
 
-        if FLASK_BASED:  # flask mode
-            head = open(PATH_TO_TEMPLATE_HTML).read()
-            head = head.replace('{{ url_index }}', PATH_TO_HTML + '/' + 'index.html')
-            head = head.replace('href="img/', 'href="' + '/img/')
-            head = head.replace('="lib/', '="' + '/lib/')
-            head = head.replace('="css/', '="' + '/css/')
-            head = head.replace('="js/', '="' + '/js/')
+    def load(self):
+        """Load rows from the manifest."""
+        self.rows = {}
+        for fn, (mtime, size, desc) in get_manifest().get_index_rows().items():
+            self.rows[fn] = (mtime, size, desc, '' if LAZY_INDEX else self.get_row(fn, mtime, desc))
 
-            # remove demo content
-            head = re.sub(r'<!-- start of demo -->.*<!-- end of demo -->',
-                          r'', head, flags=re.M | re.DOTALL)
+    def get_head(self):
+        """Get the top of the index page"""
+        if LAZY_INDEX:
+            head = get_head()
+            if isinstance(head, bytes):
+                head = head.decode('utf-8')
+            return head + LAZY_TABLE
+        if FLASK_BASED:  # flask mode
+            head = get_head()
 
             # insert dataTables
             head += """
@@ -65,44 +115,161 @@ class Index(object):
             html = re.sub(r'<!-- start of demo -->.*<!-- end of demo -->',
                           r'', html, flags=re.M | re.DOTALL)
             ##
+        if isinstance(html, bytes):
+            html = html.decode('utf-8')
+        return html
 
-        for mdfn in list_md:
-            if mdfn == 'imgs':
-                pass
+    def get_desc(self, mdfn):
+        """Get the description of the note, [desc: ...], or '...'"""
+        desc = "..."
+        with open(PATH_TO_MD + os.sep + mdfn, 'rb') as f:
+            for l in f:
+                if l.strip().startswith(b'[desc:'):
+                    desc = l.replace(b'[desc:', b'').replace(b']', b'').strip()
+        if isinstance(desc, bytes):
+            desc = desc.decode('utf-8', 'replace')
+        return desc
+
+    def get_row(self, mdfn, mtime, desc):
+        """Get html of a row of the table for the note"""
+        mdfn = re.sub('.md$', '', mdfn)  # replace only .md at the very end
+        path = PATH_TO_HTML + '/' + mdfn
+        # if l.find('::')>=0:
+        #    html += '<li class="table_of_content_h2">
+        # <a style="" href="' + path + '.html">' + l + '</a></li>'
+        # else:
+
+        if FLASK_BASED:
+            return '<tr><td><a class="index_list_a" href="/view/' + mdfn + '.html">' \
+                + mdfn + '</a>' + '<td>' + desc + '</td>' \
+                + '<td><small><center class="index_date">' + \
+                time.ctime(mtime) + '</center></small></td></tr>'
+        else:
+            return '<tr><td><a class="index_list_a" href="' + path + '.html">' \
+                + mdfn + '</a></td>' + '<td>' + desc + '</td>' \
+                + '<td><small><center class="index_date">' + \
+                time.ctime(mtime) + '</center></small></td></tr>'
+
+    def update(self, list_md, changed=None, removed=None):
+        """Update the index page
+
+        :param list_md: is a list of your md files, in the order of the index
+        :param changed: notes that you know are changed (e.g. just compiled), only they are
+                        checked, by default check all notes (os.stat, a note is read only if its
+                        mtime or size is changed)
+        :param removed: notes that you know are gone, with changed, by default notes that are
+                        not in list_md"""
+        if self.rows is None:
+            self.load()
+        manifest = get_manifest()
+        list_md = [mdfn for mdfn in list_md if mdfn != 'imgs' and mdfn.strip()]
+
+        for mdfn in (list_md if changed is None else changed):
+            row = self.rows.get(mdfn)
+            try:
+                st = os.stat(PATH_TO_MD + os.sep + mdfn)
+                if row and row[:2] == (st.st_mtime, st.st_size):
+                    continue
+                # Insert the description in the index
+                desc = self.get_desc(mdfn)
+            except (IOError, OSError):
+                continue  # the note is gone
+            self.rows[mdfn] = (st.st_mtime, st.st_size, desc,
+                               '' if LAZY_INDEX else self.get_row(mdfn, st.st_mtime, desc))
+            manifest.update_index_row(mdfn, st.st_mtime, st.st_size, desc)
+
+        if changed is None or removed is None:
+            removed = set(self.rows) - set(list_md)
+        for mdfn in removed:
+            if self.rows.pop(mdfn, None) is not None:
+                manifest.remove_index_row(mdfn)
+
+        html = self.get_head()
+        if not LAZY_INDEX:
+            html += ''.join(self.rows[mdfn][3] for mdfn in list_md if mdfn in self.rows)
+
+            html += '</p>'
+
+            html += "</tbody></table>"
+
+        write_page(PATH_TO_HTML + 'index.html', html)
+        manifest.next_generation('pages')  # flask checks its pages (see engine/pages.py)
+        manifest.commit()
+
+
+class Notes(object):
+    """Notes - the list of notes for /api/notes, in memory.
+
+    Rows are taken from the manifest (index_rows, see Index), and taken again only when the
+    manifest is changed (see engine.manifest.get_manifest_stamp), so geekbookapp.py and
+    flask can run in different processes.
+
+    Usage::
+
+        notes = Notes()
+        notes.query(q='rna', sort='mtime', reverse=True, start=0, length=20)
+    """
+    COLUMNS = ['title', 'desc', 'mtime']
+
+    def __init__(self, path=PATH_TO_MANIFEST):
+        self.path = path
+        self.stamp = None
+        self.rows = []
+        self.orders = {}  # column -> rows sorted by the column
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Load rows, if the manifest is changed since the last time."""
+        stamp = get_manifest_stamp(self.path)
+        if stamp == self.stamp:
+            return
+        with self.lock:
+            if stamp == self.stamp:
+                return
+            try:
+                manifest = Manifest(self.path, readonly=True)
+            except ManifestError:  # nothing built yet
+                index_rows = {}
             else:
-                if mdfn.strip():
-                    # Insert the description in the index
-                    f = open(PATH_TO_MD + os.sep + mdfn)
-                    desc = "..."
-                    for l in f:
-                        if l.strip().startswith('[desc:'):
-                            desc = l.replace('[desc:', '').replace(']', '').strip()
-
-                    mdfn = re.sub('.md$', '', mdfn)  # replace only .md at the very end
-                    path = PATH_TO_HTML + '/' + mdfn
-                    # if l.find('::')>=0:
-                    #    html += '<li class="table_of_content_h2">
-                    # <a style="" href="' + path + '.html">' + l + '</a></li>'
-                    # else:
-
-                    if FLASK_BASED:
-                        html += '<tr><td><a class="index_list_a" href="/view/' + mdfn + '.html">' \
-                                + mdfn + '</a>' + '<td>' + desc + '</td>' \
-                                + '<td><small><center class="index_date">' + \
-                                time.ctime(os.stat(os.path.join(PATH_TO_MD, mdfn + '.md')
-                                                   ).st_mtime) + '</center></small></td></tr>'
-
-                    else:
-                        html += '<tr><td><a class="index_list_a" href="' + path + '.html">' \
-                                + mdfn + '</a></td>' + '<td>' + desc + '</td>' \
-                                + '<td><small><center class="index_date">' + \
-                                time.ctime(os.stat(os.path.join(PATH_TO_MD, mdfn + '.md')
-                                                   ).st_mtime) + '</center></small></td></tr>'
-
-        html += '</p>'
-
-        html += "</tbody></table>"
-
-        f = open(PATH_TO_HTML + 'index.html', 'w')
-        f.write(html)
-        f.close()
+                try:
+                    index_rows = manifest.get_index_rows()
+                finally:
+                    manifest.close()
+            rows = []
+            for fn, (mtime, size, desc) in index_rows.items():
+                title = re.sub('.md$', '', fn)
+                rows.append({'title': title, 'desc': desc, 'mtime': mtime,
+                             'date': time.ctime(mtime),
+                             'text': (title + ' ' + desc).lower()})
+            self.orders = dict((c, sorted(rows, key=lambda r: r[c])) for c in self.COLUMNS)
+            self.rows = rows
+            self.stamp = stamp
+
+    def query(self, q='', sort='mtime', reverse=True, start=0, length=20):
+        """Get notes.
+
+        Args:
+
+           q (str): show only notes with all words of q in the title or the description
+           sort (str): title, desc or mtime
+           reverse (bool): sort from the biggest, e.g. the newest note first
+           start (int): the first row to show
+           length (int): how many rows, -1 for all
+
+        Returns:
+
+           (total, filtered, rows): number of notes, number of notes that match q, a page of rows
+        """
+        self.load()
+        rows = self.orders.get(sort, self.orders.get('mtime', []))
+        total = len(rows)
+        words = q.lower().split()
+        if words:
+            rows = [r for r in rows if all(w in r['text'] for w in words)]
+        n = len(rows)
+        end = n if length < 0 else min(n, start + length)
+        if reverse:
+            page = [rows[n - 1 - i] for i in range(start, end)]
+        else:
+            page = rows[start:end]
+        return total, n, [dict((k, r[k]) for k in ('title', 'desc', 'mtime', 'date')) for r in page]
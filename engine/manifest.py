@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Manifest - what we know about the notes we compiled.
+
+For every note we keep mtime & size of the md file (as it was when we compiled it),
+sha1 of its content and sha1 of the html we got. It's a sqlite file (PATH_TO_MANIFEST),
+so there is no need to keep a second copy of your notes to see what's changed.
+
+To check if a note is changed we stat it first, and only if mtime or size are different
+we read it and compare the hash (so `touch note.md` does not trigger a compilation).
+
+The html of a note depends not only on the note, so for every note we keep also a
+fingerprint of everything that was used to compile it: the note, files included into the note
+(/note.md, [if:file], see the ``deps`` table), the theme, the values from conf.py and the
+version of the engine (the code that makes html and Markdown), see get_engine_fingerprint.
+If the fingerprint is the same, there is no need to compile the note again (see
+``outdated``). Hashes of all these files are cached in the ``files`` table, so again we read
+only files that have a new mtime or size.
+
+The ``deps`` table works also the other way round, ``dependents`` tells you which notes have
+to be compiled again when an included file is changed.
+
+The ``index_rows`` table keeps what the index page shows about every note (see
+engine/make_index.py), so the notes are read again only if they are changed.
+
+The ``sections`` table keeps headers of notes for search (see engine/searcher.py), with start
+& end of their text in the md file (offsets in bytes), not the text, the notes are already on
+the disc. The ``search_notes`` table keeps mtime & size of notes when they were split into
+sections, so only changed notes are parsed again, and only their rows are written. For every
+note we keep also the generation (see below) of the search db when the note was changed,
+a removed note stays there (without mtime & size) until the search index file is written
+again, so it's easy to get what's changed since the file was written.
+
+The ``generations`` table counts changes of such data (e.g. ``search``, or ``pages`` for html
+files written by the build), so a process that keeps it in memory (flask) knows when it has to
+take it again. The ``pages_log`` table keeps which notes were compiled in every generation of
+pages (the last PAGES_LOG of them), so flask gets the notes compiled since it looked last time
+without looking at all notes (see engine/livereload.py).
+
+It's only a cache, remove the file and geekbook will compile everything again.
+"""
+import os
+import glob
+import hashlib
+import sqlite3
+
+import markdown
+
+from engine import conf
+from engine.conf import PATH_TO_MD, PATH_TO_HTML, PATH_TO_MANIFEST, PATH_TO_TEMPLATE_HTML
+from engine.theme import get_theme_head
+
+import logging
+logger = logging.getLogger('geekbook')
+
+SCHEMA_VERSION = 9
+
+SCHEMA = """
+CREATE TABLE notes (
+    fn TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    md_hash TEXT,
+    html_hash TEXT,
+    fingerprint TEXT
+);
+CREATE TABLE deps (
+    fn TEXT,
+    path TEXT
+);
+CREATE INDEX deps_fn ON deps (fn);
+CREATE INDEX deps_path ON deps (path);
+CREATE TABLE files (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    hash TEXT
+);
+CREATE TABLE index_rows (
+    fn TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    desc TEXT
+);
+CREATE TABLE search_notes (
+    md TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    generation INTEGER
+);
+CREATE INDEX search_notes_generation ON search_notes (generation);
+CREATE TABLE sections (
+    md TEXT,
+    level INTEGER,
+    name TEXT,
+    start INTEGER,
+    end INTEGER
+);
+CREATE INDEX sections_md ON sections (md);
+CREATE TABLE generations (
+    name TEXT PRIMARY KEY,
+    generation INTEGER
+);
+CREATE TABLE pages_log (
+    generation INTEGER,
+    fn TEXT
+);
+CREATE INDEX pages_log_generation ON pages_log (generation);
+"""
+
+PAGES_LOG = 1000  # generations of pages kept in the pages_log table
+
+NOTE_COLUMNS = ['fn', 'mtime', 'size', 'md_hash', 'html_hash', 'fingerprint']
+
+ENGINE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# the code (in engine/) and conf values that make the html of notes, what's in the engine
+# fingerprint; not the server, the search, the index page or tests
+ENGINE_SOURCES = ['page.py', 'preprocessing.py', 'postprocessing.py', 'backends.py', 'theme.py',
+                  'make_tableofcontent.py', 'plugins/*.py']
+ENGINE_CONF = ['PATH_TO_MD', 'PATH_TO_HTML', 'PATH_TO_IMG', 'IMG_PREFIX', 'TEMPLATE',
+               'PATH_TO_TEMPLATE', 'PATH_TO_TEMPLATE_HTML', 'PATH_TO_BASE_IMG', 'PATH_TO_CSS',
+               'MARKDOWN_BACKEND', 'FIND_FILES_PLUGIN']
+
+
+def get_hash(data):
+    """Get sha1 (hex) of data, unicode is encoded with utf-8."""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def get_file_hash(path):
+    """Get sha1 of the content of a file, or None if the file is gone."""
+    try:
+        with open(path, 'rb') as f:
+            return get_hash(f.read())
+    except IOError:
+        return None
+
+
+def get_file_stamp(path):
+    """Get (mtime, size) of a file, or None if the file is gone."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def get_manifest_stamp(path=PATH_TO_MANIFEST):
+    """Get (mtime, size) of the manifest file and of its write-ahead log. Every commit changes
+    one of them, so a process that keeps data of the manifest in memory (flask) can check it
+    with two os.stat, and open the manifest only when it's changed."""
+    return [get_file_stamp(path), get_file_stamp(path + '-wal')]
+
+
+class ManifestError(Exception):
+    """The manifest can't be read (it's not there yet, or it's of another schema version)."""
+    pass
+
+
+class Manifest(object):
+    """Manifest class
+
+    Usage::
+
+        m = Manifest()
+        if m.is_changed('test.md'):
+            ...compile...
+            m.update('test.md', st, md_hash, html_hash)
+            m.commit()
+    """
+
+    def __init__(self, path=PATH_TO_MANIFEST, readonly=False):
+        """readonly - for processes that only read the manifest (flask): the file is not made
+        and tables are never created (or dropped), raises ManifestError if it's not there or
+        of another schema version (the build is not done yet)."""
+        self.path = path
+        if readonly:
+            self._open_readonly()
+        else:
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.db = sqlite3.connect(path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self._create()
+        self._files = None
+        self._code = None  # the part of the engine fingerprint of the code
+        self._sources = []  # (path, stamp) of the code when it was taken
+        self._head = None  # the head of the theme when the engine fingerprint was taken
+        self._engine_fingerprint = None
+
+    def _open_readonly(self):
+        if not os.path.exists(self.path):  # sqlite would make an empty file
+            raise ManifestError('%s is not there yet' % self.path)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA query_only = ON')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.close()
+            raise ManifestError('%s is of version %i, not %i' % (self.path, version,
+                                                                 SCHEMA_VERSION))
+
+    def _create(self):
+        """Create tables, if the schema is old drop everything, it's just a cache."""
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        if version:
+            logger.info('manifest: schema changed, start from scratch')
+        tables = [r[0] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        for t in tables:
+            self.db.execute('DROP TABLE ' + t)
+        self.db.executescript(SCHEMA)
+        self.db.execute('PRAGMA user_version = %i' % SCHEMA_VERSION)
+        self.db.commit()
+
+    def get(self, fn):
+        """Get a row for the note as a dict or None if we have never seen the note."""
+        cur = self.db.execute('SELECT ' + ', '.join(NOTE_COLUMNS) + ' FROM notes WHERE fn = ?',
+                              (fn,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        return dict(zip(NOTE_COLUMNS, row))
+
+    def get_all(self):
+        """Get a dict fn -> row for all notes."""
+        cur = self.db.execute('SELECT ' + ', '.join(NOTE_COLUMNS) + ' FROM notes')
+        return dict((r[0], dict(zip(NOTE_COLUMNS, r))) for r in cur)
+
+    def is_changed(self, fn, st=None, md_hash=None, row=None):
+        """Check if the note is different than the one we compiled last time.
+
+        Args:
+
+           fn (str): name of the note, e.g. test.md
+           st: os.stat of the note, if you have it already
+           md_hash (str): sha1 of the note, if you have it already
+           row (dict): row from the manifest, if you have it already
+
+        Returns:
+
+           boolean
+        """
+        if st is None:
+            try:
+                st = os.stat(PATH_TO_MD + os.sep + fn)
+            except OSError:
+                return False  # the note is gone, nothing to compile
+        if row is None:
+            row = self.get(fn)
+        if not row:
+            return True
+        if row['mtime'] == st.st_mtime and row['size'] == st.st_size:
+            return False
+        # stat is different, but maybe it's only touched
+        if md_hash is None:
+            md_hash = get_file_hash(PATH_TO_MD + os.sep + fn)
+        if md_hash == row['md_hash']:
+            self.db.execute('UPDATE notes SET mtime = ?, size = ? WHERE fn = ?',
+                            (st.st_mtime, st.st_size, fn))
+            self.db.commit()
+            return False
+        return True
+
+    def dirty(self, fns):
+        """Get a list of notes (from fns) that are changed."""
+        rows = self.get_all()
+        return [fn for fn in fns if self.is_changed(fn, row=rows.get(fn, {}))]
+
+    def get_files_hash(self, paths):
+        """Get sha1 of many files (None for files that don't exist), read only files
+        with mtime or size different than last time."""
+        hashes = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                hashes.append(None)
+                continue
+            row = self.files.get(path)
+            if row and row[0] == st.st_mtime and row[1] == st.st_size:
+                hashes.append(row[2])
+                continue
+            h = get_file_hash(path)
+            self.files[path] = (st.st_mtime, st.st_size, h)
+            self.db.execute('INSERT OR REPLACE INTO files (path, mtime, size, hash) VALUES (?, ?, ?, ?)',
+                            (path, st.st_mtime, st.st_size, h))
+            hashes.append(h)
+        return hashes
+
+    @property
+    def files(self):
+        """Cache of the files table, path -> (mtime, size, hash)."""
+        if self._files is None:
+            self._files = dict((r[0], r[1:]) for r in
+                               self.db.execute('SELECT path, mtime, size, hash FROM files'))
+        return self._files
+
+    def get_engine_fingerprint(self):
+        """Get a fingerprint of everything that is the same for all notes: the theme (the head
+        for flask, with fingerprints of files it links to), conf values used to compile notes
+        (ENGINE_CONF) and the version of the engine (the code in ENGINE_SOURCES and Markdown).
+
+        The code is what this process runs, it's taken once. The theme is read while geekbook
+        runs, it's taken again when the head is read again (see check_engine)."""
+        if self._code is None:
+            sources = sorted(set(path for pattern in ENGINE_SOURCES for path in
+                                 glob.glob(os.path.join(ENGINE_PATH, *pattern.split('/')))))
+            lines = ['markdown ' + markdown.version]
+            for k in ENGINE_CONF:
+                lines.append(k + ' ' + repr(getattr(conf, k, None)))
+            for path, h in zip(sources, self.get_files_hash(sources)):
+                lines.append(path + ' ' + str(h))
+            self._code = '\n'.join(lines)
+            self._sources = [(path, get_file_stamp(path)) for path in sources]
+        head = get_theme_head().get()
+        if head is not self._head:  # a new head, read again (or for the first time)
+            self._head = head
+            self._engine_fingerprint = get_hash(self._code + '\ntheme ' + get_hash(head))
+        return self._engine_fingerprint
+
+    def get_theme_files(self):
+        """Get full paths of the head of the theme and files it links to (e.g. to watch them)."""
+        head = get_theme_head()
+        head.get()
+        return [PATH_TO_TEMPLATE_HTML] + [head.dir + os.sep + asset for asset in sorted(head.assets)]
+
+    def check_engine(self):
+        """Check if anything used to compile all notes is changed, it's a few os.stat, do it
+        once per build or per change of notes.
+
+        A changed theme is read again (see Head.check), notes compiled from now on get the new
+        fingerprint. The code (engine/, conf) is loaded only once, so if it's changed we only
+        say so, notes compiled with the old code are compiled again when geekbook is started
+        again (their fingerprint is of the old code).
+
+        Returns:
+
+           boolean: True if the fingerprint is changed, so notes are outdated
+        """
+        get_theme_head().check()
+        changed = [path for path, stamp in self._sources if get_file_stamp(path) != stamp]
+        if changed:
+            logger.warning('manifest: %s changed, restart geekbook to use it' % ', '.join(changed))
+            self._sources = [(path, get_file_stamp(path)) for path, stamp in self._sources]
+        old = self._engine_fingerprint
+        return old is not None and self.get_engine_fingerprint() != old
+
+    def get_fingerprint(self, md_hash, deps):
+        """Get a fingerprint of all inputs of a note.
+
+        Args:
+
+           md_hash (str): sha1 of the note
+           deps (list): full paths of files included into the note
+        """
+        lines = [self.get_engine_fingerprint(), str(md_hash)]
+        for dep, h in zip(deps, self.get_files_hash(deps)):
+            lines.append(dep + ' ' + str(h))
+        return get_hash(u'\n'.join(lines))
+
+    def outdated(self, fns):
+        """Get a list of notes (from fns) that have to be compiled again, because the note or
+        anything used to compile it is changed (or the html is gone)."""
+        self.check_engine()
+        rows = self.get_all()
+        deps = self.get_all_deps()
+        outdated = []
+        for fn in fns:
+            row = rows.get(fn)
+            if not row or not row['fingerprint']:
+                outdated.append(fn)
+                continue
+            try:
+                st = os.stat(PATH_TO_MD + os.sep + fn)
+            except OSError:
+                continue  # the note is gone
+            if row['mtime'] == st.st_mtime and row['size'] == st.st_size:
+                md_hash = row['md_hash']
+            else:
+                md_hash = get_file_hash(PATH_TO_MD + os.sep + fn)
+            if (self.get_fingerprint(md_hash, deps.get(fn, [])) != row['fingerprint'] or
+                    not os.path.exists(PATH_TO_HTML + fn.replace('.md', '.html'))):
+                outdated.append(fn)
+        self.commit()
+        return outdated
+
+    def update(self, fn, st, md_hash, html_hash, deps=()):
+        """Save what we know about the note (call commit() when you're done).
+
+        Args:
+
+           fn (str): name of the note
+           st: os.stat of the note (when it was read)
+           md_hash (str): sha1 of the note
+           html_hash (str): sha1 of the html
+           deps (list): full paths of files included into the note
+        """
+        deps = list(deps)
+        self.db.execute('INSERT OR REPLACE INTO notes (' + ', '.join(NOTE_COLUMNS) + ') '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (fn, st.st_mtime, st.st_size, md_hash, html_hash,
+                         self.get_fingerprint(md_hash, deps)))
+        self.db.execute('DELETE FROM deps WHERE fn = ?', (fn,))
+        self.db.executemany('INSERT INTO deps (fn, path) VALUES (?, ?)', [(fn, d) for d in deps])
+
+    def get_deps(self, fn):
+        """Get a list of files included into the note (full paths), in order."""
+        return [r[0] for r in self.db.execute('SELECT path FROM deps WHERE fn = ? ORDER BY rowid',
+                                              (fn,))]
+
+    def get_all_deps(self):
+        """Get a dict fn -> list of files included into the note."""
+        deps = {}
+        for fn, path in self.db.execute('SELECT fn, path FROM deps ORDER BY rowid'):
+            deps.setdefault(fn, []).append(path)
+        return deps
+
+    def dependents(self, paths):
+        """Get a list of notes that include any of the files (full paths), e.g. for
+        ``/root/geekbook/notes/shell.md`` you get all notes with ``/shell.md`` inside."""
+        fns = []
+        for path in paths:
+            for r in self.db.execute('SELECT DISTINCT fn FROM deps WHERE path = ?', (path,)):
+                if r[0] not in fns:
+                    fns.append(r[0])
+        return fns
+
+    def get_index_rows(self):
+        """Get a dict fn -> (mtime, size, desc) of notes in the index page."""
+        return dict((r[0], r[1:]) for r in
+                    self.db.execute('SELECT fn, mtime, size, desc FROM index_rows'))
+
+    def update_index_row(self, fn, mtime, size, desc):
+        self.db.execute('INSERT OR REPLACE INTO index_rows (fn, mtime, size, desc) VALUES (?, ?, ?, ?)',
+                        (fn, mtime, size, desc))
+
+    def remove_index_row(self, fn):
+        self.db.execute('DELETE FROM index_rows WHERE fn = ?', (fn,))
+
+    def get_search_notes(self, mds=None):
+        """Get a dict md -> (mtime, size) of notes in the search db (md is the name of a note
+        without .md, e.g. test or projects/rna), of all notes or only notes from mds."""
+        if mds is None:
+            return dict((r[0], r[1:]) for r in self.db.execute(
+                'SELECT md, mtime, size FROM search_notes WHERE mtime IS NOT NULL'))
+        notes = {}
+        for md in mds:
+            for r in self.db.execute('SELECT md, mtime, size FROM search_notes '
+                                     'WHERE md = ? AND mtime IS NOT NULL', (md,)):
+                notes[r[0]] = r[1:]
+        return notes
+
+    def get_search_changes(self, generation):
+        """Get a dict md -> True (changed) or False (removed) of notes changed after the
+        generation of the search db."""
+        return dict((r[0], r[1] is not None) for r in self.db.execute(
+            'SELECT md, mtime FROM search_notes WHERE generation > ?', (generation,)))
+
+    def get_sections(self, mds=None):
+        """Get (md, level, name, start, end) of sections of all notes (or notes from mds), in
+        order, start & end of the text of a section are offsets in bytes in the md file."""
+        if mds is None:
+            return self.db.execute('SELECT md, level, name, start, end FROM sections ORDER BY rowid')
+        rows = []
+        for md in mds:
+            rows.extend(self.db.execute('SELECT md, level, name, start, end FROM sections '
+                                        'WHERE md = ? ORDER BY rowid', (md,)))
+        return rows
+
+    def update_sections(self, md, mtime, size, sections, generation):
+        """Replace sections of a note, sections are (level, name, start, end)."""
+        self.db.execute('DELETE FROM sections WHERE md = ?', (md,))
+        self.db.execute('INSERT OR REPLACE INTO search_notes (md, mtime, size, generation) '
+                        'VALUES (?, ?, ?, ?)', (md, mtime, size, generation))
+        self.db.executemany('INSERT INTO sections (md, level, name, start, end) '
+                            'VALUES (?, ?, ?, ?, ?)', [(md,) + tuple(s) for s in sections])
+
+    def remove_sections(self, md, generation):
+        self.db.execute('DELETE FROM sections WHERE md = ?', (md,))
+        self.db.execute('INSERT OR REPLACE INTO search_notes (md, mtime, size, generation) '
+                        'VALUES (?, NULL, NULL, ?)', (md, generation))
+
+    def purge_search_notes(self, generation):
+        """Forget notes removed before or at the generation."""
+        self.db.execute('DELETE FROM search_notes WHERE mtime IS NULL AND generation <= ?',
+                        (generation,))
+
+    def get_generation(self, name):
+        """Get how many times the data (e.g. search) was changed, 0 if never."""
+        row = self.db.execute('SELECT generation FROM generations WHERE name = ?',
+                              (name,)).fetchone()
+        return row[0] if row else 0
+
+    def set_generation(self, name, generation):
+        self.db.execute('INSERT OR REPLACE INTO generations (name, generation) VALUES (?, ?)',
+                        (name, generation))
+
+    def log_pages(self, fns):
+        """Count a write of pages (the ``pages`` generation) in which notes fns were compiled.
+        Returns the generation."""
+        generation = self.next_generation('pages')
+        self.db.executemany('INSERT INTO pages_log (generation, fn) VALUES (?, ?)',
+                            [(generation, fn) for fn in fns])
+        self.db.execute('DELETE FROM pages_log WHERE generation <= ?',
+                        (generation - PAGES_LOG,))
+        return generation
+
+    def get_pages_log(self, generation):
+        """Get notes compiled after the generation of pages, a list of (generation, fn)."""
+        return self.db.execute('SELECT generation, fn FROM pages_log WHERE generation > ? '
+                               'ORDER BY generation, rowid', (generation,)).fetchall()
+
+    def next_generation(self, name):
+        """Count a change of the data (call commit() when you're done)."""
+        generation = self.get_generation(name) + 1
+        self.set_generation(name, generation)
+        return generation
+
+    def remove(self, fn):
+        self.db.execute('DELETE FROM notes WHERE fn = ?', (fn,))
+        self.db.execute('DELETE FROM deps WHERE fn = ?', (fn,))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+_manifest = None
+
+
+def get_manifest():
+    """Get the manifest of this process (open it if needed)."""
+    global _manifest
+    if _manifest is None:
+        _manifest = Manifest()
+    return _manifest
+
+
+# main
+if __name__ == '__main__':
+    m = Manifest()
+    for fn, row in sorted(m.get_all().items()):
+        print(fn + ' ' + str(row['md_hash']) + ' ' + str(row['html_hash']))
@@ -1,29 +1,59 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Page - one note is a page."""
-import markdown
-import codecs
-from mdx_gfm import GithubFlavoredMarkdownExtension
 
 import os
 from os import sep
-from shutil import copy
 
-from engine.postprocessing import (add_title,
-                                   add_head_for_flask, change_data_tag_into_actual_data,
-                                   add_path_to_img, change_html_tags_bootstrap,
-                                   unhighlight, personal_tags_to_html, get_todo, get_captions,
-                                   get_divhr, use_icons)
+from engine.postprocessing import (Replacer, RULES_BEFORE_FIND_FILES, RULES_AFTER_FIND_FILES,
+                                   add_head_for_flask, unhighlight, get_caption_in_line)
 
-from engine.preprocessing import (include_md_files, get_image_path, get_youtube_embeds, get_abstract,
-                                  include_file, make_interna_links, make_sport_links)
-from engine.conf import PATH_TO_MD, PATH_TO_HTML, PATH_TO_ORIG, FIND_FILES_PLUGIN
+from engine.preprocessing import (Preprocessor, Context, include_md_file_in_line,
+                                  get_image_path_and_todo_in_line, get_youtube_embed_in_line,
+                                  get_abstract_in_line, include_file_in_line, make_interna_links_in_line,
+                                  make_sport_links_in_line)
+from engine.conf import PATH_TO_MD, PATH_TO_HTML, FIND_FILES_PLUGIN, MARKDOWN_BACKEND
+from engine.backends import get_backend
 from engine.make_tableofcontent import make_table_of_content
+from engine.manifest import get_manifest, get_hash
+from engine.pages import write_page
 from engine.plugins.find_files import find_files
 
 import logging
 logger = logging.getLogger('geekbook')
 
+# rules of pre_process, in order, see engine/preprocessing.py
+PREPROCESSOR = Preprocessor([
+    include_file_in_line,
+    include_md_file_in_line,
+    get_image_path_and_todo_in_line,
+    get_youtube_embed_in_line,
+    get_abstract_in_line,
+    get_caption_in_line,
+    make_interna_links_in_line,
+    make_sport_links_in_line,
+    # right_link_from_dropbox_screenshot
+])
+
+# replaces of post_process, see engine/postprocessing.py
+POSTPROCESSOR = Replacer(RULES_BEFORE_FIND_FILES + RULES_AFTER_FIND_FILES)
+POSTPROCESSOR_BEFORE_FIND_FILES = Replacer(RULES_BEFORE_FIND_FILES)
+POSTPROCESSOR_AFTER_FIND_FILES = Replacer(RULES_AFTER_FIND_FILES)
+
+_converter = None
+
+
+def get_converter():
+    """Get the Markdown converter (MARKDOWN_BACKEND, see engine/backends.py) of this process
+    (e.g. a worker of the builder).
+
+    It's created once and reset before every note, because to set up Markdown with all the
+    extensions takes more time than to compile a small note."""
+    global _converter
+    if _converter is None:
+        _converter = get_backend(MARKDOWN_BACKEND)
+    return _converter
+
 
 class Page(object):
     """Page class
@@ -33,25 +63,31 @@ class Page(object):
       fn - filename of the note, with .md
       md - md content of the note
       html - html content of the note
+      st - os.stat of the md file (when we read it)
+      md_hash - sha1 of the md file
+      deps - full paths of files included into the note (/note.md, [if:file])
 
     """
 
     def __init__(self, fn):
         """Init a Page and load the content of MD file into self.md"""
         self.fn = fn
+        self.html = ''
+        self.deps = []
         # it catches errors if the file is removed
         try:
-            with codecs.open(PATH_TO_MD + sep + fn, "r", "utf-8") as f:
-                self.md = f.read()
-            self.html = ''
-        except IOError:
+            with open(PATH_TO_MD + sep + fn, "rb") as f:
+                self.st = os.fstat(f.fileno())
+                raw = f.read()
+            self.md = raw.decode('utf-8')
+            self.md_hash = get_hash(raw)
+        except (IOError, OSError):
             logging.error('file removed ' + self.fn)
             self.md = None
 
     def get_html(self):
         """Compile md to get html"""
-        self.html = markdown.markdown(
-            self.md, extensions=[GithubFlavoredMarkdownExtension()])  # (linenums=False)'])
+        self.html = get_converter().convert(self.md)
         # html = '<link rel="stylesheet" href="/home/magnus/Dropbox/lb_v2/templates/Pygments/css/pygments.css" type="text/css">' + html
 
     def compile(self):
@@ -63,72 +99,56 @@ class Page(object):
         self.post_process()
 
     def pre_process(self):
-        """Do preprocessing.
-
-        E.g.::
+        """Do preprocessing, all rules of PREPROCESSOR in one pass over lines of the note.
 
-           self.md = get_image_path(self.md) """
-        self.md = include_file(self.md)
-        self.md = include_md_files(self.md)
-        self.md = get_image_path(self.md)
-        self.md = get_youtube_embeds(self.md)
-        self.md = get_abstract(self.md)
-        self.md = get_captions(self.md)
-        self.md = make_interna_links(self.md)
-        self.md = make_sport_links(self.md)
-        # self.md = right_link_from_dropbox_screenshot(self.md)
+        To add a new rule, write a function for a line (see e.g.
+        preprocessing.get_youtube_embed_in_line) and add it to PREPROCESSOR."""
+        self.md = PREPROCESSOR.process(self.md, Context(self.deps))
 
     def post_process(self):
-        """Do postprocessing"""
+        """Do postprocessing, first the structure (table of content, code blocks, head) and
+        then all small replaces (tags, icons, todos...) in one pass, see POSTPROCESSOR.
+
+        The html is the same as of postprocessing.post_process_step_by_step
+        (test it with ``python -m engine.postprocessing``)."""
         self.html = make_table_of_content(self.fn, self.html)
-        self.html = add_head_for_flask(self.html)
-        self.html = change_data_tag_into_actual_data(self.fn, self.html)
-        self.html = add_path_to_img(self.html)
-        self.html = change_html_tags_bootstrap(self.html)
         self.html = unhighlight(self.html)
-        self.html = personal_tags_to_html(self.html)
+        self.html = add_head_for_flask(self.html)
         if FIND_FILES_PLUGIN:
+            self.html = POSTPROCESSOR_BEFORE_FIND_FILES.sub(self.html, self.fn)
             self.html = find_files(self.html)
-        self.html = get_todo(self.html)
-        self.html = add_title(self.html, self.fn)
-        self.html = use_icons(self.html)
-        self.html = get_divhr(self.html)
+            self.html = POSTPROCESSOR_AFTER_FIND_FILES.sub(self.html, self.fn)
+        else:
+            self.html = POSTPROCESSOR.sub(self.html, self.fn)
+        self.html += '\n\n'  # get_todo and get_divhr used to add a new line each
 
     def is_changed(self):
-        """Check if the file on disc is different than `md`.
-
-        Make PATH_TO_ORIG if it does not exists.
+        """Check if the file on disc is different than the one we compiled last time
+        (see engine/manifest.py).
 
         Return:
           boolean
         """
         # check if self.md exits, it does not exist if __ini__ failed (and it fails when the
         # file is removed
-        if self.md:
-            if not os.path.exists(PATH_TO_ORIG):
-                os.makedirs(PATH_TO_ORIG)
-
-            try:
-                with codecs.open(PATH_TO_ORIG + sep + self.fn, "r", "utf-8") as f:
-                    orig_md = f.read()
-            except IOError:
-                logging.error('file not detected. Create it: ' + self.fn)
-                orig_md = ''
-                pass
-
-            if self.md != orig_md:
-                copy(PATH_TO_MD + sep + self.fn, PATH_TO_ORIG + sep + self.fn)
-                return True
-            else:
-                return False
-
-    def save(self):
-        """Save html file to the drive"""
+        if self.md is not None:
+            return get_manifest().is_changed(self.fn, self.st, self.md_hash)
+
+    def save(self, record=True):
+        """Save html file (and its compressed copies, see engine/pages.py) to the drive and
+        remember it in the manifest.
+
+        Use record=False if you want to update the manifest on your own (e.g. builder)."""
         if not os.path.exists(PATH_TO_HTML):
             os.mkdir(PATH_TO_HTML)
 
-        with codecs.open(PATH_TO_HTML + self.fn.replace('.md', '.html'), "w", "utf-8") as outfn:
-            outfn.write(self.html)
+        # and .etag, .gz, .br
+        self.html_hash = write_page(PATH_TO_HTML + self.fn.replace('.md', '.html'), self.html)
+        if record:
+            manifest = get_manifest()
+            manifest.update(self.fn, self.st, self.md_hash, self.html_hash, self.deps)
+            manifest.log_pages([self.fn])  # flask checks its pages (see engine/pages.py)
+            manifest.commit()
 
 
 # start
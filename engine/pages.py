@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Pages - html pages written for flask, and served by flask with validators (ETag,
+Last-Modified) and compressed.
+
+When a page (a note or index.html) is written, compressed copies of it are written next
+to it: page.html.gz and page.html.br (brotli, only if the brotli module is installed; pip install
+brotli). Flask sends the smallest one the browser accepts (Accept-Encoding), so a page is
+never compressed for a request.
+
+The ETag of a page is sha1 of its html (it's the html_hash the manifest keeps for notes,
+see engine/manifest.py), written next to it too (page.html.etag), so flask does not read the
+whole page to get it. The ETag and the compressed copies are written first, the html last, so
+when flask sees a new html, all its files are there. Files not written between the ETag and
+the html (e.g. left by a write that was stopped) are not used. The ETag is read again only
+when mtime or size of the html are changed, and if the browser has the page already
+(If-None-Match or If-Modified-Since), flask answers 304 Not Modified without a body.
+
+Flask keeps pages (and their compressed copies) in memory, the ones used most recently, up
+to PAGE_CACHE_MB. The build counts every time it writes pages (the ``pages`` generation in
+the manifest), a thread of flask checks the manifest every POLL seconds, and a page is checked
+on the disc (os.stat) only if pages were written since it was checked last time. So a page
+asked for often is sent without touching the disc at all.
+"""
+import os
+import re
+import time
+import zlib
+import threading
+import email.utils
+from collections import OrderedDict
+
+from engine.conf import PATH_TO_MANIFEST, PAGE_CACHE_MB
+from engine.manifest import Manifest, ManifestError, get_hash, get_file_hash, get_manifest_stamp
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import logging
+logger = logging.getLogger('geekbook')
+
+POLL = 0.5  # seconds between checks of the manifest
+
+
+def gzip_compress(data):
+    """Gzip data, the same data gives always the same bytes (no time in the header)."""
+    c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+# Content-Encoding, extension, compress function; the smallest first
+ENCODINGS = [('gzip', '.gz', gzip_compress)]
+if brotli:
+    ENCODINGS.insert(0, ('br', '.br', brotli.compress))
+
+
+def write_page(path, html):
+    """Write the html (unicode) to path, its ETag and compressed copies next to it (path.etag,
+    path.gz, path.br). The html is written last. Returns the ETag (sha1 of the html)."""
+    data = html.encode('utf-8')
+    etag = get_hash(data)
+    if not brotli and os.path.exists(path + '.br'):  # from the time brotli was installed
+        os.remove(path + '.br')
+    files = [('.etag', etag)] + [(ext, compress(data)) for name, ext, compress in ENCODINGS]
+    for ext, d in files + [('', data)]:
+        tmp = path + ext + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(d)
+        os.rename(tmp, path + ext)
+    return etag
+
+
+def remove_page(path):
+    """Remove the html file and its compressed copies (if there are)."""
+    for ext in ['', '.etag', '.gz', '.br']:
+        try:
+            os.remove(path + ext)
+        except OSError:
+            pass
+
+
+class Page(object):
+    """A page as flask serves it.
+
+    Attributes:
+
+      path - of the html file
+      stamp - (mtime, size) of the file
+      etag - sha1 of the file
+      last_modified - mtime, as in http headers
+      encodings - Content-Encoding -> path of a compressed copy, only copies written with the file
+      generation - of pages (see Pages) when the page was checked
+    """
+
+    def __init__(self, path, st):
+        self.path = path
+        self.generation = None
+        self.stamp = (st.st_mtime, st.st_size)
+        self.last_modified = email.utils.formatdate(int(st.st_mtime), usegmt=True)
+        self.etag, written = self.read_etag(st)
+        self.encodings = {}
+        if self.etag is None:  # an html not written by write_page, no copies of it
+            self.etag = get_file_hash(path)
+            return
+        for name, ext, compress in ENCODINGS:
+            try:
+                if written <= os.stat(path + ext).st_mtime <= st.st_mtime:
+                    self.encodings[name] = path + ext
+            except OSError:
+                pass
+
+    def read_etag(self, st):
+        """Get (ETag, mtime of its file) written with the html (st), (None, None) if there is
+        no such ETag."""
+        try:
+            with open(self.path + '.etag', 'rb') as f:
+                written = os.fstat(f.fileno()).st_mtime
+                etag = f.read().strip()
+        except (IOError, OSError):
+            return None, None
+        if written > st.st_mtime or not etag:  # of the next html, it's being written
+            return None, None
+        return etag, written
+
+    def is_not_modified(self, if_none_match, if_modified_since):
+        """Check validators of a request (values of If-None-Match and If-Modified-Since)."""
+        if if_none_match:  # the ETag wins
+            etags = [re.sub('^W/', '', e.strip()).strip('"').split('-')[0]  # "sha1-gzip"
+                     for e in if_none_match.split(',')]
+            return self.etag in etags or '*' in etags
+        if if_modified_since:
+            since = email.utils.parsedate_tz(if_modified_since)
+            return since is not None and email.utils.mktime_tz(since) >= int(self.stamp[0])
+        return False
+
+    def get_encoding(self, accept_encoding):
+        """Get (Content-Encoding, path) of the best copy for Accept-Encoding, (None, path)
+        of the html if there is no such copy."""
+        accepted = [e.split(';')[0].strip() for e in (accept_encoding or '').split(',')
+                    if not e.replace(' ', '').endswith(';q=0')]
+        for name, ext, compress in ENCODINGS:
+            if name in accepted and name in self.encodings:
+                return name, self.encodings[name]
+        return None, self.path
+
+
+class Pages(object):
+    """Pages known to flask, with the content of the most recently used ones in memory.
+
+    Usage::
+
+        pages = Pages()
+        page = pages.get(PATH_TO_HTML + 'test.html')  # None if there is no such file
+        encoding, path = page.get_encoding('gzip, deflate')
+        html = pages.read(page, encoding, path)
+
+    Attributes:
+
+      pages - path -> Page
+      data - (path, Content-Encoding) -> ((mtime, size) of the page, bytes), the most recent last
+      size - bytes in data
+      generation - of pages in the manifest, None if unknown (then pages are checked every time)
+    """
+
+    def __init__(self, max_bytes=PAGE_CACHE_MB * 1024 * 1024, path=PATH_TO_MANIFEST):
+        self.pages = {}
+        self.data = OrderedDict()
+        self.size = 0
+        self.max_bytes = max_bytes
+        self.path = path
+        self.stamp = None
+        self.generation = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def refresh(self):
+        """Take the generation of pages, if the manifest is changed."""
+        stamp = get_manifest_stamp(self.path)
+        if stamp != self.stamp:
+            try:
+                manifest = Manifest(self.path, readonly=True)
+            except ManifestError as e:  # nothing built yet, pages are checked every time
+                logger.debug('pages: %s' % e)
+                self.generation = None
+            else:
+                try:
+                    self.generation = manifest.get_generation('pages')
+                finally:
+                    manifest.close()
+            self.stamp = stamp
+
+    def watch(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('pages: checking the manifest failed')
+                self.generation = None
+            time.sleep(POLL)
+
+    def start(self):
+        """Start watching the manifest (again in a new process of gunicorn)."""
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.watch)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def get(self, path):
+        self.start()
+        page = self.pages.get(path)
+        generation = self.generation
+        if page is not None and generation is not None and page.generation == generation:
+            return page  # nothing written since we checked it
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if page is None or page.stamp != (st.st_mtime, st.st_size):
+            page = Page(path, st)
+        page.generation = generation
+        with self.lock:
+            self.pages[path] = page
+        return page
+
+    def read(self, page, encoding, path):
+        """Get the page (encoding is None) or its compressed copy (path of it), from memory
+        if it's there. Pages bigger than a quarter of the memory are not kept."""
+        key = (page.path, encoding)
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is not None:
+                if entry[0] == page.stamp:
+                    self.data[key] = entry  # the most recent now
+                    return entry[1]
+                self.size -= len(entry[1])
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) <= self.max_bytes // 4:
+            with self.lock:
+                old = self.data.pop(key, None)
+                if old is not None:
+                    self.size -= len(old[1])
+                self.data[key] = (page.stamp, data)
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    key, (stamp, old) = self.data.popitem(last=False)
+                    self.size -= len(old)
+        return data
+
+
+# main
+if __name__ == '__main__':
+    import sys
+    from engine.conf import PATH_TO_HTML
+    pages = Pages()
+    for fn in sys.argv[1:] or ['test.html']:
+        page = pages.get(PATH_TO_HTML + fn)
+        if page is None:
+            print('%s not found' % fn)
+            continue
+        print('%s %s %s' % (fn, page.etag, page.last_modified))
+        for name, path in sorted(page.encodings.items()):
+            print('  %-4s %7i bytes' % (name, os.path.getsize(path)))
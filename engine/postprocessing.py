@@ -17,7 +17,12 @@ from pygments import highlight
 from pygments.lexers import PythonLexer, HtmlLexer, CssLexer, EmacsLispLexer, BashLexer, HexdumpLexer, DjangoLexer
 from pygments.formatters import HtmlFormatter
 
-from engine.conf import PATH_TO_BASE_IMG, PATH_TO_TEMPLATE, PATH_TO_TEMPLATE_HTML, PATH_TO_HTML, PATH_TO_MD
+from engine.conf import (PATH_TO_BASE_IMG, PATH_TO_TEMPLATE, PATH_TO_TEMPLATE_HTML, PATH_TO_HTML,
+                         PATH_TO_MD, FIND_FILES_PLUGIN)
+from engine.preprocessing import Preprocessor, rule
+from engine.make_tableofcontent import make_table_of_content
+from engine.plugins.find_files import find_files
+from engine.theme import get_head
 
 
 def change_data_tag_into_actual_data(mdfn, text):
@@ -27,6 +32,25 @@ def change_data_tag_into_actual_data(mdfn, text):
     return text
 
 
+# [!tag] and [tag!] change text background depending on text contest, the rules of Replacer
+# (see RULES_BEFORE_FIND_FILES); the functions below are the old chain, kept as they were,
+# post_process_step_by_step checks the rules against them
+PERSONAL_TAGS = [
+    # warning text
+    ('[!warning]', '<p class="bg-warning">'),
+    ('[warning!]', '<br></p>'),
+    # danger text
+    ('[!danger]', '<p class="bg-danger">'),
+    ('[danger!]', '<br></p>'),
+    # succes text
+    ('[!success]', '<p class="bg-success">'),
+    ('[success!]', '<br></p>'),
+    # info text
+    ('[!info]', '<p class="bg-info">'),
+    ('[info!]', '<br></p>'),
+]
+
+
 def personal_tags_to_html(text):
     """ insert here your personal tags!"""
     # Change text background depending on text contest.
@@ -47,33 +71,13 @@ def personal_tags_to_html(text):
 
 
 def add_head_for_flask(text):
-    head = open(PATH_TO_TEMPLATE_HTML).read()
-    head = head.replace('{{ url_index }}', PATH_TO_HTML + '/' + 'index.html')
-    head = head.replace('href="img/', 'href="' + '/img/')
-    head = head.replace('="lib/', '="' + '/lib/')
-    head = head.replace('="css/', '="' + '/css/')
-    head = head.replace('="js/', '="' + '/js/')
-
-    # remove demo content
-    head = re.sub(r'<!-- start of demo -->.*<!-- end of demo -->',
-                  r'', head, flags=re.M | re.DOTALL)
-    return head + text
+    """Add head html from template, links for flask (see engine/theme.py)"""
+    return get_head() + text
 
 
 def add_head(text):
     """Add head html from template  """
-    head = open(PATH_TO_TEMPLATE_HTML).read()
-    head = head.replace('{{ url_index }}', PATH_TO_HTML + '/' + 'index.html')
-
-    head = head.replace('href="img/', 'href="' + PATH_TO_TEMPLATE + '/img/')
-    head = head.replace('="lib/', '="' + PATH_TO_TEMPLATE + '/lib/')
-    head = head.replace('="css/', '="' + PATH_TO_TEMPLATE + '/css/')
-    head = head.replace('="js/', '="' + PATH_TO_TEMPLATE + '/js/')
-
-    # remove demo content
-    head = re.sub(r'<!-- start of demo -->.*<!-- end of demo -->',
-                  r'', head, flags=re.M | re.DOTALL)
-    return head + text
+    return get_head(PATH_TO_TEMPLATE + '/') + text
 
     #head_new = ''
     # for l in head.split('\n'):
@@ -86,6 +90,12 @@ def add_head(text):
     # return head + text
 
 
+ICONS = [
+    ('!!!', '<span class="label label-danger">!</span>'),
+    ('!!', '<span class="label label-warning">!</span>'),
+]
+
+
 def use_icons(text):
     """
     https://www.w3schools.com/bootstrap/bootstrap_badges_labels.asp
@@ -136,6 +146,18 @@ def add_path_to_img(text):
     return(text)
 
 
+CHECKBOXES = [
+    # of list
+    ('<li>[ ]', '<li><input type="checkbox" />'),
+    ('<li>[X]', '<li><input type="checkbox" checked="checked" />'),
+    ('<li>[x]', '<li><input type="checkbox" checked="checked" />'),
+    # every [ ] is change
+    ('[ ]', '<input type="checkbox" />'),
+    ('[X]', '<input type="checkbox" checked="checked" />'),
+    ('[x]', '<input type="checkbox" checked="checked" />'),
+]
+
+
 def change_todo_square_chainbox_or_icon(text, verbose=False):
     """Set of rules to replace [i] etc with <img ... >  [ OK ]"""
     # of list
@@ -149,6 +171,21 @@ def change_todo_square_chainbox_or_icon(text, verbose=False):
     return text
 
 
+TODO_TAGS = [
+    ('@todo', '<span class="label label-danger">@todo</span>'),
+    ('@inprogress', '<span class="label label-warning">@inprogress</span>'),
+    ('@progress', '<span class="label label-warning">@progress</span> '),
+    ('@done', '<span class="label label-success">@done</span>'),
+    ('@fixed', '<span class="label label-info">@fixed</span>'),
+    ('@error', '<span class="label label-danger">@error</span>'),
+    ('True', '<span class="label label-success">True</span>'),
+    ('False', '<span class="label label-danger">False</span>'),
+]
+
+# lines of headers, todo tags are not used there
+TODO_SKIP_LINES = ('<div id=', '<li class="table_of_content')
+
+
 def get_todo(text):
     """Replace *in text* @todo, @inprogress and @done with `<span class="label label-danger">@todo</span>` and so on.
     """
@@ -172,17 +209,19 @@ def get_todo(text):
     return ntext
 
 
+@rule(lambda l: l.startswith('Fig'))
+def get_caption_in_line(l, ctx=None):
+    """Make a caption of a line starting with Fig. or Figure."""
+    if l.startswith('Fig.') or l.startswith('Figure.'):
+        l = l.replace('Figure.', '<small><b>Figure.</b>')
+        l = l.replace('Fig.', '<small><b>Figure.</b>')
+        l += '</small>'
+    return l
+
+
 def get_captions(text):
-    """Replace *in text* @todo, @inprogress and @done with `<span class="label label-danger">@todo</span>` and so on.
-    """
-    ntext = ''
-    for l in text.split('\n'):
-        if l.startswith('Fig.') or l.startswith('Figure.'):
-            l = l.replace('Figure.', '<small><b>Figure.</b>')
-            l = l.replace('Fig.', '<small><b>Figure.</b>')
-            l += '</small>'
-        ntext += l + '\n'
-    return ntext
+    """See get_caption_in_line."""
+    return Preprocessor([get_caption_in_line]).process(text)
 
 def get_divhr(text):
     """"""
@@ -205,19 +244,220 @@ def get_divhr(text):
     return ntext
 
 
+CLEAR = '<div style="clear:both"></div>'
+
+DIVHR = [('^<hr />', CLEAR + '<hr>')] + [('<h%i' % i, CLEAR + '<h%i' % i) for i in range(1, 6)]
+
+
+class Replacer(object):
+    """Do a list of text.replace(old, new), one after another, in one pass over the text.
+
+    Rules are (old, new) or (old, new, skip_lines), in the order you would call replace:
+
+    - new is a str, or a function that gets the args of sub() and returns a str,
+    - old starting with ^ is replaced only in lines that start with it (see get_divhr),
+    - skip_lines is a tuple of prefixes of lines where the rule is not used (see get_todo).
+
+    As with a chain of replace, what a rule puts into the text is seen by the rules that
+    come after it (but not by the rule itself and the rules before).
+
+    All olds go into one regex (an alternation of literals, so re can jump to the first
+    char of any of them) and the rule is picked from a dict by the matched text.
+
+    Usage::
+
+        r = Replacer([('[date]', get_date), ('!!', '<b>!</b>')])
+        html = r.sub(html, 'test.md')
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        self.index = {}
+        for r in rules:
+            old, new = r[0], r[1]
+            skip_lines = r[2] if len(r) > 2 else ()
+            bol = old.startswith('^')
+            if bol:
+                old = old[1:]
+            if old not in self.index:
+                self.index[old] = len(self.rules)
+            self.rules.append((old, new, bol, skip_lines))
+        if self.rules:
+            self.regex = re.compile('|'.join(re.escape(r[0]) for r in self.rules))
+        else:
+            self.regex = None
+        self._after = {}  # i -> Replacer of rules after i
+        self._news = {}  # i -> new (a str) after the rules that come later
+
+    def after(self, i):
+        """Get Replacer of rules that come after the rule i."""
+        if i not in self._after:
+            self._after[i] = Replacer([(('^' if bol else '') + old, new, skip_lines)
+                                       for old, new, bol, skip_lines in self.rules[i + 1:]])
+        return self._after[i]
+
+    def _new(self, i, args):
+        new = self.rules[i][1]
+        if callable(new):
+            return self.after(i).sub(new(*args), *args)
+        if i not in self._news:
+            self._news[i] = self.after(i).sub(new)
+        return self._news[i]
+
+    def sub(self, text, *args):
+        """Do all replaces on text, args are passed to rules with functions."""
+        if self.regex is None:
+            return text
+
+        def replace(m):
+            i = self.index[m.group(0)]
+            old, new, bol, skip_lines = self.rules[i]
+            if bol or skip_lines:
+                start = text.rfind('\n', 0, m.start()) + 1
+                if bol and not text.startswith(old, start):
+                    return m.group(0)
+                if skip_lines and text.startswith(skip_lines, start):
+                    return m.group(0)
+            return self._new(i, args)
+
+        return self.regex.sub(replace, text)
+
+
+def get_date(mdfn):
+    """Get the date of the note for [date]"""
+    return time.strftime("%Y-%m-%d", time.localtime(os.path.getctime(PATH_TO_MD + mdfn)))
+
+
+def get_title(mdfn):
+    """Get <head> with the title of the note, see add_title"""
+    return '<head>\n  <title>' + mdfn.replace('.md', '') + '</title>'
+
+
+# rules of post_process, in the order of post_process_step_by_step, find_files goes in between
+RULES_BEFORE_FIND_FILES = [
+    ('[date]', get_date),
+    ('src="img/', 'src="' + PATH_TO_TEMPLATE + '/img/'),
+    ('<table>', '<table class="table table-hover">'),
+] + PERSONAL_TAGS
+
+RULES_AFTER_FIND_FILES = ([(tag, html, TODO_SKIP_LINES) for tag, html in TODO_TAGS] +
+                          CHECKBOXES + [('<head>', get_title)] + ICONS + DIVHR)
+
+
+def post_process_step_by_step(fn, text):
+    """Postprocessing as it used to be done, one function after another (slow, each function
+    goes over the whole html). Page.post_process must give the same html, see main."""
+    text = make_table_of_content(fn, text)
+    text = add_head_for_flask(text)
+    text = change_data_tag_into_actual_data(fn, text)
+    text = add_path_to_img(text)
+    text = change_html_tags_bootstrap(text)
+    text = unhighlight(text)
+    text = personal_tags_to_html(text)
+    if FIND_FILES_PLUGIN:
+        text = find_files(text)
+    text = get_todo(text)
+    text = add_title(text, fn)
+    text = use_icons(text)
+    text = get_divhr(text)
+    return text
+
+
+SAMPLE = u"""# Sample @todo !!! [date]
+[tableofcontent]
+## Header @done True
+<table> src="img/x.png" [!warning] warn [warning!] [!info] info [info!] !! !!!! ok
+- [ ] task @inprogress
+- [x] done False @progress @fixed @error
+- [X] Done
+
+    code [date] True <h1
+
+<hr />
+---
+text <hr /> [ ] [ff:file.txt] [files-not-found] zażółć
+### Last <h5 <head>
+"""
+
+# cases for the golden test, (name, markdown), besides SAMPLE, notes and examples/
+SAMPLES = [
+    ('SAMPLE', SAMPLE),
+    ('empty', u''),
+    ('overlaps', u"""# !!!!! [!danger][danger!][!success]x[success!]
+
+!!!!!! !! ! [x][X][ ] [[ ]] [date][date] @todo@done @inprogress@progress @progressive
+TrueFalse NotTrue False-True @error@fixed @@todo
+"""),
+    ('lists', u"""## Todo True
+
+- [ ] one @todo
+- [x] two @done
+* [X] three
+1. [ ] four !!!
+    - [ ] nested [x]
+
+| a [ ] | b !! |
+|-------|------|
+| True  | <table> |
+"""),
+    ('html', u"""<div id="x">@todo True !!</div>
+<li class="table_of_content">@done</li>
+<h1>True</h1><h2>@todo</h2><h3>x</h3><h4>y</h4><h5>z</h5><h6>w</h6>
+<hr /> <hr /><head></head>
+<img src="img/a.png"> src="img/b.png"
+
+```
+<h1 @todo [ ] [date] !!
+<hr />
+```
+"""),
+    ('headers', u"""Before a header @todo
+
+### Third first [ ]
+# One !!!
+###### Six True
+## Two [!info]
+text [info!]
+"""),
+]
+
+
 # main
 if __name__ == '__main__':
-    content = sys.stdin.read()
-    # output = change_infotags_into_icon(content)
-    # output = change_todo_square_chainbox_or_icon(output)
-    output = change_data_tag_into_actual_data(output)
-    output = add_path_to_img(output)
-    output = change_html_tags_bootstrap(output)
-    output = personal_tags_to_html(output)
-    # output = change_tags_into_searchtaglinks(text)
-    # output = remove_em(output)
-    # output = include_file(output)
-    # output = make_inner_link(output)
-    output = pigmentize(output)
-    sys.stdout.write(output)
-    sys.stdout.write
+    # golden test: python -m engine.postprocessing [note.md ...]
+    # Page.post_process must give the same html as post_process_step_by_step, for SAMPLES,
+    # examples/ and notes (all of them by default), with and without the find files plugin
+    import glob
+    import codecs
+    import engine.page
+    from engine.page import Page
+    fns = sys.argv[1:] or sorted(fn for fn in os.listdir(PATH_TO_MD) if fn.endswith('.md'))
+    cases = list(SAMPLES)
+    if not sys.argv[1:]:
+        examples = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'examples')
+        for path in sorted(glob.glob(examples + os.sep + '*.md')):
+            cases.append(('examples/' + os.path.basename(path),
+                          codecs.open(path, encoding='utf-8').read()))
+    cases += [(fn, None) for fn in fns]
+    ok = 0
+    failed = []
+    for FIND_FILES_PLUGIN in (False, True):
+        engine.page.FIND_FILES_PLUGIN = FIND_FILES_PLUGIN
+        for name, md in cases:
+            fn = 'test.md' if md is not None else name  # samples need a note for [date]
+            p = Page(fn)
+            if p.md is None:
+                continue
+            if md is not None:
+                p.md = md
+            p.pre_process()
+            p.get_html()
+            html = p.html
+            p.post_process()
+            if p.html == post_process_step_by_step(fn, html):
+                ok += 1
+            else:
+                failed.append(name)
+    print('golden test: %i ok, %i failed %s' % (ok, len(failed), ' '.join(failed)))
+    sys.exit(1 if failed else 0)
@@ -3,6 +3,10 @@
 
 """This is a set of functions that work on Markdown file, before compiling them to html.
 
+Most of them work on a single line (``*_in_line``), a Preprocessor runs all of them in one
+pass over the lines of a note (instead of splitting and joining the whole note again and again
+for each function).
+
 Go to page.py (Page) pre_process to add a new function from here."""
 
 from conf import PATH_TO_IMG, PATH_TO_MD
@@ -16,6 +20,129 @@ logger.setLevel(logging.INFO)
 
 FLASK_BASED = True
 
+# content of files included into notes (/note.md, [if:file]), full path -> text or None
+# if the file can not be read, kept for the whole build, see clear_cache()
+_files_cache = {}
+
+
+def clear_cache():
+    """Forget the content of included files (call it when a new build starts)."""
+    _files_cache.clear()
+
+
+def read_included_file(path):
+    """Get the content of an included file (or None if it can not be read), every file is
+    read only once per build."""
+    path = os.path.abspath(path)
+    if path not in _files_cache:
+        try:
+            with codecs.open(path, "r", "utf-8") as f:
+                _files_cache[path] = f.read()
+        except IOError:
+            _files_cache[path] = None
+    return _files_cache[path]
+
+
+class Context(object):
+    """State of one run of the Preprocessor, shared by rules.
+
+    Attributes:
+
+      deps - full paths of included files (/note.md, [if:file])
+      abstract - lines collected for [abstract]
+      abstract_flag - True after the [abstract] line
+      head - lines to be put at the very beginning of the note (rules add them here)
+      top - the same lines, but already processed by the rules after the one that added them
+    """
+
+    def __init__(self, deps=None):
+        if deps is None:
+            deps = []
+        self.deps = deps
+        self.abstract = []
+        self.abstract_flag = False
+        self.head = []
+        self.top = []
+
+
+class Later(object):
+    """Return it from a rule if the line can be finished only when the whole note is seen.
+    finish(line, ctx) is called at the end and gets the line (and the context)."""
+
+    def __init__(self, line, finish):
+        self.line = line
+        self.finish = finish
+
+
+def rule(match):
+    """Decorator, make a line function a rule for the Preprocessor.
+
+    match(line) is a quick test if the rule should be used for the line at all. The
+    function gets (line, ctx) and returns a new line, or a list of lines (e.g. the content of
+    an included file), or Later."""
+    def decorator(func):
+        func.match = match
+        return func
+    return decorator
+
+
+class Preprocessor(object):
+    """Run many line rules over a note in one pass.
+
+    Rules are used in order, lines returned by a rule go only to the rules after this one, so
+    you get the same as if you run the rules one by one over the whole note.
+
+    Usage::
+
+       p = Preprocessor([include_file_in_line, get_youtube_embed_in_line])
+       md = p.process(md)
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def _run(self, lines, start, out, ctx):
+        """Run lines through rules[start:] and append results to out."""
+        rules = self.rules
+        n = len(rules)
+        for l in lines:
+            i = start
+            while i < n:
+                r = rules[i]
+                if r.match(l):
+                    l = r(l, ctx)
+                    if ctx.head:
+                        # this line goes to the beginning of the note, but first
+                        # let's run the rules after this one
+                        head, ctx.head = ctx.head, []
+                        done = []
+                        self._run(head, i + 1, done, ctx)
+                        ctx.top[0:0] = done
+                    if isinstance(l, list):
+                        self._run(l, i + 1, out, ctx)
+                        break
+                    if isinstance(l, Later):
+                        out.append((l, i))
+                        break
+                i += 1
+            else:
+                out.append(l)
+
+    def process(self, text, ctx=None):
+        """Process the text (md of a note), returns a new text."""
+        if ctx is None:
+            ctx = Context()
+        out = []
+        self._run(text.split('\n'), 0, out, ctx)
+        lines = ctx.top
+        for l in out:
+            if isinstance(l, tuple):  # Later
+                later, i = l
+                self._run(later.finish(later.line, ctx).split('\n'), i + 1, lines, ctx)
+            else:
+                lines.append(l)
+        return '\n'.join(lines) + '\n'
+
 
 def change_todo_square_chainbox_or_icon(text, verbose=False):
     """Set of rules to replace [i] etc with <img ... >  [ OK ]"""
@@ -28,67 +155,78 @@ def change_todo_square_chainbox_or_icon(text, verbose=False):
     return text
 
 
-def get_abstract(text):
+def _finish_abstract(l, ctx):
+    abstract = '<div class="abstract">' + ' '.join(ctx.abstract) + '</div><br />\n\n'
+    return l.replace('[abstract]', abstract)
+
+
+@rule(lambda l: '[abstract]' in l or l.startswith('! ') or '\\\\' in l)
+def get_abstract_in_line(l, ctx):
     """Collect all lines starting with ``! `` and insert it as in abstract in a place tagged as [abstract].
 
     Now you can use ** to bold some text.
     You can use \\ to introduce a break (</br>).
     """
-    ntext = ''
-    abstract = []
+    if l.strip() == '[abstract]':
+        ctx.abstract_flag = True
+    if l.startswith('! '):
+        if ctx.abstract_flag:
+            # my own converter from **XX** to <b>XX</b>
+            rx = re.findall('\*\*(?P<tobold>.+?)\*\*', l)
+            for r in rx:
+                print(r)
+                l = l.replace('**' + r + '**', '<b>' + r + '</b>')
+            #
+            # \\ -> </br>
+            ctx.abstract.append(l[1:].replace('\\\\', '</br>'))
+        l = '<div class="abstract"> ' + l[1:] + '</div>'
+    # this is conversion of lines along the note, remove \\ but don't convert into br/
+    l = l.replace('\\\\', '')
+    if '[abstract]' in l:
+        # we know the abstract when we see the whole note
+        return Later(l, _finish_abstract)
+    return l
 
-    abstract_flag = False
-    for l in text.split('\n'):
-        if l.strip() == '[abstract]':
-            abstract_flag = True
-        if l.startswith('! '):
-            if abstract_flag:
-                # my own converter from **XX** to <b>XX</b>
-                rx = re.findall('\*\*(?P<tobold>.+?)\*\*', l)
-                for r in rx:
-                    print r
-                    l = l.replace('**' + r + '**', '<b>' + r + '</b>')
-                #
-                # \\ -> </br>
-                abstract.append(l[1:].replace('\\\\', '</br>'))
-            l = '<div class="abstract"> ' + l[1:] + '</div>'
-        # this is conversion of lines along the note, remove \\ but don't convert into br/
-        ntext += l.replace('\\\\', '') + '\n'
-    abstract = '<div class="abstract">' + ' '.join(abstract) + '</div><br />\n\n'
-    ntext = ntext.replace('[abstract]', abstract)
-    return ntext
+
+def get_abstract(text):
+    """See get_abstract_in_line."""
+    return Preprocessor([get_abstract_in_line]).process(text)
+
+
+@rule(lambda l: '[file:' in l)
+def make_interna_links_in_line(l, ctx=None, verbose=False):
+    # [file:xxxx.md]
+    rx = re.findall('\[file\:(?P<filename>.+?)\]', l)
+    for r in rx:
+        l = l.replace('[file:' + r + ']', '<a href="http://127.0.0.1:5000/view/' + r.replace('.md', '.html') + '">' + \
+                      r.replace('.md','') + '</a>')
+        if verbose: print(l)
+    return l
 
 
 def make_interna_links(text, verbose=False):
-    ntext = ''
-    for l in text.split('\n'):
-        # [file:xxxx.md]
-        rx = re.findall('\[file\:(?P<filename>.+?)\]', l)
-        for r in rx:
-            l = l.replace('[file:' + r + ']', '<a href="http://127.0.0.1:5000/view/' + r.replace('.md', '.html') + '">' + \
-                          r.replace('.md','') + '</a>')
-            if verbose: print(l)
-        ntext += l + '\n'
-    return ntext
+    return Preprocessor([make_interna_links_in_line]).process(text)
+
+
+@rule(lambda l: '[sport:' in l)
+def make_sport_links_in_line(l, ctx=None, verbose=False):
+    # [file:xxxx.md]
+    rx = re.findall('\[sport\:(?P<date>.+?)\]', l)
+    for r in rx:
+        # 181203
+        y = r[:2]
+        m = r[2:4]
+        d = r[4:]
+        print(rx, y, m, d)
+        l = '<a target="_top" href="http://www.myfitnesspal.com/food/diary?date=20%s-%s-%s">MFP</a> ' % (y, m, d)
+        print(l)
+        l += '<a target="_top" href="https://connect.garmin.com/modern/daily-summary/mmagnus/20%s-%s-%s">Garmin Connect</a>' % (y, m, d)
+        if verbose: print(l)
+    return l
 
 
 def make_sport_links(text, verbose=False):
-    ntext = ''
-    for l in text.split('\n'):
-        # [file:xxxx.md]
-        rx = re.findall('\[sport\:(?P<date>.+?)\]', l)
-        for r in rx:
-            # 181203
-            y = r[:2]
-            m = r[2:4]
-            d = r[4:]
-            print(rx, y, m, d)
-            l = '<a target="_top" href="http://www.myfitnesspal.com/food/diary?date=20%s-%s-%s">MFP</a> ' % (y, m, d)
-            print(l)
-            l += '<a target="_top" href="https://connect.garmin.com/modern/daily-summary/mmagnus/20%s-%s-%s">Garmin Connect</a>' % (y, m, d)
-            if verbose: print(l)
-        ntext += l + '\n'
-    return ntext
+    return Preprocessor([make_sport_links_in_line]).process(text)
 
 
 def get_image_path_in_line(l):
@@ -176,27 +314,31 @@ def get_image_path_in_line(l):
     return l
 
 
+@rule(lambda l: '![' in l or '<li>[' in l)
+def get_image_path_and_todo_in_line(l, ctx=None):
+    """See get_image_path_in_line, plus checkboxes of lists (change_todo_square_chainbox_or_icon)."""
+    if '![' in l:
+        l = get_image_path_in_line(l)
+    return change_todo_square_chainbox_or_icon(l)
+
+
 def get_image_path(text):
     """Get image path for text. See get_image_path_in_line (to get links per line) to learn more."""
-    ntext = ''
-    for l in text.split('\n'):
-        l = get_image_path_in_line(l)
-        ntext += l + '\n'
-    ntext = change_todo_square_chainbox_or_icon(ntext)
-    return ntext
+    return Preprocessor([get_image_path_and_todo_in_line]).process(text)
 
 
-def get_youtube_embeds(text):
-    ntext = ''
+@rule(lambda l: '[yt:' in l)
+def get_youtube_embed_in_line(l, ctx=None):
+    if l.strip().startswith('[yt:'):
+        video_id = l.replace('[yt:', '').replace(']', '').strip()
+        logger.info('youtube video detected: %s', video_id)
+        l = '<iframe width="800" height="441" src="https://www.youtube.com/embed/' + \
+            video_id + '" frameborder="0" allowfullscreen></iframe>'
+    return l
 
-    for l in text.split('\n'):
-        if l.strip().startswith('[yt:'):
-            video_id = l.replace('[yt:', '').replace(']', '').strip()
-            logger.info('youtube video detected: %s', video_id)
-            l = '<iframe width="800" height="441" src="https://www.youtube.com/embed/' + \
-                video_id + '" frameborder="0" allowfullscreen></iframe>'
-        ntext += l + '\n'
-    return ntext
+
+def get_youtube_embeds(text):
+    return Preprocessor([get_youtube_embed_in_line]).process(text)
 
 
 def right_MD_from_webservices(text):
@@ -219,54 +361,68 @@ def right_MD_from_webservices(text):
     return text, changed
 
 
-def include_md_files(md):
+@rule(lambda l: l.startswith('/') and l.endswith('.md') and l.count('/') == 1)
+def include_md_file_in_line(l, ctx):
+    """Whenever you see /<file.md> include content of this file in here.
+
+    Returns:
+
+       list: lines of the included note (without the first line, the title)
+    """
+    ffullpath = PATH_TO_MD + os.sep + l.replace('/', '').strip()
+    ctx.deps.append(os.path.abspath(ffullpath))
+    txt = read_included_file(ffullpath)
+    # check if exists
+    if txt is not None:
+        # skip first line? hack to get rid of # Title of the note
+        txt = ''.join(txt.splitlines(True)[1:])
+        # remove table of content for this included note
+        txt = txt.replace('{{TOC}}', '')
+        txt = txt.replace('[tableofcontent]', '')
+        return [''] + txt.split('\n')
+    else:
+        ctx.head.append('@error The file can not be found: ' + l)  # at this info at the beginning of the file
+        return []
+
+
+def include_md_files(md, deps=None):
     """Whenever you see /<file.md> include content of this file in here.
 
     Args:
 
        md (str): context of a md file
+       deps (list): if given, full paths of included files are appended here
 
     Returns:
 
        str: new md (nmd)
 
     """
-    nmd = ''
-    for l in md.split('\n'):
-        if l.startswith('/') and l.endswith('.md') and l.count('/') == 1:  # /shell.md
-            ffullpath = PATH_TO_MD + os.sep + l.replace('/', '').strip()
-            # check if exists
-            if os.path.isfile(ffullpath):
-                with codecs.open(ffullpath, "r", "utf-8") as f:
-                    next(f)  # skip first line? hack to get rid of # Title of the note
-                    txt = f.read()
-                    # remove table of content for this included note
-                    txt = txt.replace('{{TOC}}', '')
-                    txt = txt.replace('[tableofcontent]', '')
-                    nmd += '\n' + txt + '\n'
-            else:
-                nmd = '@error The file can not be found: ' + l + '\n' + nmd  # at this info at the beginning of the file
-        else:
-            nmd += l + '\n'
-    return nmd
-
-
-def include_file(text):
-    ntext = ''
-
-    for l in text.split('\n'):
-        if l.strip().startswith('[if:'):
-            file_fn = l.replace('[if:', '').replace(']', '').strip()
-            ntext += '<kbd> Imported file: %s </kbd>\n' % file_fn
-            try:
-                with codecs.open(file_fn, "r", "utf-8") as f:
-                    ntext += f.read()
-            except IOError:
-                logger.info('include file -- file not found -- %s', file_fn)
-            else:
-                logger.info('include file detected: %s', file_fn)
-        ntext += l + '\n'
-    return ntext
+    return Preprocessor([include_md_file_in_line]).process(md, Context(deps))
+
+
+@rule(lambda l: '[if:' in l)
+def include_file_in_line(l, ctx):
+    """Whenever you see [if:<file>] include content of this file in here."""
+    if not l.strip().startswith('[if:'):
+        return l
+    file_fn = l.replace('[if:', '').replace(']', '').strip()
+    ctx.deps.append(os.path.abspath(file_fn))
+    ntext = '<kbd> Imported file: %s </kbd>\n' % file_fn
+    txt = read_included_file(file_fn)
+    if txt is None:
+        logger.info('include file -- file not found -- %s', file_fn)
+    else:
+        ntext += txt
+        logger.info('include file detected: %s', file_fn)
+    return (ntext + l).split('\n')
+
+
+def include_file(text, deps=None):
+    """Whenever you see [if:<file>] include content of this file in here.
+
+    If deps (list) is given, full paths of included files are appended there."""
+    return Preprocessor([include_file_in_line]).process(text, Context(deps))
 
 
 # main
@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Search index - an inverted index of sections of notes (Headers, see searcher.py).
+
+Text of a section (its header and note) is split into tokens (words, @tags), for every token
+the index keeps a postings list: sections with the token and positions of it in them. To
+search we only look at the postings lists of the words of the query, not at all the text,
+and rank the sections with BM25.
+
+Queries::
+
+    rna structure       sections with both words (in any place)
+    "secondary struct"  a phrase, words next to each other
+    struct*             words starting with struct (structure, structural...)
+    @todo               tags are words too
+
+There are three kinds of indexes, all searched the same way (Searcher):
+
+- SearchIndex - in memory, sections are added one by one,
+- IndexFile - a file written by write_index and opened with mmap, only the parts needed for a
+  query are read (the file format is below),
+- Segments - an IndexFile with sections of some notes removed and a SearchIndex with new
+  sections of these notes, so the file does not have to be written again after every change.
+
+The file (all numbers little-endian)::
+
+    header     'GBSI', version, generation, number of sections, notes and tokens,
+               average length of sections, offsets of the tables below
+    notes      note (offset, length in strings), first section, number of sections;
+               sorted by note, sections of a note are next to each other
+    sections   note, name (offset, length), text (offset, length), level; the text of
+               a section is a piece of the text of its note
+    norms      float32 for every section (BM25 length normalization)
+    tokens     token (offset, length in strings), number of sections, offsets of sections
+               and of positions in postings; sorted by utf-8 of tokens
+    postings   for every token: varints of (section - previous section, number of positions),
+               then varints of positions (position - previous position) section by section
+    strings    utf-8 of notes (names and the whole text of every note, once), names of
+               sections and tokens
+"""
+import os
+import re
+import math
+import mmap
+import heapq
+import array
+import struct
+import bisect
+
+TOKEN = re.compile(r'@?\w+', re.U)
+QUERY = re.compile(r'"([^"]*)"|(\S+)', re.U)
+
+# BM25
+K1 = 1.2
+B = 0.75
+
+# max number of words a prefix is expanded to
+MAX_PREFIX_TERMS = 10000
+
+MAGIC = b'GBSI'
+VERSION = 1
+HEAD = struct.Struct('<4sIIIIIdQQQQQQ')
+NOTE = struct.Struct('<IIII')
+DOC = struct.Struct('<IIIIII')
+TERM = struct.Struct('<IIIII')
+
+
+class IndexFormatError(Exception):
+    pass
+
+
+def tokenize(text):
+    """Get a list of lower-cased tokens of text, e.g. ['@todo', 'rna', 'structure']."""
+    return [t.lower() for t in TOKEN.findall(text)]
+
+
+def get_tokens(header):
+    """Get tokens of a section (Header), its name and note."""
+    return tokenize(header.name + ' ' + header.note)
+
+
+def parse_query(query):
+    """Get a list of clauses of a query, a clause is (kind, tokens), kind is 'term', 'phrase'
+    or 'prefix'. A word split by the tokenizer (e.g. rna-puzzles) is a phrase."""
+    clauses = []
+    for phrase, word in QUERY.findall(query):
+        if phrase:
+            tokens = tokenize(phrase)
+            if tokens:
+                clauses.append(('phrase' if len(tokens) > 1 else 'term', tokens))
+            continue
+        prefix = word.endswith('*')
+        tokens = tokenize(word)
+        if not tokens:
+            continue
+        if prefix and len(tokens) == 1:
+            clauses.append(('prefix', tokens))
+        elif len(tokens) > 1:
+            clauses.append(('phrase', tokens))
+        else:
+            clauses.append(('term', tokens))
+    return clauses
+
+
+def get_norm(length, avgdl):
+    """Get K1 * (1 - B + B * length / average length)."""
+    return K1 * (1 - B + B * length / (avgdl or 1.0))
+
+
+def varints(values):
+    """Encode non-negative ints, 7 bits per byte, the highest bit set if more bytes follow."""
+    out = bytearray()
+    for v in values:
+        while v > 127:
+            out.append(v & 127 | 128)
+            v >>= 7
+        out.append(v)
+    return out
+
+
+def read_varints(data):
+    """Decode bytes of varints to a list of ints."""
+    data = bytearray(data)
+    if not data or max(data) < 128:  # all numbers < 128, usually positions and small gaps
+        return list(data)
+    values = []
+    value = shift = 0
+    for b in data:
+        if b < 128:
+            values.append(value | b << shift)
+            value = shift = 0
+        else:
+            value |= (b & 127) << shift
+            shift += 7
+    return values
+
+
+class Searcher(object):
+    """Searcher - queries (BM25), for any index that gives:
+
+      count - number of sections
+      df(token) - number of sections with the token
+      get_tfs(token) - list of (doc id, number of positions), sorted by doc id
+      get_positions(token, docs) - dict doc id -> positions, for docs (a set) or all docs
+      get_terms(prefix) - tokens that start with prefix
+      get_norms() - length normalization of every doc, see get_norm
+      get_doc(doc) - Header
+    """
+    count = 0
+
+    def prepare(self):
+        """Compute now what queries compute when they need it (e.g. norms), e.g. before
+        the index is shared by threads."""
+        self.get_norms()
+
+    def idf(self, token):
+        n = self.count
+        df = self.df(token)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def _score_term(self, token):
+        """Get doc -> score for one token."""
+        norms = self.get_norms()
+        idf = self.idf(token) * (K1 + 1)
+        scores = {}
+        for doc, tf in self.get_tfs(token):
+            scores[doc] = idf * tf / (tf + norms[doc])
+        return scores
+
+    def _score_phrase(self, tokens):
+        """Get doc -> score for docs with tokens next to each other."""
+        tfs = [self.get_tfs(t) for t in tokens]
+        if not all(tfs):
+            return {}
+        # positions are needed only for docs with all the tokens
+        docs = set(doc for doc, tf in min(tfs, key=len))
+        for l in tfs:
+            docs.intersection_update([doc for doc, tf in l])
+        if not docs:
+            return {}
+        lists = [self.get_positions(t, docs) for t in tokens]
+        scores = {}
+        norms = self.get_norms()
+        idf = sum(self.idf(t) for t in tokens) * (K1 + 1)
+        for doc in docs:
+            starts = set(lists[0][doc])
+            for i, l in enumerate(lists[1:], 1):
+                starts.intersection_update(p - i for p in l[doc])
+                if not starts:
+                    break
+            if starts:
+                tf = len(starts)
+                scores[doc] = idf * tf / (tf + norms[doc])
+        return scores
+
+    def _score_prefix(self, prefix):
+        scores = {}
+        for token in self.get_terms(prefix):
+            for doc, score in self._score_term(token).items():
+                scores[doc] = scores.get(doc, 0) + score
+        return scores
+
+    def _match(self, query):
+        """Get doc -> score of docs that match all clauses of the query."""
+        clauses = parse_query(query)
+        if not clauses or not self.count:
+            return {}
+        results = []
+        for kind, tokens in clauses:
+            if kind == 'term':
+                results.append(self._score_term(tokens[0]))
+            elif kind == 'phrase':
+                results.append(self._score_phrase(tokens))
+            else:
+                results.append(self._score_prefix(tokens[0]))
+            if not results[-1]:
+                return {}
+        # the rarest clause first, so the dict of docs gets small fast
+        results.sort(key=len)
+        scores = results[0]
+        for r in results[1:]:
+            scores = dict((doc, score + r[doc]) for doc, score in scores.items() if doc in r)
+        return scores
+
+    def search(self, query, limit=None):
+        """Get a list of (score, Header) of sections that match all clauses of the query,
+        the best first."""
+        scores = self._match(query)
+        key = lambda doc: (-scores[doc], doc)
+        if limit is None:
+            docs = sorted(scores, key=key)
+        else:
+            docs = heapq.nsmallest(limit, scores, key=key)
+        return [(scores[doc], self.get_doc(doc)) for doc in docs]
+
+    def search_page(self, query, start=0, length=20):
+        """Get (number of hits, list of (score, Header) of hits from start to start + length),
+        the best first. Only Headers of the page are made."""
+        scores = self._match(query)
+        docs = heapq.nsmallest(start + length, scores, key=lambda doc: (-scores[doc], doc))
+        return len(scores), [(scores[doc], self.get_doc(doc)) for doc in docs[start:]]
+
+
+class SearchIndex(Searcher):
+    """SearchIndex class, in memory
+
+    Attributes:
+
+      docs - list of sections (Headers), a doc id is the position on this list
+      lengths - number of tokens of every doc
+      postings - token -> list of (doc id, tuple of positions), sorted by doc id
+      count - number of docs
+      avgdl - average length of docs for BM25, by default of the docs of this index
+
+    Usage::
+
+        index = SearchIndex()
+        for h in headers:
+            index.add(h)
+        for score, h in index.search('"rna structure" @todo'):
+            print(score, h.name)
+    """
+
+    def __init__(self, avgdl=None):
+        self.docs = []
+        self.lengths = []
+        self.postings = {}
+        self.count = 0
+        self.total_length = 0
+        self.avgdl = avgdl
+        self._terms = None  # sorted tokens, for prefix queries
+        self._norms = None  # length normalization of BM25 of every doc
+
+    def add(self, header):
+        """Add a section, its header and note are searched. Returns the doc id."""
+        doc = len(self.docs)
+        tokens = get_tokens(header)
+        positions = {}
+        for i, t in enumerate(tokens):
+            positions.setdefault(t, []).append(i)
+        for t, pos in positions.items():
+            self.postings.setdefault(t, []).append((doc, tuple(pos)))
+        self.docs.append(header)
+        self.lengths.append(len(tokens))
+        self.count += 1
+        self.total_length += len(tokens)
+        self._terms = None
+        self._norms = None
+        return doc
+
+    def df(self, token):
+        return len(self.postings.get(token, ()))
+
+    def get_tfs(self, token):
+        return [(doc, len(pos)) for doc, pos in self.postings.get(token, ())]
+
+    def get_positions(self, token, docs=None):
+        postings = self.postings.get(token, ())
+        if docs is None:
+            return dict(postings)
+        return dict(p for p in postings if p[0] in docs)
+
+    def get_terms(self, prefix):
+        """Get tokens that start with prefix."""
+        if self._terms is None:
+            self._terms = sorted(self.postings)
+        i = bisect.bisect_left(self._terms, prefix)
+        terms = []
+        while i < len(self._terms) and self._terms[i].startswith(prefix):
+            terms.append(self._terms[i])
+            if len(terms) == MAX_PREFIX_TERMS:
+                break
+            i += 1
+        return terms
+
+    def prepare(self):
+        self.get_terms('')
+        self.get_norms()
+
+    def get_avgdl(self):
+        if self.avgdl is not None:
+            return self.avgdl
+        return float(self.total_length) / self.count if self.count else 1.0
+
+    def get_norms(self):
+        if self._norms is None:
+            avgdl = self.get_avgdl()
+            self._norms = [get_norm(l, avgdl) for l in self.lengths]
+        return self._norms
+
+    def get_doc(self, doc):
+        return self.docs[doc]
+
+
+def write_index(path, notes, generation=0):
+    """Write an IndexFile.
+
+    Args:
+
+       path (str): the file, it's written to path.tmp and renamed, so processes that have
+                   the old file opened can still use it
+       notes: list of (md, list of Headers), sorted by md
+       generation (int): saved in the file, e.g. the generation of the search db it's made of
+    """
+    index = SearchIndex()
+    strings = bytearray()
+    offsets = {}
+
+    def add_string(text):
+        data = text.encode('utf-8')
+        if data not in offsets:  # the same note, token... only once
+            offsets[data] = len(strings)
+            strings.extend(data)
+        return offsets[data], len(data)
+
+    texts = {}  # id of the text of a note -> its offset in strings
+
+    notes_table = bytearray()
+    docs_table = bytearray()
+    for i, (md, headers) in enumerate(notes):
+        notes_table.extend(NOTE.pack(*add_string(md) + (len(index.docs), len(headers))))
+        for h in headers:
+            index.add(h)
+            if id(h.text) not in texts:  # Headers of a note share its text, it's written once
+                texts[id(h.text)] = len(strings)
+                strings.extend(h.text)
+            docs_table.extend(DOC.pack(*(i,) + add_string(h.name) +
+                                       (texts[id(h.text)] + h.start, h.end - h.start, h.level)))
+    norms = bytearray(array.array('f', index.get_norms()).tostring())
+
+    terms_table = bytearray()
+    postings = bytearray()
+    tokens = sorted(index.postings, key=lambda t: t.encode('utf-8'))
+    for token in tokens:
+        docs = []
+        positions = []
+        previous = 0
+        for doc, pos in index.postings[token]:
+            docs.extend((doc - previous, len(pos)))
+            previous = doc
+            p = 0
+            for q in pos:
+                positions.append(q - p)
+                p = q
+        start = len(postings)
+        postings.extend(varints(docs))
+        middle = len(postings)
+        postings.extend(varints(positions))
+        terms_table.extend(TERM.pack(*add_string(token) + (len(index.postings[token]),
+                                                           start, middle)))
+
+    tables = [notes_table, docs_table, norms, terms_table, postings, strings]
+    offsets = []
+    offset = HEAD.size
+    for table in tables:
+        offsets.append(offset)
+        offset += len(table)
+    head = HEAD.pack(*[MAGIC, VERSION, generation, len(index.docs), len(notes_table) // NOTE.size,
+                       len(tokens), index.get_avgdl()] + offsets)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(head)
+        for table in tables:
+            f.write(table)
+    os.rename(tmp, path)
+
+
+class IndexFile(Searcher):
+    """IndexFile - an index written by write_index, opened with mmap.
+
+    Opening is the same fast for any number of notes, only the header is read. A query reads
+    the postings lists of its tokens and sections it returns (and norms of all sections,
+    once, 4 bytes per section).
+
+    Raises IndexFormatError if the file is not an index or of another version.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise IndexFormatError('%s is empty' % path)
+        if len(self.mm) < HEAD.size:
+            raise IndexFormatError('%s is not a search index' % path)
+        (magic, version, self.generation, self.count, self.n_notes, self.n_terms, self.avgdl,
+         self._notes, self._docs, self._norms_offset, self._terms, self._postings,
+         self._strings) = HEAD.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise IndexFormatError('%s is not a search index' % path)
+        if version != VERSION:
+            raise IndexFormatError('%s is of version %i, not %i' % (path, version, VERSION))
+        self.path = path
+        self._norms = None
+
+    def close(self):
+        self.mm.close()
+
+    def _get_string(self, offset, length):
+        start = self._strings + offset
+        return self.mm[start:start + length]
+
+    def _get_token(self, i):
+        offset, length = TERM.unpack_from(self.mm, self._terms + i * TERM.size)[:2]
+        return self._get_string(offset, length)
+
+    def _bisect(self, token):
+        """Get the position of the first token >= token (utf-8)."""
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_token(mid) < token:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, token):
+        """Get (df, start of sections, start of positions, end) of a token or None."""
+        token = token.encode('utf-8')
+        i = self._bisect(token)
+        if i == self.n_terms or self._get_token(i) != token:
+            return None
+        df, start, middle = TERM.unpack_from(self.mm, self._terms + i * TERM.size)[2:]
+        if i + 1 < self.n_terms:
+            end = self._postings + TERM.unpack_from(self.mm, self._terms + (i + 1) * TERM.size)[3]
+        else:
+            end = self._strings
+        return df, self._postings + start, self._postings + middle, end
+
+    def df(self, token):
+        found = self._find(token)
+        return found[0] if found else 0
+
+    def _get_tfs(self, found):
+        values = read_varints(self.mm[found[1]:found[2]])
+        tfs = []
+        doc = 0
+        for i in range(0, len(values), 2):
+            doc += values[i]
+            tfs.append((doc, values[i + 1]))
+        return tfs
+
+    def get_tfs(self, token):
+        found = self._find(token)
+        return self._get_tfs(found) if found else []
+
+    def get_positions(self, token, docs=None):
+        found = self._find(token)
+        if not found:
+            return {}
+        values = read_varints(self.mm[found[2]:found[3]])
+        positions = {}
+        i = 0
+        for doc, tf in self._get_tfs(found):
+            if docs is None or doc in docs:
+                pos = []
+                p = 0
+                for delta in values[i:i + tf]:
+                    p += delta
+                    pos.append(p)
+                positions[doc] = pos
+            i += tf
+        return positions
+
+    def get_terms(self, prefix):
+        prefix = prefix.encode('utf-8')
+        terms = []
+        i = self._bisect(prefix)
+        while i < self.n_terms and len(terms) < MAX_PREFIX_TERMS:
+            token = self._get_token(i)
+            if not token.startswith(prefix):
+                break
+            terms.append(token.decode('utf-8'))
+            i += 1
+        return terms
+
+    def get_norms(self):
+        if self._norms is None:
+            self._norms = array.array('f', self.mm[self._norms_offset:self._terms])
+        return self._norms
+
+    def get_note(self, md):
+        """Get (first doc, number of docs) of a note or None."""
+        md = md.encode('utf-8')
+        lo, hi = 0, self.n_notes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, first, n = NOTE.unpack_from(self.mm, self._notes + mid * NOTE.size)
+            name = self._get_string(offset, length)
+            if name == md:
+                return first, n
+            if name < md:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def get_doc(self, doc):
+        """Get a Header, its note is not a copy, it's read from the mmap when it's used."""
+        from engine.searcher import Header
+        note, name, name_length, text, text_length, level = DOC.unpack_from(
+            self.mm, self._docs + doc * DOC.size)
+        md = self._get_string(*NOTE.unpack_from(self.mm, self._notes + note * NOTE.size)[:2])
+        h = Header(self._get_string(name, name_length).decode('utf-8'), level,
+                   md.decode('utf-8'))
+        start = self._strings + text
+        h.add_note(self.mm, start, start + text_length)
+        return h
+
+
+class Segments(Searcher):
+    """Segments - an IndexFile (base) without some sections (deleted doc ids) and
+    a SearchIndex with new sections (delta), searched as one index. Doc ids of the delta
+    come after doc ids of the base.
+
+    Make the delta with SearchIndex(avgdl=base.avgdl), so lengths of all sections are
+    normalized the same way. The number of sections with a token counts also deleted
+    sections, until the base is written again.
+    """
+
+    def __init__(self, base, delta, deleted=()):
+        self.base = base
+        self.delta = delta
+        self.deleted = set(deleted)
+        self.offset = base.count if base else 0
+        self.count = self.offset - len(self.deleted) + delta.count
+        self._norms = None
+
+    def df(self, token):
+        return (self.base.df(token) if self.base else 0) + self.delta.df(token)
+
+    def get_tfs(self, token):
+        tfs = []
+        if self.base:
+            tfs = self.base.get_tfs(token)
+            if self.deleted:
+                tfs = [t for t in tfs if t[0] not in self.deleted]
+        return tfs + [(self.offset + doc, tf) for doc, tf in self.delta.get_tfs(token)]
+
+    def get_positions(self, token, docs=None):
+        positions = {}
+        if self.base:
+            positions = self.base.get_positions(token, docs)
+            for doc in self.deleted.intersection(positions):
+                del positions[doc]
+        delta_docs = None
+        if docs is not None:
+            delta_docs = set(doc - self.offset for doc in docs if doc >= self.offset)
+        for doc, pos in self.delta.get_positions(token, delta_docs).items():
+            positions[self.offset + doc] = pos
+        return positions
+
+    def get_terms(self, prefix):
+        terms = set(self.delta.get_terms(prefix))
+        if self.base:
+            terms.update(self.base.get_terms(prefix))
+        return sorted(terms)[:MAX_PREFIX_TERMS]
+
+    def get_norms(self):
+        if self._norms is None:
+            norms = array.array('f', self.base.get_norms() if self.base else [])
+            norms.extend(array.array('f', self.delta.get_norms()))
+            self._norms = norms
+        return self._norms
+
+    def prepare(self):
+        self.delta.prepare()
+        self.get_norms()
+
+    def get_doc(self, doc):
+        if doc < self.offset:
+            return self.base.get_doc(doc)
+        return self.delta.get_doc(doc - self.offset)
+
+
+# main
+if __name__ == '__main__':
+    import sys
+    print(parse_query(' '.join(sys.argv[1:]) or u'"rna structure" struct* @todo rna-puzzles'))
@@ -3,40 +3,38 @@
 
 """
 
-@todo
- - h3 and h4 are not search??? (i think)
- - dont replace ## because it breaks '## @tag ## text'
- - if md has no # at start you get error! and if you have # and then ### !!!
-
-####################################################################################################
-/home/magnus/Dropbox/lb_v2/md/RNApuzzle05.md
-Traceback (most recent call last):
-  File "make-everything-in-one-line.py", line 157, in <module>
-    main()
-  File "make-everything-in-one-line.py", line 140, in main
-    all_headers.extend(make_headers_objects_for_md(o))
-  File "make-everything-in-one-line.py", line 85, in make_headers_objects_for_md
-    current_h1.add_child(current_h2)
-UnboundLocalError: local variable 'current_h1' referenced before assignment
-
 Marcin Magnus
 init: 2012/10/05
 huge improv: 2012/11/08
 """
 import re
 import os
-import codecs
-import pickle
+import cgi
+import time
+import threading
 
 import os
 import sys
 PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 print(PATH)
 sys.path.append(PATH)
-from engine.conf import PATH_TO_HTML, PATH_TO_TEMPLATE_HTML, PATH_TO_MD
+from engine.conf import PATH_TO_HTML, PATH_TO_TEMPLATE_HTML, PATH_TO_MD, PATH_TO_MANIFEST, \
+    PATH_TO_SEARCH_INDEX, PATH_TO_COMPLETIONS
+from engine.search_index import SearchIndex, IndexFile, IndexFormatError, Segments, write_index, \
+    parse_query
+from engine.manifest import Manifest, ManifestError, get_manifest, get_manifest_stamp
+from engine.autocomplete import CompletionsFile, CompleterSegments, make_completer, \
+    write_completions, TOP_K
+
+import logging
+logger = logging.getLogger('geekbook')
 
 debug = False
 
+PAGE_SIZE = 20  # hits on a page of results
+MAX_PAGE_SIZE = 100
+SNIPPET_LENGTH = 200
+
 
 def hightlight_text_in_html(phrase, text):
     """
@@ -52,6 +50,39 @@ def hightlight_text_in_html(phrase, text):
     return text
 
 
+def get_words_re(query):
+    """Get a regex of words of the query (as the index sees them, prefix* is a prefix)."""
+    words = []
+    for kind, tokens in parse_query(query):
+        for t in tokens:
+            words.append(re.escape(t) + (r'\w*' if kind == 'prefix' else ''))
+    if not words:
+        return None
+    return re.compile(r'(?<![\w@])(' + '|'.join(words) + r')(?!\w)', re.I | re.U)
+
+
+def get_snippet(text, words_re, length=SNIPPET_LENGTH):
+    """Get html of a piece of text around the first word of the query, words are highlighted
+    with <mark>, the rest is escaped."""
+    text = re.sub(r'\s+', ' ', text).strip()
+    m = words_re.search(text) if words_re else None
+    start = 0
+    if m and m.end() > length:
+        start = text.rfind(' ', 0, max(0, m.start() - length // 3)) + 1
+    end = start + length
+    if end < len(text):
+        end = max(text.rfind(' ', start, end), m.end() if m else 0) or end
+    snippet = text[start:end]
+    html = ''
+    last = 0
+    if words_re:
+        for m in words_re.finditer(snippet):
+            html += cgi.escape(snippet[last:m.start()]) + '<mark>' + cgi.escape(m.group()) + '</mark>'
+            last = m.end()
+    html += cgi.escape(snippet[last:])
+    return ('...' if start else '') + html + ('...' if end < len(text) else '')
+
+
 def lsdir(directory='/home/magnus/Desktop/', exclude_files_starting_with_dot=True, verbose=False):
     """
     magnus@maximus:~/workspace/myutil$ python test.py
@@ -65,7 +96,8 @@ def lsdir(directory='/home/magnus/Desktop/', exclude_files_starting_with_dot=Tru
     DO:
     - walk and collect a list of all files -> f
     RETURN:
-    - f = list of all files under given directory, [/home/magnus/Desktop/temp/beta.png, ... ,/home/magnus/Desktop/temp/temp~]
+    - f = list of all files under given directory,
+      [/home/magnus/Desktop/temp/beta.png, ... ,/home/magnus/Desktop/temp/temp~]
 
     http://snippets.dzone.com/posts/show/644
 
@@ -101,10 +133,16 @@ def lsdir(directory='/home/magnus/Desktop/', exclude_files_starting_with_dot=Tru
     return f
 
 
-class Header:
+class Header(object):
     """
     Header = # or ## or ### or ####
+
+    There can be hundreds of thousands of them, so a Header is small: it has no __dict__
+    (__slots__), and its note is not a copy, it's taken from the text of the whole note (the
+    same bytes for all Headers of a note, utf-8 as in the md file, or the mmap of the search
+    index) with start & end of the note in it, offsets in bytes.
     """
+    __slots__ = ('name', 'level', 'child', 'md', 'text', 'start', 'end')
 
     def __init__(self, name, level, md):
         """
@@ -115,29 +153,46 @@ class Header:
         """
 
         self.name = name
-        self.name_dashed = name.replace(' ', '-')
         self.level = level
-        self.child = []
-        self.note = ''
+        self.child = None
         self.md = md
+        self.text = b''
+        self.start = 0
+        self.end = 0
+
+    @property
+    def name_dashed(self):
+        return self.name.replace(' ', '-')
+
+    @property
+    def note(self):
+        return self.text[self.start:self.end].decode('utf-8', 'replace')
 
     def add_child(self, header_obj):
+        if self.child is None:
+            self.child = []
         self.child.append(header_obj)
 
     def get_child(self):
-        return self.child
+        return self.child or []
 
     def get_note(self):
         return self.note
 
     def has_note(self):
-        if self.note:
+        if self.end > self.start:
             return True
         else:
             return False
 
-    def add_note(self, note):
-        self.note = note
+    def add_note(self, note, start=0, end=None):
+        """Set the note, it's note[start:end] (bytes, offsets in bytes), note can be the text
+        of the whole md file. Unicode is encoded with utf-8."""
+        if isinstance(note, unicode):
+            note = note.encode('utf-8')
+        self.text = note
+        self.start = start
+        self.end = len(note) if end is None else end
 
     def get_format(self, term):
         out = ''
@@ -145,7 +200,8 @@ class Header:
             self.md + '.html#' + self.name_dashed + '">' + self.name + '</a></h1>\n'
         out += '<small style="color: #009933;">' + '<a href="/view/' + self.md + \
             '.html#' + self.name_dashed + '">' + self.md + '</a>' + '</small>\n'
-        #        out += '<p>...' + myutilspy.hightlight_text_in_html(term, self.note).replace('\n','<br/>') + '...<p>\n'
+        #        out += '<p>...' + myutilspy.hightlight_text_in_html(term, self.note) \
+        #            .replace('\n','<br/>') + '...<p>\n'
         out += '<pre>' + hightlight_text_in_html(term,
                                                  self.note).replace('\n', '<br/>') + '</pre>\n'
         out += '<div style="width:100%" class="hrDotted"></div>'
@@ -155,142 +211,328 @@ class Header:
         return 'h' + str(self.level) + ': ' + self.name
 
 
-def next_lines_has_header_or_end_of_file(lines, no_lines, c, v=0):
-    """
-    Return True when the end of the files occurs or a next line starts with '#'
-    Return False if a next line starts with anything different than '#'.
-    If a next line is empty then just skip the line and get a next next line to analyse.
-    """
-    if c == no_lines:
-        return True
-    elif lines[c].startswith('#'):
-        return True
-    else:
-        return False
-
-
 def replace_space_with_minus(text):
     replace = text.replace(' ', '-')
     return replace
 
 
-def make_headers_objects_for_md(filename, verbose=False, version2=True):
+HEADER_RE = re.compile(r'^(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$')
+FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+
+
+def make_headers(text, md):
+    """Get Headers of all sections of a note (of any level, # to ######), in order.
+
+    One pass over lines: a header is a line of 1-6 # and a space (or only #), its note is
+    the text up to the next header. Headers are put in a tree with a stack of open headers,
+    a header is a child of the last one of a lower level, so a note can start with ## or have
+    # and then ### (then ### is a child of #, and a header with no parent is in the root).
+    Lines in fenced code (``` or ~~~) are never headers. The text before the first header is
+    not in any section.
+
+    text is the content of the md file (bytes, unicode is encoded with utf-8), start & end of
+    notes are offsets in bytes of it, so a note can be cut out of the file (or of the search
+    index) without decoding the whole note.
     """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    headers = []
+    stack = []  # open headers, of growing levels
+    fence = None  # ``` or ~~~ (or longer) of the code block we are in
+    last_h = None
+    start = 0  # where the line starts in the text
+    for l in text.split(b'\n'):
+        end = start + len(l) + 1  # with \n
+        line = l.rstrip(b'\r').decode('utf-8', 'replace')
+        m = FENCE_RE.match(line)
+        if fence:
+            if m and m.group(1)[0] == fence[0] and len(m.group(1)) >= len(fence) \
+                   and not line[m.end():].strip():
+                fence = None
+        elif m:
+            fence = m.group(1)
+        else:
+            m = HEADER_RE.match(line)
+            if m:
+                if last_h:
+                    last_h.add_note(text, last_h.start, start)
+                h = Header(m.group(2) or u'', len(m.group(1)), md)
+                while stack and stack[-1].level >= h.level:
+                    stack.pop()
+                if stack:
+                    stack[-1].add_child(h)
+                stack.append(h)
+                headers.append(h)
+                h.start = min(end, len(text))  # the note starts after the header
+                last_h = h
+        start = end
+    if last_h:
+        last_h.add_note(text, last_h.start, len(text))
+    return headers
+
+
+def make_headers_objects_for_md(filename, verbose=False, version2=True):
+    """Get Headers of all sections of a note, see make_headers.
+
     filename = '/home/magnus/Dropbox/lb_v2/md/bioinfo::threading.md'
     """
-    text = codecs.open(filename, mode="r", encoding="utf8").read()
+    with open(filename, 'rb') as f:
+        text = f.read()
     md = filename.replace(PATH_TO_MD, '')
     # replace only .md at the very end    #.replace('.md','') ## md = bioinfo::threading
     md = re.sub('.md$', '', md)
-    root = []  # starting point of the structure
-    lines = text.split('\n')
-    no_lines = len(lines)
-    list_h = ''
-    note = ''
-    c = 0
-    for l in lines:
-        c += 1
-        if l.startswith('# '):
-            l = l.replace('# ', '')
-            current_h1 = Header(l, 1, md)
-            root.append(current_h1)
-            last_h = current_h1
-        elif l.startswith('## '):
-            l = l.replace('## ', '')
-            current_h2 = Header(l, 2, md)
-            try:
-                current_h1.add_child(current_h2)
-            except UnboundLocalError:
-                raise Exception("""Exception: Error: This is stupid, sorry for this. But to get searcher running
-you have to have headers structured in a way that first you have # (H1 header) and then ## etc. You can not
-start your note with ##. Moreover, you can not have # and then ###. You have to keep #, and ##, and ### etc. It should
-be fixed at some point. The problem is in the file: %s""" % filename)
-            last_h = current_h2
-        elif l.startswith('### '):
-            l = l.replace('### ', '')
-            current_h3 = Header(l, 3, md)
-            try:
-                current_h2.add_child(current_h3)  # if not current2 then current1
-            except UnboundLocalError:
-                raise Exception(filename)
-
-            last_h = current_h3
-        elif l.startswith('#### '):
-            l = l.replace('#### ', '')
-            current_h4 = Header(l, 4, md)
-            try:
-                current_h3.add_child(current_h4)
-            except UnboundLocalError:
-                raise Exception(filename)
-            last_h = current_h4
-        else:
-            note += ' ' + l + '\n'  # \n = not in one line!
-            if next_lines_has_header_or_end_of_file(lines, no_lines, c):
-                try:
-                    last_h.add_note(note)
-                except NameError:
-                    pass
-                note = ''  # reset the note variable
+    headers = make_headers(text, md)
     if verbose:
-        print('root has following headers of # type: '.ljust(40), root)
-    #tb = PrettyTable(["r.name", "r.note", "r.level", "r.get_child()", "h3"])
-    for r in root:
-        row = [r.name, r.note[:50], r.level, r.get_child(), [x.get_child() for x in r.get_child()]]
-        if verbose:
-            print(row)
-        # tb.add_row(row)
-    # collect all h1
-    all_h = []
-    for r in root:
-        all_h.append(r)
-        for c in r.get_child():
-            all_h.append(c)
-            for a in c.get_child():
-                all_h.append(a)
-    return all_h
+        for h in headers:
+            print(' ' * (h.level - 1) + repr(h), h.start, h.end, h.get_child())
+    return headers
 
 
-class Db():
+def is_searched(i):
+    """Check if a note (full path) is searched, skip e.g. '/home/magnus/Dropbox/lb_v2/md/.#bash.md'"""
+    ## hack ##
+    if i.find('#') > -1 or i.find('~') > -1 or i.find('.org') > -1 or i.find('.git') > -1:
+        return False
+    return i.endswith('.md')
+
+
+def get_notes():
+    """Get full paths of all notes to search in."""
+    return [i for i in lsdir(PATH_TO_MD) if is_searched(i)]
+
+
+def get_md(filename):
+    """Get the name of a note as used in Headers, e.g. test for .../notes/test.md"""
+    return re.sub('.md$', '', filename.replace(PATH_TO_MD, ''))
+
+
+def read_note(md):
+    """Get (os.stat, content as bytes) of a note, (None, None) if it's gone."""
+    try:
+        with open(PATH_TO_MD + md + '.md', 'rb') as f:
+            return os.fstat(f.fileno()), f.read()
+    except (IOError, OSError):
+        return None, None
+
+
+def read_headers(manifest, mds=None):
+    """Get Headers of notes (from mds, all by default) from sections in the manifest.
+
+    Every note is read once, its Headers are offsets in the same bytes. A note changed since
+    it was parsed (mtime or size) is parsed again, make_db saves it soon.
+
+    Returns:
+
+       list: (md, list of Headers), in the order of the manifest
     """
+    stamps = manifest.get_search_notes(mds)
+    sections = []
+    for md, level, name, start, end in manifest.get_sections(mds):
+        if not sections or sections[-1][0] != md:
+            sections.append((md, []))
+        sections[-1][1].append((level, name, start, end))
+    notes = []
+    for md, rows in sections:
+        st, text = read_note(md)
+        if text is None:
+            continue  # it's gone, make_db will remove it
+        if stamps.get(md) != (st.st_mtime, st.st_size):
+            notes.append((md, make_headers(text, md)))
+            continue
+        headers = []
+        for level, name, start, end in rows:
+            h = Header(name, level, md)
+            h.add_note(text, start, end)
+            headers.append(h)
+        notes.append((md, headers))
+    return notes
+
+
+class Db():
+    """Db of all headers of all notes, searched with an inverted index (see search_index.py).
+
+    Sections are kept per note (in the manifest, see engine/manifest.py), so if a note is
+    changed only this note is parsed again and only its sections are replaced. For search,
+    all sections are written also to an index file (PATH_TO_SEARCH_INDEX) opened with mmap,
+    notes changed since the file was written are taken from the manifest. The file is written
+    again when there are more than MAX_DELTA_NOTES such notes. Completions for the search box
+    (see autocomplete.py) are written and loaded the same way, with the index file::
+
+        db = Db()
+        db.update()  # parse notes changed since the last time
+        db.load()  # open the index file
+        db.search('rna')
     """
+    MAX_DELTA_NOTES = 100
 
-    def __init__(self, ):
+    def __init__(self, path=PATH_TO_SEARCH_INDEX, completions_path=PATH_TO_COMPLETIONS):
         """
         """
-        self.all_headers = ''
-
-    def collect_data(self, v=0):
-        out = lsdir(PATH_TO_MD)
-        ## hack start ##
-        out2 = []
-        #'/home/magnus/Dropbox/lb_v2/md/.#bash.md'
-        for i in out:
-            if i.find('#') > -1 or i.find('~') > -1 or i.find('.org') > -1 or i.find('.git') > -1:
-                pass
-            else:
-                if i.endswith('.md'):
-                    out2.append(i)
-        out = out2
-        ## hack end ##
-
-        all_headers = []
-        # print '<head><meta content="text/html; charset=UTF-8" http-equiv="content-type">'
-        # print "<link rel='stylesheet' href='/home/magnus/Dropbox/Public/lb/css/style.css' /></head>"
-        for o in out:
+        self.path = path
+        self.completions_path = completions_path
+        self.index = SearchIndex()
+        self.completer = make_completer([])
+        self.generation = None  # of the search db in the manifest, when loaded
+
+    def open_index(self):
+        """Open the index file and the completions file, (None, None) if there are no files
+        (or of an old version, or not written together)."""
+        base = completions = None
+        try:
+            base = IndexFile(self.path)
+            completions = CompletionsFile(self.completions_path)
+        except IOError:
+            pass
+        except IndexFormatError as e:
+            logger.info('searcher: %s' % e)
+        if completions is None or completions.generation != base.generation:
+            for f in base, completions:
+                if f:
+                    f.close()  # the mmap and the file
+            return None, None
+        return base, completions
+
+    def load(self, manifest=None):
+        """Load the index file and sections of notes changed since it was written."""
+        if manifest is None:
+            manifest = get_manifest()
+        for attempt in range(3):
+            self.generation = manifest.get_generation('search')
+            base, completions = self.open_index()
+            # the files could be written again after we opened them, then take the new ones
+            if (base.generation if base else 0) >= manifest.get_generation('search_base') \
+                    or attempt == 2:  # (or use the ones we have, if they're written all the time)
+                break
+            if base:
+                base.close()
+                completions.close()
+        if base:
+            changes = manifest.get_search_changes(base.generation)
+            mds = [md for md in changes if changes[md]]
+            delta = SearchIndex(avgdl=base.avgdl)
+        else:
+            changes = {}
+            mds = None
+            delta = SearchIndex()
+        notes = read_headers(manifest, mds)
+        for md, headers in notes:
+            for h in headers:
+                delta.add(h)
+        deleted = []
+        for md in changes:
+            docs = base.get_note(md)
+            if docs:
+                deleted.extend(range(docs[0], docs[0] + docs[1]))
+        self.index = Segments(base, delta, deleted)
+        # notes without sections are in the manifest, but not in its sections
+        parsed = set(md for md, headers in notes)
+        for md in manifest.get_search_notes() if mds is None else mds:
+            if md not in parsed:
+                notes.append((md, []))
+        self.completer = make_completer(notes)
+        if base:
+            self.completer = CompleterSegments(completions, self.completer, changes)
+
+    def update(self, manifest=None, force=False, v=0, changed=None, removed=None):
+        """Parse notes that are new or changed since the last time (mtime or size), or all
+        notes with force, remove notes that are gone, save sections of these notes in the
+        manifest. Write the index file if there are too many changes since it was written.
+
+        All notes are listed (and stat-ed) to find what's changed, unless you know it (e.g.
+        from the watcher, see geekbookapp.py): then give changed and removed (md of notes), and
+        only these notes are looked at.
+
+        Returns:
+
+           (list, list): md of changed notes, md of removed notes
+        """
+        if manifest is None:
+            manifest = get_manifest()
+        if changed is None and removed is None:
+            stamps = manifest.get_search_notes()
+            paths = get_notes()
+        else:
+            changed = list(changed or [])
+            stamps = manifest.get_search_notes(changed + list(removed or []))
+            paths = [PATH_TO_MD + md + '.md' for md in changed]
+            paths = [o for o in paths if is_searched(o)]
+        parsed = []
+        seen = set()
+        for o in paths:
+            md = get_md(o)
+            seen.add(md)
+            try:
+                st = os.stat(o)
+            except OSError:
+                continue
+            if not force and stamps.get(md) == (st.st_mtime, st.st_size):
+                continue
             if v:
                 print(o)
-            all_headers.extend(make_headers_objects_for_md(o))
-        self.all_headers = all_headers
+            st, text = read_note(md)  # the stamp of exactly what is parsed
+            if text is None:
+                continue
+            try:
+                headers = make_headers(text, md)
+            except Exception as e:
+                logger.error('searcher: %s' % e)
+                headers = []
+            parsed.append((md, st, headers))
+        if removed is None:
+            removed = [md for md in stamps if md not in seen]
+        else:
+            removed = [md for md in removed if md in stamps and md not in seen]
+        if parsed or removed:
+            generation = manifest.next_generation('search')
+            for md, st, headers in parsed:
+                manifest.update_sections(md, st.st_mtime, st.st_size,
+                                         [(h.level, h.name, h.start, h.end) for h in headers],
+                                         generation)
+            for md in removed:
+                manifest.remove_sections(md, generation)
+            manifest.commit()
+        base, completions = self.open_index()
+        if base:
+            outdated = len(manifest.get_search_changes(base.generation)) > self.MAX_DELTA_NOTES
+            base.close()
+            completions.close()
+        if force or not base or outdated:
+            self.write_index(manifest)
+        return [p[0] for p in parsed], removed
+
+    def write_index(self, manifest=None):
+        """Write the index file and the completions file with all sections from the
+        manifest."""
+        if manifest is None:
+            manifest = get_manifest()
+        t = time.time()
+        generation = manifest.get_generation('search')
+        notes = dict(read_headers(manifest))
+        for md in manifest.get_search_notes():
+            notes.setdefault(md, [])
+        notes = sorted(notes.items())
+        write_completions(self.completions_path, notes, generation)  # first, see open_index
+        write_index(self.path, notes, generation)
+        manifest.set_generation('search_base', generation)
+        manifest.purge_search_notes(generation)
+        manifest.commit()
+        logger.info('searcher: %s written in %.2f s' % (self.path, time.time() - t))
+
+    def collect_data(self, v=0):
+        """Parse all notes again."""
+        self.update(force=True, v=v)
+        self.load()
 
     def search(self, term):
-        hits_output = self._search_over_headers_objects(term, self.all_headers)
+        hits_output = self._search_over_headers_objects(term)
         return hits_output
 
     def _search_over_headers_objects(self, term, v=0):
-        hits = []
-        for h in self.all_headers:
-            if re.search(term, h.name + h.note, re.I):
-                hits.append(h)
+        """Search with the index, e.g. 'rna "secondary structure" struct* @todo', see
+        search_index.py. The best hits first."""
+        hits = [h for score, h in self.index.search(term)]
+        # highlight the words of the query, without quotes and *
+        term = term.replace('"', '').replace('*', '').strip()
         hits_output = ''
         for hit in hits:
             if v:
@@ -303,16 +545,145 @@ class Db():
                 print
         return hits_output
 
+    def query(self, q, page=1, size=PAGE_SIZE):
+        """Get a page of hits for /api/search and /search, the best first.
+
+        Returns:
 
-def make_db():
+           dict: q, page, size, total (number of hits), pages, hits (list of dicts of title,
+           note, level, url, score, snippet (html))
+        """
+        size = max(1, min(size, MAX_PAGE_SIZE))
+        page = max(1, page)
+        total, hits = self.index.search_page(q, (page - 1) * size, size)
+        words_re = get_words_re(q)
+        return {'q': q, 'page': page, 'size': size, 'total': total,
+                'pages': (total + size - 1) // size,
+                'hits': [{'title': h.name, 'note': h.md, 'level': h.level,
+                          'url': '/view/' + h.md + '.html#' + h.name_dashed,
+                          'score': round(score, 3),
+                          'snippet': get_snippet(h.note, words_re)} for score, h in hits]}
+
+
+def format_results(results):
+    """Get html of a page of hits (see Db.query), with links to other pages."""
+    out = '<p style="color: gray;">%i hits</p>\n' % results['total']
+    for hit in results['hits']:
+        out += '<h1 style="font-size:20px;color:black"><a href="' + hit['url'] + '">' + \
+            cgi.escape(hit['title']) + '</a></h1>\n'
+        out += '<small style="color: #009933;">' + '<a href="' + hit['url'] + '">' + \
+            cgi.escape(hit['note']) + '</a>' + '</small>\n'
+        out += '<p>' + hit['snippet'] + '</p>\n'
+        out += '<div style="width:100%" class="hrDotted"></div>'
+    links = []
+    if results['page'] > 1:
+        links.append('<a href="?page=%i">&laquo; previous</a>' % (results['page'] - 1))
+    if results['page'] < results['pages']:
+        links.append('<a href="?page=%i">next &raquo;</a>' % (results['page'] + 1))
+    if links:
+        out += '<p>page %i of %i %s</p>\n' % (results['page'], results['pages'], ' '.join(links))
+    return out
+
+
+class LiveDb(object):
+    """LiveDb - a Db kept in memory of a server (flask).
+
+    The Db has completions for the search box too (see autocomplete.py).
+
+    The Db is loaded again when the search db in the manifest is changed (by make_db in
+    geekbookapp.py): if the manifest file is changed (see engine.manifest.get_manifest_stamp),
+    we check the generation of the search db. A new Db is loaded in a thread, queries are
+    answered by the old one until the new one is ready, then it's swapped in (queries keep
+    the Db they started with).
+
+    Usage::
+
+        db = LiveDb()
+        db.search('rna')
+    """
+
+    def __init__(self, path=PATH_TO_MANIFEST):
+        self.path = path
+        self.db = None
+        self.completer = None
+        self.stamp = None
+        self.lock = threading.Lock()  # only one thread loads
+
+    def load(self, stamp):
+        try:
+            manifest = Manifest(self.path, readonly=True)
+        except ManifestError as e:  # nothing built yet, nothing to search in
+            logger.info('searcher: %s' % e)
+            if self.db is None:
+                self.db = Db()
+                self.completer = self.db.completer
+            self.stamp = stamp
+            return
+        try:
+            if self.db is None or manifest.get_generation('search') != self.db.generation:
+                t = time.time()
+                db = Db()
+                db.load(manifest)
+                db.index.prepare()
+                self.db, self.completer = db, db.completer
+                logger.info('searcher: loaded %i sections (generation %i), %i completions in %.3f s'
+                            % (db.index.count, db.generation, db.completer.count, time.time() - t))
+            self.stamp = stamp
+        finally:
+            manifest.close()
+
+    def _load_in_background(self, stamp):
+        try:
+            self.load(stamp)
+        except Exception:
+            logger.exception('searcher: loading failed')
+        finally:
+            self.lock.release()
+
+    def get(self):
+        """Get the Db, the newest one ready to use."""
+        stamp = get_manifest_stamp(self.path)
+        if stamp != self.stamp and self.lock.acquire(False):
+            if self.db is None:  # nothing to search in yet, wait
+                try:
+                    self.load(stamp)
+                finally:
+                    self.lock.release()
+            else:
+                t = threading.Thread(target=self._load_in_background, args=(stamp,))
+                t.daemon = True
+                t.start()
+        elif self.db is None:  # another thread loads the first Db
+            with self.lock:
+                pass
+        return self.db
+
+    def search(self, term):
+        return self.get().search(term)
+
+    def query(self, q, page=1, size=PAGE_SIZE):
+        return self.get().query(q, page, size)
+
+    def complete(self, prefix, k=TOP_K):
+        self.get()
+        return self.completer.complete(prefix, k)
+
+
+def make_db(changed=None, removed=None):
+    """Update the search db, only notes changed since the last time are parsed. Give changed
+    and removed notes (e.g. test.md) if you know them, then other notes are not even stat-ed."""
     db = Db()
     print('searcher::making the db')
-    db.collect_data()
-    pickle.dump(db, open(PATH + os.sep + "engine/searchdb.pickle", "wb"))
+    if changed is not None or removed is not None:
+        changed = [get_md(fn) for fn in changed or []]
+        removed = [get_md(fn) for fn in removed or []]
+    changed, removed = db.update(changed=changed, removed=removed)
+    logger.info('searcher: %i notes parsed, %i removed' % (len(changed), len(removed)))
 
 
 def search_term(term):
-    db = pickle.load(open(PATH + os.sep + "engine/searchdb.pickle", "rb"))
+    db = Db()
+    db.load()
     return db.search(term)
 
 
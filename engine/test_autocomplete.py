@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests of engine/autocomplete.py, python -m unittest engine.test_autocomplete"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from engine.searcher import make_headers
+from engine.autocomplete import Completer, CompletionsFile, CompleterSegments, \
+    make_completer, write_completions, MAX_K
+
+
+def make_note(md, seed):
+    random.seed(seed)
+    words = [u'rna', u'rnaseq', u'@todo', u'@rna', u'ab', u'abc', u'zażółć', u'b'] + \
+        [u'w%i' % i for i in range(300)]
+    lines = []
+    for s in range(random.randint(0, 6)):
+        lines.append(u'#' * random.randint(1, 3) + u' ' + u' '.join(random.sample(words, 2)))
+        lines.append(u' '.join(random.sample(words, 5)))
+    return md, make_headers(u'\n'.join(lines), md)
+
+
+class CompleterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_prefixes(self):
+        c = make_completer([make_note(u'rna', 0),
+                            (u'notes', make_headers(u'# RNA structure\n@todo\n## b\n@todo', u'notes')),
+                            (u'other', make_headers(u'# RNA structure\n', u'other'))])
+        texts = [x['text'] for x in c.complete(u'RNA S')]
+        self.assertEqual(texts, [u'RNA structure'])
+        x = c.complete(u'rna s')[0]
+        self.assertEqual((x['weight'], x['url']), (2, '/search/%22RNA%20structure%22'))
+        self.assertEqual(c.complete(u'b', 1)[0]['url'], u'/view/notes.html#b')
+        self.assertEqual(c.complete(u'@to')[0]['weight'], 2)  # sections with the tag
+        self.assertEqual(c.complete(u'xyz'), [])
+        self.assertEqual(c.complete(u'n')[0], {'text': u'notes', 'kind': 'note',
+                                               'url': u'/view/notes.html', 'weight': 3})
+
+    def test_url(self):
+        """Texts are quoted in urls, a header with ? # / % is one part of an url."""
+        text = u'# Why? #1 a/b 50% gęś\n@todo'
+        c = make_completer([(u'zażółć', make_headers(text, u'zażółć'))])
+        note = '/view/za%C5%BC%C3%B3%C5%82%C4%87.html'
+        self.assertEqual(c.complete(u'why')[0]['url'],
+                         note + '#Why%3F-%231-a%2Fb-50%25-g%C4%99%C5%9B')
+        self.assertEqual(c.complete(u'za')[0]['url'], note)
+        c = make_completer([(u'a', make_headers(u'# Why? #1\n', u'a')),
+                            (u'b', make_headers(u'# Why? #1\n', u'b'))])
+        self.assertEqual(c.complete(u'why')[0]['url'], '/search/%22Why%3F%20%231%22')
+
+    def test_file_and_segments(self):
+        """Completions of the file with changed notes taken away and added again are the same
+        as completions of all notes made at once."""
+        notes = [make_note(u'n%03i' % i, i) for i in range(200)]
+        path = os.path.join(self.path, 'complete.idx')
+        write_completions(path, notes, 7)
+        base = CompletionsFile(path)
+        self.assertEqual(base.generation, 7)
+        changed = dict([make_note(u'n%03i' % i, 1000 + i) for i in range(0, 200, 3)] +
+                       [make_note(u'new', 5)])
+        removed = [u'n%03i' % i for i in range(1, 200, 7) if i % 3]
+        now = dict(notes)
+        now.update(changed)
+        for md in removed:
+            del now[md]
+        full = make_completer(sorted(now.items()))
+        segments = CompleterSegments(base, make_completer(changed.items()),
+                                     list(changed) + removed)
+        prefixes = [u'', u'r', u'rn', u'rna', u'@', u'@t', u'a', u'ab', u'w1', u'w2', u'za', u'n0',
+                    u'zaż', u'b', u'x']
+        for prefix in prefixes:
+            for k in (1, 10, MAX_K):
+                self.assertEqual(self.get(full, prefix, k), self.get(segments, prefix, k),
+                                 (prefix, k))
+        self.assertEqual(self.get(base, u'r', MAX_K),
+                         self.get(make_completer(notes), u'r', MAX_K))
+        base.close()
+
+    def get(self, completer, prefix, k):
+        # a note and a header of the same text can be in any order
+        return sorted((-x['weight'], len(x['text']), x['text'], x['kind'], x['url'])
+                      for x in completer.complete(prefix, k))
+
+
+if __name__ == '__main__':
+    unittest.main()
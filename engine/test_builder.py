@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests of engine/builder.py, python -m unittest engine.test_builder
+
+Notes are compiled in a tmp folder (md, html and the manifest), not in engine/data.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from engine import page, preprocessing, postprocessing, manifest
+from engine.page import Page
+from engine.builder import build, compile_note
+from engine.manifest import Manifest, get_manifest
+
+# modules that keep paths of conf.py, to compile notes from another folder
+PATHS = [(page, 'PATH_TO_MD'), (page, 'PATH_TO_HTML'), (preprocessing, 'PATH_TO_MD'),
+         (postprocessing, 'PATH_TO_MD'), (postprocessing, 'PATH_TO_HTML'),
+         (manifest, 'PATH_TO_MD'), (manifest, 'PATH_TO_HTML')]
+
+
+class BuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        md = os.path.join(self.dir, 'md') + os.sep
+        html = os.path.join(self.dir, 'html') + os.sep
+        os.mkdir(md)
+        with open(md + 'test.md', 'w') as f:
+            f.write('# test\nA note, **compiled** in a test.\n\n## rna\n@todo\n')
+        self.saved = [getattr(module, name) for module, name in PATHS] + [manifest._manifest]
+        for module, name in PATHS:
+            setattr(module, name, md if name == 'PATH_TO_MD' else html)
+        manifest._manifest = Manifest(os.path.join(self.dir, 'manifest.sqlite'))
+
+    def tearDown(self):
+        manifest._manifest.close()
+        for (module, name), value in zip(PATHS, self.saved):
+            setattr(module, name, value)
+        manifest._manifest = self.saved[-1]
+        shutil.rmtree(self.dir)
+
+    def get_logged(self):
+        """Get notes compiled in the last generation of pages."""
+        m = get_manifest()
+        generation = m.get_generation('pages')
+        return [fn for g, fn in m.get_pages_log(generation - 1)]
+
+    def test_gone(self):
+        """A note removed before it's compiled fails, the other ones are compiled."""
+        failed = build(['test.md', 'gone.md'], jobs=2)
+        self.assertEqual(failed, [('gone.md', 'file removed')])
+        self.assertEqual(get_manifest().get('gone.md'), None)
+        self.assertEqual(self.get_logged(), ['test.md'])
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'html', 'test.html')))
+
+    def test_broken(self):
+        """An exception in a note is reported with its traceback, the manifest does not keep
+        the note as compiled and pages are not counted as written."""
+        m = get_manifest()
+        build(['test.md'])
+        generation = m.get_generation('pages')
+        compile = Page.compile
+
+        def broken(page):
+            raise ValueError('a broken note')
+        Page.compile = broken
+        try:
+            fn, st, md_hash, html_hash, deps, error = compile_note('test.md')
+            self.assertEqual((fn, st), ('test.md', None))
+            self.assertIn('ValueError: a broken note', error)
+            m.db.execute("UPDATE notes SET html_hash = 'old' WHERE fn = 'test.md'")
+            m.commit()
+            failed = build(['test.md'])
+        finally:
+            Page.compile = compile
+        self.assertEqual([fn for fn, error in failed], ['test.md'])
+        self.assertEqual(m.get('test.md')['html_hash'], 'old')
+        self.assertEqual(m.get_generation('pages'), generation)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests of engine/manifest.py, python -m unittest engine.test_manifest"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from engine import manifest
+from engine.manifest import Manifest, get_hash
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.md = os.path.join(self.dir, 'md') + os.sep
+        self.html = os.path.join(self.dir, 'html') + os.sep
+        os.mkdir(self.md)
+        os.mkdir(self.html)
+        self.paths = manifest.PATH_TO_MD, manifest.PATH_TO_HTML
+        manifest.PATH_TO_MD, manifest.PATH_TO_HTML = self.md, self.html
+        self.m = Manifest(os.path.join(self.dir, 'manifest.sqlite'))
+
+    def tearDown(self):
+        self.m.close()
+        manifest.PATH_TO_MD, manifest.PATH_TO_HTML = self.paths
+        shutil.rmtree(self.dir)
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def compile(self, fn, deps=()):
+        """Save the note in the manifest as if it was compiled."""
+        path = self.md + fn
+        with open(path) as f:
+            text = f.read()
+        self.write(self.html + fn.replace('.md', '.html'), '<p>' + text)
+        self.m.update(fn, os.stat(path), get_hash(text), get_hash('<p>' + text), deps)
+        self.m.commit()
+
+    def set_mtime(self, path, delta):
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + delta))
+
+    def test_is_changed(self):
+        self.write(self.md + 'a.md', '# a')
+        self.assertTrue(self.m.is_changed('a.md'))  # never seen
+        self.compile('a.md')
+        self.assertFalse(self.m.is_changed('a.md'))
+        self.set_mtime(self.md + 'a.md', 10)  # touch
+        self.assertFalse(self.m.is_changed('a.md'))
+        self.assertEqual(self.m.get('a.md')['mtime'], os.stat(self.md + 'a.md').st_mtime)
+        self.write(self.md + 'a.md', '# b')  # the same size, another content
+        self.set_mtime(self.md + 'a.md', 20)
+        self.assertTrue(self.m.is_changed('a.md'))
+        self.assertEqual(self.m.dirty(['a.md', 'b.md']), ['a.md'])
+        os.remove(self.md + 'a.md')
+        self.assertFalse(self.m.is_changed('a.md'))  # gone, nothing to compile
+
+    def test_outdated(self):
+        inc = os.path.join(self.dir, 'inc.md')
+        self.write(inc, 'included')
+        for fn in 'a.md', 'b.md', 'c.md':
+            self.write(self.md + fn, '# ' + fn)
+        self.assertEqual(self.m.outdated(['a.md', 'b.md', 'c.md']), ['a.md', 'b.md', 'c.md'])
+        self.compile('a.md')
+        self.compile('b.md', [inc])
+        self.compile('c.md')
+        self.assertEqual(self.m.outdated(['a.md', 'b.md', 'c.md', 'gone.md']), ['gone.md'])
+        self.assertEqual(self.m.dependents([inc]), ['b.md'])
+        self.set_mtime(self.md + 'a.md', 10)  # only touched
+        self.assertEqual(self.m.outdated(['a.md']), [])
+        self.write(self.md + 'a.md', '# changed')
+        self.write(inc, 'included, changed')
+        os.remove(self.html + 'c.html')
+        self.assertEqual(self.m.outdated(['a.md', 'b.md', 'c.md']), ['a.md', 'b.md', 'c.md'])
+        os.remove(self.md + 'a.md')
+        self.assertEqual(self.m.outdated(['a.md']), [])  # gone
+
+    def test_engine(self):
+        self.write(self.md + 'a.md', '# a')
+        self.compile('a.md')
+        self.assertFalse(self.m.check_engine())
+        self.m._code += '\nanother version'  # as if the engine was changed
+        self.m._head = None
+        self.assertTrue(self.m.check_engine())
+        self.assertEqual(self.m.outdated(['a.md']), ['a.md'])
+
+
+if __name__ == '__main__':
+    unittest.main()
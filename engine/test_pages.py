@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests of engine/pages.py, python -m unittest engine.test_pages"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import email.utils
+
+from engine import pages
+from engine.pages import Page, Pages, write_page, remove_page, gzip_compress
+from engine.manifest import Manifest, get_hash
+
+
+class PageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.html')
+        self.html = u'<h1>Zażółć</h1>' * 100
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get_page(self):
+        return Page(self.path, os.stat(self.path))
+
+    def test_write(self):
+        etag = write_page(self.path, self.html)
+        self.assertEqual(etag, get_hash(self.html))
+        page = self.get_page()
+        self.assertEqual(page.etag, etag)
+        self.assertEqual(sorted(page.encodings), sorted(name for name, ext, c in pages.ENCODINGS))
+        with open(self.path + '.gz', 'rb') as f:
+            self.assertEqual(f.read(), gzip_compress(self.html.encode('utf-8')))
+        remove_page(self.path)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_not_written_together(self):
+        """Copies and the ETag of the next html, being written now, are not used."""
+        write_page(self.path, self.html)
+        st = os.stat(self.path)
+        later = st.st_mtime + 10
+        os.utime(self.path + '.gz', (later, later))
+        self.assertNotIn('gzip', self.get_page().encodings)
+        with open(self.path + '.etag', 'wb') as f:
+            f.write('next')
+        os.utime(self.path + '.etag', (later, later))
+        page = self.get_page()
+        self.assertEqual((page.etag, page.encodings), (get_hash(self.html), {}))
+
+    def test_not_modified(self):
+        write_page(self.path, self.html)
+        page = self.get_page()
+        etag = page.etag
+        self.assertTrue(page.is_not_modified('"%s"' % etag, None))
+        self.assertTrue(page.is_not_modified('"x", W/"%s-gzip"' % etag, None))
+        self.assertTrue(page.is_not_modified('*', None))
+        self.assertFalse(page.is_not_modified('"x"', None))
+        # the ETag wins over the date
+        self.assertFalse(page.is_not_modified('"x"', email.utils.formatdate(time.time() + 60)))
+        self.assertTrue(page.is_not_modified(None, page.last_modified))
+        self.assertFalse(page.is_not_modified(None, email.utils.formatdate(0, usegmt=True)))
+        self.assertFalse(page.is_not_modified(None, 'not a date'))
+        self.assertFalse(page.is_not_modified(None, None))
+
+    def test_encoding(self):
+        write_page(self.path, self.html)
+        page = self.get_page()
+        self.assertEqual(page.get_encoding('gzip, deflate'), ('gzip', self.path + '.gz'))
+        self.assertEqual(page.get_encoding('gzip;q=0, deflate'), (None, self.path))
+        self.assertEqual(page.get_encoding(None), (None, self.path))
+        best = pages.ENCODINGS[0]
+        self.assertEqual(page.get_encoding('gzip, br'), (best[0], self.path + best[1]))
+        page.encodings = {}
+        self.assertEqual(page.get_encoding('gzip'), (None, self.path))
+
+
+class PagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.dir, 'manifest.sqlite')
+        self.pages = Pages(max_bytes=4000, path=self.manifest)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, size):
+        path = os.path.join(self.dir, name)
+        write_page(path, u'x' * size)
+        return path
+
+    def read(self, path):
+        page = self.pages.get(path)
+        return self.pages.read(page, None, path)
+
+    def test_lru(self):
+        a, b, c = [self.write(name, 1000) for name in 'abc']
+        for path in a, b, c:
+            self.read(path)
+        self.read(a)  # the most recent now, b is the oldest
+        d = self.write('d', 1000)
+        self.read(d)
+        self.assertEqual(self.pages.size, 4000)
+        e = self.write('e', 1000)
+        self.read(e)
+        self.assertEqual([key[0] for key in self.pages.data], [c, a, d, e])
+        self.assertEqual(self.pages.size, 4000)
+        big = self.write('big', 1001)  # more than a quarter, never kept
+        self.assertEqual(self.read(big), 'x' * 1001)
+        self.assertNotIn((big, None), self.pages.data)
+
+    def test_changed_page(self):
+        a = self.write('a', 100)
+        self.assertEqual(self.read(a), 'x' * 100)
+        time.sleep(0.01)
+        write_page(a, u'y' * 200)  # no manifest, so pages are checked every time
+        self.assertEqual(self.read(a), 'y' * 200)
+        self.assertEqual(self.pages.size, 200)
+
+    def test_generation(self):
+        self.pages.refresh()
+        self.assertEqual(self.pages.generation, None)  # nothing built yet
+        self.assertFalse(os.path.exists(self.manifest))  # and no empty manifest made
+        m = Manifest(self.manifest)
+        m.log_pages(['a.md'])
+        m.commit()
+        self.pages.refresh()
+        self.assertEqual(self.pages.generation, 1)
+        a = self.write('a', 100)
+        page = self.pages.get(a)
+        os.remove(a)
+        self.assertIs(self.pages.get(a), page)  # nothing written since, not checked
+        m.log_pages([])
+        m.commit()
+        m.close()
+        self.pages.refresh()
+        self.assertEqual(self.pages.get(a), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests of engine/search_index.py, python -m unittest engine.test_search_index"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from engine.searcher import make_headers
+from engine.search_index import SearchIndex, IndexFile, Segments, IndexFormatError, \
+    parse_query, write_index, read_varints, varints
+
+
+def get_names(index, query):
+    return [h.name for score, h in index.search(query)]
+
+
+class QueryTest(unittest.TestCase):
+
+    def test_parse_query(self):
+        self.assertEqual(parse_query(u'RNA structure'),
+                         [('term', [u'rna']), ('term', [u'structure'])])
+        self.assertEqual(parse_query(u'"secondary  structure" "rna"'),
+                         [('phrase', [u'secondary', u'structure']), ('term', [u'rna'])])
+        self.assertEqual(parse_query(u'struct* @todo rna-puzzles'),
+                         [('prefix', [u'struct']), ('term', [u'@todo']),
+                          ('phrase', [u'rna', u'puzzles'])])
+        self.assertEqual(parse_query(u'"" * -- zażółć'), [('term', [u'zażółć'])])
+
+    def test_varints(self):
+        values = [0, 1, 127, 128, 300, 2 ** 31]
+        self.assertEqual(read_varints(bytes(varints(values))), values)
+
+
+class SearchIndexTest(unittest.TestCase):
+    TEXT = u"""# rna
+rna rna rna structure
+
+# long
+rna and a lot of other words, many many words about nothing else at all here
+
+# structure
+secondary structure of rna @todo
+
+# reversed
+structure secondary, structural
+
+## Zażółć
+gęślą jaźń
+"""
+
+    def setUp(self):
+        self.index = SearchIndex()
+        for h in make_headers(self.TEXT, u'test'):
+            self.index.add(h)
+
+    def test_ranking(self):
+        """More of the word and a shorter section first, the name is searched too."""
+        self.assertEqual(get_names(self.index, u'rna'), [u'rna', u'structure', u'long'])
+        scores = [score for score, h in self.index.search(u'rna')]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(get_names(self.index, u'rna'), get_names(self.index, u'RNA'))
+
+    def test_queries(self):
+        self.assertEqual(get_names(self.index, u'rna structure'), [u'rna', u'structure'])
+        self.assertEqual(get_names(self.index, u'"secondary structure"'), [u'structure'])
+        self.assertEqual(sorted(get_names(self.index, u'struct*')),
+                         [u'reversed', u'rna', u'structure'])
+        self.assertEqual(get_names(self.index, u'@todo'), [u'structure'])
+        self.assertEqual(get_names(self.index, u'jaźń'), [u'Zażółć'])
+        self.assertEqual(get_names(self.index, u'rna nothing2'), [])
+        self.assertEqual(get_names(self.index, u''), [])
+
+    def test_page(self):
+        total, hits = self.index.search_page(u'rna', 1, 1)
+        self.assertEqual((total, [h.name for score, h in hits]), (3, [u'structure']))
+
+
+class IndexFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'search.idx')
+        self.notes = [(u'a', make_headers(u'# a1\nrna one\n# a2\nrna two rna', u'a')),
+                      (u'b', make_headers(u'# b1\nrna structure\n', u'b')),
+                      (u'c', make_headers(u'# c1\nstructure only\n', u'c'))]
+        write_index(self.path, self.notes, 3)
+        self.base = IndexFile(self.path)
+
+    def tearDown(self):
+        self.base.close()
+        shutil.rmtree(self.dir)
+
+    def search(self, index, query):
+        return [(round(score, 6), h.md, h.name, h.note) for score, h in index.search(query)]
+
+    def test_file(self):
+        """The file is searched the same as the index in memory."""
+        memory = SearchIndex()
+        for md, headers in self.notes:
+            for h in headers:
+                memory.add(h)
+        self.assertEqual(self.base.generation, 3)
+        self.assertEqual(self.base.get_note(u'b'), (2, 1))
+        self.assertEqual(self.base.get_note(u'x'), None)
+        for query in [u'rna', u'structure', u'"rna structure"', u'r*', u'rna two', u'x']:
+            self.assertEqual(self.search(self.base, query), self.search(memory, query), query)
+
+    def test_segments(self):
+        """Notes changed (a) and removed (b) since the file was written are not found in
+        the file, a changed note is found in the delta."""
+        delta = SearchIndex(avgdl=self.base.avgdl)
+        for h in make_headers(u'# a1\nstructure now\n', u'a'):
+            delta.add(h)
+        deleted = []
+        for md in u'a', u'b':
+            first, n = self.base.get_note(md)
+            deleted.extend(range(first, first + n))
+        index = Segments(self.base, delta, deleted)
+        self.assertEqual(index.count, 2)
+        self.assertEqual(self.search(index, u'rna'), [])
+        self.assertEqual(sorted(h.md for score, h in index.search(u'structure')), [u'a', u'c'])
+        self.assertEqual(index.search(u'"structure now"')[0][1].note, u'structure now\n')
+        self.assertEqual(index.get_terms(u'str'), [u'structure'])
+        self.assertEqual(sorted(index.get_positions(u'structure')), [3, 4])
+
+    def test_not_an_index(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not an index, but long enough to have a header of one' * 3)
+        self.assertRaises(IndexFormatError, IndexFile, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
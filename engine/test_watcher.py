@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Tests of engine/watcher.py, python -m unittest engine.test_watcher"""
+import os
+import shutil
+import platform
+import tempfile
+import unittest
+
+from engine.watcher import StatWatcher, InotifyWatcher, CREATED, MODIFIED, DELETED, RENAMED, \
+    RESCAN, EVENT_HEADER, IN_Q_OVERFLOW
+
+
+class WatcherTests(object):
+    """The same tests for every watcher, see make_watcher."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.write('old.md', '# old')
+        self.watcher = self.make_watcher(self.dir)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, fn, text, dirname=None):
+        with open(os.path.join(dirname or self.dir, fn), 'w') as f:
+            f.write(text)
+
+    def wait(self):
+        return [(e.kind, e.fn, e.old_fn) for e in self.watcher.wait(timeout=2)]
+
+    def test_create(self):
+        self.write('new.md', '# new')
+        self.assertEqual(self.wait(), [(CREATED, 'new.md', None)])
+        self.assertEqual(self.watcher.wait(timeout=0.1), [])
+
+    def test_modify(self):
+        self.write('old.md', '# old, longer')
+        self.assertEqual(self.wait(), [(MODIFIED, 'old.md', None)])
+
+    def test_rename(self):
+        os.rename(os.path.join(self.dir, 'old.md'), os.path.join(self.dir, 'new.md'))
+        self.assertEqual(self.wait(), [(RENAMED, 'new.md', 'old.md')])
+
+    def test_rename_to_other(self):
+        """A note renamed to a file that is not a note is gone."""
+        os.rename(os.path.join(self.dir, 'old.md'), os.path.join(self.dir, 'old.txt'))
+        self.assertEqual(self.wait(), [(DELETED, 'old.md', None)])
+
+    def test_atomic_save(self):
+        """Editors write a tmp file and rename it to the note."""
+        self.write('.old.md.swp', '# old, saved')
+        os.rename(os.path.join(self.dir, '.old.md.swp'), os.path.join(self.dir, 'old.md'))
+        self.assertEqual(self.wait(), [(MODIFIED, 'old.md', None)])
+
+    def test_delete(self):
+        os.remove(os.path.join(self.dir, 'old.md'))
+        self.assertEqual(self.wait(), [(DELETED, 'old.md', None)])
+
+    def test_not_notes(self):
+        for fn in ['.#old.md', 'old.md~', 'flycheck_old.md', 'old.txt']:
+            self.write(fn, 'x')
+        self.write('new.md', '# new')
+        self.assertEqual(self.wait(), [(CREATED, 'new.md', None)])
+
+    def test_watch_file(self):
+        other = tempfile.mkdtemp()
+        try:
+            self.write('inc.md', 'included', other)
+            self.write('skip.md', 'x', other)
+            self.watcher.watch_file(os.path.join(other, 'inc.md'))
+            self.write('skip.md', 'not watched', other)
+            self.write('inc.md', 'changed', other)
+            self.assertEqual(self.wait(), [(MODIFIED, os.path.join(other, 'inc.md'), None)])
+        finally:
+            shutil.rmtree(other)
+
+
+class StatWatcherTest(WatcherTests, unittest.TestCase):
+
+    def make_watcher(self, path):
+        return StatWatcher(path, interval=0.01)
+
+
+@unittest.skipUnless(platform.system() == 'Linux', 'inotify is only on Linux')
+class InotifyWatcherTest(WatcherTests, unittest.TestCase):
+
+    def make_watcher(self, path):
+        return InotifyWatcher(path)
+
+    def test_overflow(self):
+        """Events lost by the kernel are reported as one RESCAN."""
+        events = []
+        self.watcher._parse(EVENT_HEADER.pack(-1, IN_Q_OVERFLOW, 0, 0), events, {})
+        self.assertEqual(events, [(RESCAN, None, None)])
+        e = self.watcher._merge(events)[0]
+        self.assertEqual((e.kind, e.fn, e.path), (RESCAN, None, self.watcher.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Theme - the head of pages (PATH_TO_TEMPLATE_HTML, e.g. themes/default/notes/head.html).
+
+Every page and the index start with the head of the theme, with links to img/, lib/, css/
+and js/ of the theme fixed and the demo content removed. The head is read and prepared
+only once and kept in memory. Head.check() tells if the file is changed (mtime or size), then
+it's read again, so you can work on your theme while geekbook is running. It's checked once per
+build or per change of notes (see engine/builder.py, geekbookapp.py), not for every page.
+
+In the head for flask, links to files of the theme (css/, js/, img/, lib/) get a fingerprint, a piece
+of sha1 of the file in the name (css/style.css -> /css/style.3f2a9c01bd.css). Flask sends such
+files to be kept by the browser forever (see webserverflask.py), a changed file gets a new name.
+Head.check() looks at these files too, the head is prepared again when any of them is changed.
+
+Usage::
+
+    html = get_head() + html  # for flask, links start with /
+    html = get_head(PATH_TO_TEMPLATE + '/') + html  # for html files opened from the disc
+"""
+import os
+import re
+import hashlib
+
+from engine.conf import PATH_TO_TEMPLATE_HTML, PATH_TO_HTML
+
+import logging
+logger = logging.getLogger('geekbook')
+
+DEMO = re.compile(r'<!-- start of demo -->.*<!-- end of demo -->', flags=re.M | re.DOTALL)
+ASSET = re.compile(r'(href|src)="/((?:css|js|img|lib)/[^"?#]+)"')
+FINGERPRINTED = re.compile(r'^(.+)\.([0-9a-f]{10})(\.[^./]+)?$')
+FINGERPRINT_LENGTH = 10
+
+
+def strip_fingerprint(path):
+    """Get (path, fingerprint) of a path with a fingerprint (js/x.0123456789.js -> js/x.js),
+    (path, None) if there is no fingerprint."""
+    m = FINGERPRINTED.match(path)
+    if m:
+        return m.group(1) + (m.group(3) or ''), m.group(2)
+    return path, None
+
+
+class Head(object):
+    """Head class
+
+    Attributes:
+
+      path - path to the head of the theme
+      stamp - (mtime, size) of the file when it was read
+      raw - content of the file
+      heads - prefix -> head ready to use
+      assets - path of a file of the theme (e.g. css/style.css) -> ((mtime, size), fingerprint)
+    """
+
+    def __init__(self, path=PATH_TO_TEMPLATE_HTML):
+        self.path = path
+        self.dir = os.path.dirname(path)
+        self.stamp = None
+        self.raw = None
+        self.heads = {}
+        self.assets = {}
+
+    def get_stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def load(self):
+        """Read the file, if it's not read yet (or forgotten by check)."""
+        if self.raw is not None:
+            return
+        logger.debug('theme: load %s' % self.path)
+        self.stamp = self.get_stamp(self.path)
+        with open(self.path) as f:
+            self.raw = f.read()
+        self.heads = {}
+        self.assets = {}
+
+    def check(self):
+        """Forget the head if the file or any file of the theme with a fingerprint is changed
+        since it was read (mtime or size), it's read again when it's needed.
+
+        Returns:
+
+           boolean: True if anything is changed
+        """
+        if self.raw is None:
+            return False
+        changed = self.get_stamp(self.path) != self.stamp
+        for asset, (asset_stamp, fingerprint) in self.assets.items():
+            if changed:
+                break
+            changed = self.get_stamp(self.dir + os.sep + asset) != asset_stamp
+        if changed:
+            logger.debug('theme: %s changed' % self.dir)
+            self.raw = None
+            self.heads = {}
+            self.assets = {}
+        return changed
+
+    def get_fingerprint(self, asset):
+        """Get the fingerprint of a file of the theme (e.g. css/style.css), None if there is no
+        such file."""
+        if asset not in self.assets:
+            path = self.dir + os.sep + asset
+            stamp = self.get_stamp(path)
+            fingerprint = None
+            if stamp:
+                with open(path, 'rb') as f:
+                    fingerprint = hashlib.sha1(f.read()).hexdigest()[:FINGERPRINT_LENGTH]
+            self.assets[asset] = (stamp, fingerprint)
+        return self.assets[asset][1]
+
+    def add_fingerprints(self, head):
+        """Put fingerprints into links to files of the theme, href="/css/style.css" ->
+        href="/css/style.3f2a9c01bd.css"."""
+        def add(m):
+            fingerprint = self.get_fingerprint(m.group(2))
+            if not fingerprint:
+                return m.group(0)
+            root, ext = os.path.splitext(m.group(2))
+            return '%s="/%s.%s%s"' % (m.group(1), root, fingerprint, ext)
+        return ASSET.sub(add, head)
+
+    def get(self, prefix='/'):
+        """Get the head, links to img/, lib/, css/ and js/ of the theme start with prefix."""
+        self.load()
+        if prefix not in self.heads:
+            head = self.raw.replace('{{ url_index }}', PATH_TO_HTML + '/' + 'index.html')
+            head = head.replace('href="img/', 'href="' + prefix + 'img/')
+            head = head.replace('="lib/', '="' + prefix + 'lib/')
+            head = head.replace('="css/', '="' + prefix + 'css/')
+            head = head.replace('="js/', '="' + prefix + 'js/')
+            # remove demo content
+            head = DEMO.sub('', head)
+            if prefix == '/':  # for flask
+                head = self.add_fingerprints(head)
+            self.heads[prefix] = head
+        return self.heads[prefix]
+
+
+_head = None
+
+
+def get_theme_head():
+    """Get the Head of this process."""
+    global _head
+    if _head is None:
+        _head = Head()
+    return _head
+
+
+def get_head(prefix='/'):
+    """Get the head of the theme, see Head.get."""
+    return get_theme_head().get(prefix)
+
+
+# main
+if __name__ == '__main__':
+    print(get_head())
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Watcher - tell the app which notes were created, modified, deleted or renamed.
+
+On Linux the kernel does the job (inotify, via ctypes, no extra packages needed) so the app
+sleeps in ``select`` until something happens. Everywhere else we fall back to polling
+``os.stat`` of the files in the folder, which never reads the content of the notes.
+
+Usage::
+
+    watcher = get_watcher(PATH_TO_MD)
+    while True:
+        for e in watcher.wait():
+            print(e.kind, e.fn)
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import platform
+from collections import namedtuple
+
+import logging
+logger = logging.getLogger('geekbook')
+
+CREATED = 'created'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+RENAMED = 'renamed'
+RESCAN = 'rescan'  # events were lost, look at all the notes again
+
+# kind - one of the above, fn - basename of the file (None for RESCAN), path - full path,
+# old_fn - the previous name (only for RENAMED)
+Event = namedtuple('Event', ['kind', 'fn', 'path', 'old_fn'])
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# how long to wait for more events after the first one (editors write in bursts)
+SETTLE = 0.02
+POLL_INTERVAL = 0.5
+
+
+def is_note(fn, suffix='.md'):
+    """Return True if fn looks like a note, skip temporary files of editors
+    (emacs ``.#``, ``flycheck_``, ``~`` backups)."""
+    if not fn.endswith(suffix):
+        return False
+    if fn.startswith('.') or fn.startswith('flycheck_'):
+        return False
+    if '#' in fn or '~' in fn:
+        return False
+    return True
+
+
+class Watcher(object):
+    """Base class. Subclasses implement ``_read(timeout)`` that returns a list of raw
+    events ``(kind, fn, old_fn)``.
+
+    Beside the whole folder you can watch single files somewhere else in the system,
+    see ``watch_file``, events for these files are reported with the full path as fn."""
+
+    def __init__(self, path, suffix='.md'):
+        self.path = os.path.abspath(path)
+        self.suffix = suffix
+        self.files = {}  # dirname -> set of basenames watched outside self.path
+
+    def watch_file(self, path):
+        """Report also events for this file (e.g. a file included with [if:...])."""
+        path = os.path.abspath(path)
+        dirname, fn = os.path.split(path)
+        if dirname == self.path:
+            return
+        if dirname not in self.files:
+            if not self._add_dir(dirname):
+                return
+            self.files[dirname] = set()
+        self.files[dirname].add(fn)
+
+    def _add_dir(self, dirname):
+        return True
+
+    def _accept(self, dirname, fn):
+        """Get a basename and return the name to report or None if the file is not
+        interesting."""
+        if dirname == self.path:
+            if is_note(fn, self.suffix):
+                return fn
+        elif fn in self.files.get(dirname, ()):
+            return os.path.join(dirname, fn)
+        return None
+
+    def _event(self, kind, fn, old_fn=None):
+        if fn is None:
+            path = self.path
+        elif os.path.isabs(fn):
+            path = fn
+        else:
+            path = os.path.join(self.path, fn)
+        return Event(kind, fn, path, old_fn)
+
+    def wait(self, timeout=None):
+        """Block until something changes (or timeout, in seconds, passes) and return a list
+        of Events. Many events for the same file are merged into one."""
+        events = self._read(timeout)
+        if events:
+            # editors save in a few steps, give them a moment to finish
+            time.sleep(SETTLE)
+            events.extend(self._read(0))
+        return self._merge(events)
+
+    def _merge(self, raw):
+        """Merge raw events, keep the order of the first appearance of a file."""
+        state = {}
+        order = []
+        for kind, fn, old_fn in raw:
+            if fn not in state:
+                order.append(fn)
+            prev = state.get(fn)
+            if kind == MODIFIED and prev and prev[0] in (CREATED, RENAMED):
+                continue  # it's still new
+            if kind == CREATED and prev and prev[0] == DELETED:
+                kind = MODIFIED  # save via delete & create
+            state[fn] = (kind, old_fn)
+        events = []
+        for fn in order:
+            kind, old_fn = state[fn]
+            events.append(self._event(kind, fn, old_fn))
+        return events
+
+    def close(self):
+        pass
+
+
+class StatWatcher(Watcher):
+    """Portable watcher, compare (mtime, size) of files between calls."""
+
+    def __init__(self, path, suffix='.md', interval=POLL_INTERVAL):
+        super(StatWatcher, self).__init__(path, suffix)
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _stat_dir(self, dirname, names, snapshot):
+        for fn in names:
+            name = self._accept(dirname, fn)
+            if not name:
+                continue
+            try:
+                st = os.stat(os.path.join(dirname, fn))
+            except OSError:
+                continue
+            snapshot[name] = (st.st_mtime, st.st_size, st.st_ino)
+
+    def _scan(self):
+        snapshot = {}
+        try:
+            self._stat_dir(self.path, os.listdir(self.path), snapshot)
+        except OSError:
+            pass
+        for dirname, names in self.files.items():
+            self._stat_dir(dirname, names, snapshot)
+        return snapshot
+
+    def _add_dir(self, dirname):
+        return os.path.isdir(dirname)
+
+    def watch_file(self, path):
+        super(StatWatcher, self).watch_file(path)
+        self.snapshot = self._scan()
+
+    def _diff(self):
+        new = self._scan()
+        old = self.snapshot
+        self.snapshot = new
+        events = []
+        gone = dict((old[fn][2], fn) for fn in old if fn not in new)
+        for fn in new:
+            if fn not in old:
+                old_fn = gone.pop(new[fn][2], None)
+                if old_fn:
+                    events.append((RENAMED, fn, old_fn))
+                else:
+                    events.append((CREATED, fn, None))
+            elif new[fn] != old[fn]:
+                events.append((MODIFIED, fn, None))
+        for fn in gone.values():
+            events.append((DELETED, fn, None))
+        return events
+
+    def _read(self, timeout):
+        if timeout == 0:
+            return self._diff()
+        start = time.time()
+        while True:
+            events = self._diff()
+            if events:
+                return events
+            if timeout is not None and time.time() - start >= timeout:
+                return []
+            time.sleep(self.interval)
+
+
+class InotifyWatcher(Watcher):
+    """Linux watcher, sleep in select() until the kernel tells us something happened."""
+
+    def __init__(self, path, suffix='.md'):
+        super(InotifyWatcher, self).__init__(path, suffix)
+        self.libc = _get_libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wds = {}  # wd -> dirname
+        if not self._add_dir(self.path):
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: ' + self.path)
+
+    def _add_dir(self, dirname):
+        if not isinstance(dirname, bytes):
+            dirname_raw = dirname.encode('utf-8')
+        else:
+            dirname_raw = dirname
+        wd = self.libc.inotify_add_watch(self.fd, dirname_raw, WATCH_MASK)
+        if wd < 0:
+            logger.info('watcher: can not watch %s', dirname)
+            return False
+        self.wds[wd] = dirname
+        return True
+
+    def _read_raw(self):
+        try:
+            return os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return b''
+            raise
+
+    def _read(self, timeout):
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error:
+            return []
+        if not ready:
+            return []
+        events = []
+        moved = {}  # cookie -> name, for IN_MOVED_FROM waiting for its IN_MOVED_TO
+        data = self._read_raw()
+        while data:
+            self._parse(data, events, moved)
+            data = self._read_raw()
+        # moved out of the folder (or to a file we don't care about)
+        for cookie in moved:
+            events.append((DELETED, moved[cookie], None))
+        return events
+
+    def _parse(self, data, events, moved):
+        i = 0
+        while i + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, i)
+            i += EVENT_HEADER.size
+            raw_fn = data[i:i + length].rstrip(b'\0')
+            i += length
+            if mask & IN_Q_OVERFLOW:
+                logger.info('watcher: queue overflow, some events lost, rescan the notes')
+                events.append((RESCAN, None, None))
+                continue
+            dirname = self.wds.get(wd)
+            if dirname is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF):
+                if dirname == self.path:
+                    logger.error('watcher: the notes folder is gone %s', dirname)
+                continue
+            if not isinstance(raw_fn, str):  # py3
+                raw_fn = raw_fn.decode('utf-8', 'replace')
+            fn = self._accept(dirname, raw_fn)
+            if mask & IN_MOVED_FROM:
+                if fn:
+                    moved[cookie] = fn
+            elif mask & IN_MOVED_TO:
+                old_fn = moved.pop(cookie, None)
+                if fn and old_fn:
+                    events.append((RENAMED, fn, old_fn))
+                elif fn:
+                    # e.g. editors that write to a tmp file and rename it to the note
+                    events.append((MODIFIED, fn, None))
+                elif old_fn:  # a note renamed to a file we don't care about (a.md -> a.txt)
+                    events.append((DELETED, old_fn, None))
+            elif not fn:
+                continue
+            elif mask & IN_CREATE:
+                events.append((CREATED, fn, None))
+            elif mask & IN_CLOSE_WRITE:
+                events.append((MODIFIED, fn, None))
+            elif mask & IN_DELETE:
+                events.append((DELETED, fn, None))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _get_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def get_watcher(path, suffix='.md'):
+    """Get the best watcher for this system."""
+    if platform.system() == 'Linux':
+        try:
+            return InotifyWatcher(path, suffix)
+        except (OSError, AttributeError) as e:
+            logger.info('watcher: inotify is not available (%s), use stat polling', e)
+    return StatWatcher(path, suffix)
+
+
+# main
+if __name__ == '__main__':
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from engine.conf import PATH_TO_MD
+    watcher = get_watcher(PATH_TO_MD)
+    print(watcher.__class__.__name__ + ' ' + PATH_TO_MD)
+    while True:
+        for e in watcher.wait():
+            print(e)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Webserver, async - the same flask app (webserverflask.py) served by gevent, with live reload
+of pages (Server-Sent Events on /events, see engine/livereload.py).
+
+Every request is a greenlet, not a thread, so pages waiting for events cost (almost) nothing,
+you can have thousands of them open. gevent makes sockets, sleep, threads etc. cooperative
+(monkey patching), so it's done here before anything else is imported.
+
+    pip install gevent
+    python engine/webserverasync.py  # or SERVER = 'gevent' in conf_local.py
+"""
+try:
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pywsgi import WSGIServer
+except ImportError as e:
+    raise ImportError('SERVER gevent is not installed, pip install gevent (%s)' % e)
+
+import os
+import sys
+PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PATH)
+
+from engine import webserverflask
+from engine.webserverflask import app, search_db, get_parser
+
+
+def serve(host, port):
+    webserverflask.LIVE_RELOAD = True
+    search_db.get()
+    WSGIServer((host, port), app).serve_forever()
+
+
+#main
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+
+    if args.public:
+        print('WARNING PUBLIC MODE')
+        serve('0.0.0.0', args.port)
+    else:
+        serve('127.0.0.1', args.port)
@@ -10,8 +10,11 @@ import sys
 PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(PATH)
 from engine.conf import PATH_TO_HTML, PATH_TO_TEMPLATE_HTML, PATH_TO_TEMPLATE, PATH_TO_MD
+from engine.conf import SERVER, SERVER_WORKERS
 from engine.postprocessing import add_head
-from flask import Flask, redirect, url_for, send_from_directory, request
+from engine.theme import get_head, get_theme_head, strip_fingerprint
+from flask import Flask, redirect, url_for, send_from_directory, request, make_response, abort
+from flask import Response
 
 import subprocess
 import re
@@ -20,7 +23,11 @@ import argparse
 from flask import request
 from flask import jsonify
 
-from engine.searcher import search_term, Db, Header
+from engine.searcher import search_term, Db, Header, LiveDb, PAGE_SIZE, format_results
+from engine.autocomplete import TOP_K
+from engine.make_index import Notes
+from engine.pages import Pages
+from engine.livereload import Rebuilds
 
 # Open Access mode
 try:
@@ -112,62 +119,232 @@ def open_file(filename):
     return cmd
 """
 
+pages = Pages()
+
+ASSET_MAX_AGE = 365 * 24 * 3600  # a year, files of the theme with a fingerprint never change
+
+
+_theme_generation = [None]
+
+
+def check_theme(head):
+    """Forget fingerprints of changed files of the theme, only when pages were written since
+    the last check (a changed theme is compiled into pages), not on every request."""
+    pages.start()
+    generation = pages.generation
+    if generation is None or generation != _theme_generation[0]:
+        head.check()
+        _theme_generation[0] = generation
+
+
+def send_theme_file(folder, path):
+    """Send a file of the theme. With the fingerprint of the file in the name (see
+    engine/theme.py) it's sent to be kept by the browser forever (immutable), without it (or
+    with an old one) it's checked every time (ETag)."""
+    path, fingerprint = strip_fingerprint(path)
+    head = get_theme_head()
+    check_theme(head)
+    if fingerprint and fingerprint == head.get_fingerprint(folder + '/' + path):
+        response = send_from_directory(PATH_TO_TEMPLATE + os.sep + folder, path,
+                                       cache_timeout=ASSET_MAX_AGE)
+        response.headers['Cache-Control'] = 'public, max-age=%i, immutable' % ASSET_MAX_AGE
+        return response
+    return send_from_directory(PATH_TO_TEMPLATE + os.sep + folder, path, cache_timeout=0)
+
+
 @app.route('/js/<path:path>')
 def send_js(path):
-    return send_from_directory(PATH_TO_TEMPLATE + os.sep + 'js/' , path)
+    return send_theme_file('js', path)
 
 @app.route('/css/<path:path>')
 def send_css(path):
-    return send_from_directory(PATH_TO_TEMPLATE + os.sep + 'css/' , path)
+    return send_theme_file('css', path)
 
 @app.route('/img/<path:path>')
 def send_flav(path):
-    return send_from_directory(PATH_TO_TEMPLATE + os.sep + 'img/', path)
+    return send_theme_file('img', path)
+
+@app.route('/lib/<path:path>')
+def send_lib(path):
+    return send_theme_file('lib', path)
 
 @app.route('/imgs/<path:path>')
 def send_img(path):
-    return send_from_directory(PATH_TO_MD + os.sep + 'imgs', path)
+    """Send an image of notes. Links to them have no fingerprint (they're in your notes), so
+    the browser asks every time, and gets 304 Not Modified (ETag, Last-Modified) if the image
+    is not changed."""
+    response = send_from_directory(PATH_TO_MD + os.sep + 'imgs', path, cache_timeout=0)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/view/<note_title>')
 def view(note_title):
-    """Open a note with your edit"""
+    """Open a note with your edit
+
+    The page is sent compressed (gzip or brotli, written when the note is compiled) with
+    ETag and Last-Modified, so a page you have already is 304 Not Modified, pages used often
+    are kept in memory (see engine/pages.py).
+    """
     if request.remote_addr not in ['127.0.0.1', '0.0.0.0']:
         if note_title not in OPEN_ACCESS:
             return 'Hmm...'
 
-    head = open(PATH_TO_TEMPLATE_HTML).read()
-    head = head.replace('{{ url_index }}', PATH_TO_HTML + '/' + 'index.html')
-    head = head.replace('href="img/', 'href="' + '/img/')
-    head = head.replace('="lib/', '="' + '/lib/')
-    head = head.replace('="css/', '="'+ '/css/')
-    head = head.replace('="js/', '="' + '/js/')
-    head = re.sub(r'<!-- start of demo -->.*<!-- end of demo -->', r'', head, flags=re.M | re.DOTALL)
+    page = pages.get(PATH_TO_HTML + os.sep + note_title.replace('.md', '.html'))
+    if page is None:
+        abort(404)
+    encoding, path = page.get_encoding(request.headers.get('Accept-Encoding'))
+    if page.is_not_modified(request.headers.get('If-None-Match'),
+                            request.headers.get('If-Modified-Since')):
+        response = make_response('', 304)
+    else:
+        response = make_response(pages.read(page, encoding, path))
+        response.headers['Content-Type'] = 'text/html; charset=utf-8'
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = '"%s"' % (page.etag + ('-' + encoding if encoding else ''))
+    response.headers['Last-Modified'] = page.last_modified
+    response.headers['Cache-Control'] = 'no-cache'  # ask every time, it's 304 if not changed
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+search_db = LiveDb()
 
-    html = open(PATH_TO_HTML + os.sep + note_title.replace('.md', '.html')).read()
-    #return head + html
-    return html
 
-@app.route('/search/<text>')
+@app.route('/search/<path:text>')
 def search(text):
     if request.remote_addr not in ['127.0.0.1', '0.0.0.0']:
         return 'Hmm...'
 
-    results = search_term(text)
+    results = format_results(search_db.query(text, request.args.get('page', 1, type=int)))
+    return get_head() + results
+    #return send_from_directory('', 'file:///' + PATH_TO_HTML + '/geekbook-search.html')
+    #return redirect(url_for('static', filename='file:///' + PATH_TO_HTML + '/geekbook-search.html'))
 
-    head = open(PATH_TO_TEMPLATE_HTML).read()
-    head = head.replace('{{ url_index }}', PATH_TO_HTML + '/' + 'index.html')
-    head = head.replace('href="img/', 'href="' + '/img/')
-    head = head.replace('="lib/', '="' + '/lib/')
-    head = head.replace('="css/', '="'+ '/css/')
-    head = head.replace('="js/', '="' + '/js/')
 
-    os.system('open file://' + PATH_TO_HTML + '_search_geekbook_.html')
+@app.route('/api/search')
+def api_search():
+    """Search, a page of hits as JSON, the best first::
 
-    # remove demo content
-    head = re.sub(r'<!-- start of demo -->.*<!-- end of demo -->', r'', head, flags=re.M | re.DOTALL)
-    return head + results
-    #return send_from_directory('', 'file:///' + PATH_TO_HTML + '/geekbook-search.html')
-    #return redirect(url_for('static', filename='file:///' + PATH_TO_HTML + '/geekbook-search.html'))
+        /api/search?q=rna structure&page=1&size=20
+
+    Returns {"q", "page", "size", "total", "pages", "hits": [{title, note, level, url, score,
+    snippet}]}, snippet is html with words of the query in <mark>.
+    """
+    if request.remote_addr not in ['127.0.0.1', '0.0.0.0']:
+        return 'Hmm...'
+
+    args = request.args
+    return jsonify(search_db.query(args.get('q', ''), args.get('page', 1, type=int),
+                                   args.get('size', PAGE_SIZE, type=int)))
+
+
+@app.route('/api/complete')
+def api_complete():
+    """Completions for the search box, notes, headers and @tags starting with q, the best
+    first::
+
+        /api/complete?q=rna&k=10
+
+    Returns {"q", "completions": [{text, kind (note, header, tag), url, weight}]}
+    """
+    if request.remote_addr not in ['127.0.0.1', '0.0.0.0']:
+        return 'Hmm...'
+
+    q = request.args.get('q', '')
+    return jsonify(q=q, completions=search_db.complete(q, request.args.get('k', TOP_K, type=int)))
+
+
+notes = Notes()
+
+
+@app.route('/api/notes')
+def api_notes():
+    """The list of notes, a page of it, as JSON (for the lazy index.html, see LAZY_INDEX).
+
+    Takes q, sort (title, desc, mtime), dir (asc, desc), start and length (-1 for all), or
+    the same as sent by DataTables with serverSide (search[value], order[0][column]...)::
+
+        /api/notes?q=rna&sort=title&dir=asc&start=0&length=20
+
+    Returns {"draw", "recordsTotal", "recordsFiltered", "data": [{title, desc, mtime, date}]}
+    """
+    if request.remote_addr not in ['127.0.0.1', '0.0.0.0']:
+        if 'index.html' not in OPEN_ACCESS:
+            return 'Hmm...'
+
+    args = request.args
+    q = args.get('q', args.get('search[value]', ''))
+    sort = args.get('sort')
+    if sort is None:
+        column = args.get('order[0][column]', 2, type=int)
+        sort = Notes.COLUMNS[column] if 0 <= column < len(Notes.COLUMNS) else 'mtime'
+    reverse = args.get('dir', args.get('order[0][dir]', 'desc')) == 'desc'
+    start = max(0, args.get('start', 0, type=int))
+    length = args.get('length', 20, type=int)
+    total, filtered, rows = notes.query(q, sort, reverse, start, length)
+    return jsonify(draw=args.get('draw', 0, type=int), recordsTotal=total,
+                   recordsFiltered=filtered, data=rows)
+
+
+rebuilds = Rebuilds(on_rebuilt=pages.refresh)  # the pages in memory are checked before open pages reload
+LIVE_RELOAD = False  # only with gevent (webserverasync.py), a page waiting for events is a thread otherwise
+
+
+@app.route('/events')
+def events():
+    """Server-Sent Events: "rebuilt" with the name of a note when it's compiled again, pages
+    reload themselves (see engine/livereload.py). 204 if there is no live reload, then pages
+    don't ask again."""
+    if not LIVE_RELOAD:
+        return '', 204
+    allowed = None
+    if request.remote_addr not in ['127.0.0.1', '0.0.0.0']:
+        allowed = lambda md: md + '.html' in OPEN_ACCESS
+    last = request.headers.get('Last-Event-ID')
+    last = int(last) if last and last.isdigit() else None
+    return Response(rebuilds.stream(allowed, last), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def serve(host, port, server=SERVER, workers=SERVER_WORKERS, debug=False):
+    """Run the app with a server: flask (the development server), waitress (workers threads),
+    gunicorn (workers processes) or gevent (one process, see webserverasync.py).
+
+    The search db is loaded before the server starts, gunicorn starts workers after that
+    (preload), so they all share it (the index file is mmap-ed, so it's in memory only once
+    anyway, and the rest is shared by fork until it's changed).
+    """
+    if server == 'gevent':  # gevent has to be set up before anything else is imported
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webserverasync.py')
+        os.execv(sys.executable, [sys.executable, script] + sys.argv[1:])
+    search_db.get()
+    if server == 'flask':
+        app.run(debug=debug, host=host, port=port, threaded=True)
+    elif server == 'waitress':
+        try:
+            import waitress
+        except ImportError as e:
+            raise ImportError('SERVER waitress is not installed, pip install waitress (%s)' % e)
+        waitress.serve(app, host=host, port=port, threads=workers)
+    elif server == 'gunicorn':
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError as e:
+            raise ImportError('SERVER gunicorn is not installed, pip install gunicorn (%s)' % e)
+
+        class Gunicorn(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', '%s:%i' % (host, port))
+                self.cfg.set('workers', workers)
+                self.cfg.set('preload_app', True)
+
+            def load(self):
+                return app
+
+        Gunicorn().run()
+    else:
+        raise ValueError('unknown SERVER %s (flask, waitress, gunicorn or gevent)' % server)
 
 
 def get_parser():
@@ -179,6 +356,13 @@ def get_parser():
     parser.add_argument('--debug', default=False,
                         action="store_true", help="debug mode")
     parser.add_argument('--port', default=5000, type=int)
+    parser.add_argument('--server', default=SERVER,
+                        choices=['flask', 'waitress', 'gunicorn', 'gevent'],
+                        help="flask is the development server, use waitress or gunicorn "
+                        "for many users, gevent for live reload of pages "
+                        "(default from conf.py: %(default)s)")
+    parser.add_argument('-w', '--workers', default=SERVER_WORKERS, type=int,
+                        help="threads of waitress, processes of gunicorn (default: %(default)s)")
     return parser
 
 
@@ -190,7 +374,7 @@ if __name__ == "__main__":
     if args.public:
         # if you want your geekbook to be seen in the network uncomment this line, and comment the line above
         print('WARNING PUBLIC MODE')
-        app.run(debug=args.debug, host= '0.0.0.0', port=args.port)
+        serve('0.0.0.0', args.port, args.server, args.workers, args.debug)
         # of course be very careful with this. EVERYONE within network can read ALL your notes! (if they know your IP)
     else:
-        app.run(debug=args.debug, port=args.port)
+        serve('127.0.0.1', args.port, args.server, args.workers, args.debug)
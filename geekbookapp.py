@@ -7,7 +7,6 @@ import os
 import sys
 import argparse
 import logging
-import commands
 import gc
 import platform
 
@@ -19,12 +18,17 @@ PATH = os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))  # __file_
 sys.path.append(PATH)
 
 
-from engine.conf import PATH_TO_MD, PATH_TO_HTML, PATH_TO_IMG, PATH_TO_ORIG, AI_WRITER
+from engine.conf import PATH_TO_MD, PATH_TO_HTML, PATH_TO_IMG, AI_WRITER
 from engine.page import Page
+from engine.pages import remove_page
+from engine.manifest import get_manifest
+from engine.builder import build
+from engine.preprocessing import clear_cache
 from engine.md_update import Md_update
 from engine.make_index import Index
 from engine.colors import bcolors
 from engine.searcher import make_db
+from engine.watcher import get_watcher, Event, MODIFIED, DELETED, RENAMED, RESCAN
 from engine.plugins import ia_writer
 # import yappi
 
@@ -34,32 +38,42 @@ class GeekbookError(Exception):
 
 
 class MdFiles(object):
-    """MdFiles manages the index of your md files (notes)"""
+    """MdFiles manages the index of your md files (notes)
+
+    Attributes:
+
+      md_files - names of notes, the newest first (by mtime)
+      mtimes - name -> mtime of the note
+    """
     path_to_watch = PATH_TO_MD
 
     def __init__(self):
         self.md_files = []
+        self.mtimes = {}
         self.get_filelist()
         self.sort_by_mtime()
 
+    def is_md_file(self, f):
+        """Check if the file is a note (and not e.g. a file of emacs)."""
+        if f.startswith('flycheck_') and f.endswith('.md'):
+            return False
+        if f.endswith('.md') and not f.startswith('.#'):
+            if ' ' in f:
+                raise GeekbookError("""We don't handle names of you notes with spaces, please \
+    use `-`. e.g. geekbook-is-the-best.md Please rename your note and start this app again. Fix: %s """ % f)
+            return True
+        return False
+
     def get_filelist(self):
         """Get a raw index of all files in your notes folder, clean it and save the list as
         self.md_files"""
-        self.md_files = os.listdir(self.path_to_watch)
-        nfiles = []
-        for f in self.md_files:
-            if f.startswith('flycheck_') and f.endswith('.md'):
-                continue
-            if f.endswith('.md') and not f.startswith('.#'):
-                if ' ' in f:
-                    raise GeekbookError("""We don't handle names of you notes with spaces, please \
-    use `-`. e.g. geekbook-is-the-best.md Please rename your note and start this app again. Fix: %s """ % f)
-                nfiles.append(f)
-        self.md_files = nfiles
+        self.md_files = [f for f in os.listdir(self.path_to_watch) if self.is_md_file(f)]
 
     def sort_by_mtime(self):
         """Sort by mtime the list of md files"""
-        self.md_files.sort(key=lambda x: os.stat(os.path.join(self.path_to_watch, x)).st_mtime)
+        self.mtimes = dict((f, os.stat(os.path.join(self.path_to_watch, f)).st_mtime)
+                           for f in self.md_files)
+        self.md_files.sort(key=lambda x: self.mtimes[x])
         self.md_files.reverse()
 
     def get_files(self):
@@ -69,17 +83,141 @@ class MdFiles(object):
         self.sort_by_mtime()
         return self.md_files
 
+    def _remove(self, f):
+        if self.mtimes.pop(f, None) is not None:
+            self.md_files.remove(f)
+
+    def update(self, events):
+        """Update the list with events of the watcher (see engine/watcher.py), only notes of
+        the events are checked (os.stat), not the whole folder.
+
+        Returns:
+
+           list: notes that are gone (deleted, or renamed to another name)
+        """
+        removed = []
+        for e in events:
+            if os.path.isabs(e.fn):
+                continue  # a file included into notes
+            if e.kind == RENAMED:
+                self._remove(e.old_fn)
+                removed.append(e.old_fn)
+            try:
+                mtime = os.stat(os.path.join(self.path_to_watch, e.fn)).st_mtime
+            except OSError:  # deleted (or gone already)
+                self._remove(e.fn)
+                removed.append(e.fn)
+                continue
+            if self.is_md_file(e.fn):
+                self._remove(e.fn)
+                i = 0  # a changed note is the newest one, usually
+                while i < len(self.md_files) and self.mtimes[self.md_files[i]] > mtime:
+                    i += 1
+                self.md_files.insert(i, e.fn)
+                self.mtimes[e.fn] = mtime
+        return removed
+
 
 class App(object):
     """App class"""
 
     def __init__(self, args):
         self.args = args
-        # fix #
-        try:
-            os.mkdir(PATH_TO_ORIG)
-        except OSError:
-            pass
+        self.watcher = None
+        self.index = Index()
+
+    def remove(self, fn):
+        """Remove the html of a note that is gone (and forget it in the manifest)."""
+        remove_page(PATH_TO_HTML + fn.replace('.md', '.html'))
+        manifest = get_manifest()
+        manifest.remove(fn)
+        manifest.next_generation('pages')
+        manifest.commit()
+        logger.info('removed --> %s' % fn)
+
+    def watch_deps(self, deps):
+        """Tell the watcher to look also at files included into notes that are outside
+        the notes folder ([if:file])."""
+        if self.watcher:
+            for path in deps:
+                self.watcher.watch_file(path)
+
+    def rescan(self, events, mf):
+        """Events were lost (RESCAN), so look at all the notes as at the start: notes gone
+        from the folder are deleted, outdated ones (new, changed) are modified."""
+        events = [e for e in events if e.kind != RESCAN]
+        fns = set(e.fn for e in events)
+        known = set(mf.md_files)
+        files = mf.get_files()
+        outdated = [fn for fn in get_manifest().outdated(files) if fn not in fns]
+        gone = known - set(files) - fns
+        logger.info('rescan --> %i notes to compile, %i gone' % (len(outdated), len(gone)))
+        return (events +
+                [Event(DELETED, fn, os.path.join(PATH_TO_MD, fn), None) for fn in sorted(gone)] +
+                [Event(MODIFIED, fn, os.path.join(PATH_TO_MD, fn), None) for fn in outdated])
+
+    def update(self, events, mf, force=False):
+        """Compile notes reported by the watcher (and notes that include them), then update
+        the index and the search db.
+
+        Use force to compile notes even if the md file itself is not changed."""
+        manifest = get_manifest()
+        if any(e.kind == RESCAN for e in events):
+            events = self.rescan(events, mf)
+            force = True
+        removed = mf.update(events)
+        clear_cache()  # included files could be changed
+        if manifest.check_engine():  # and the theme too, then all notes are outdated
+            fns = set(e.fn for e in events)
+            outdated = [fn for fn in manifest.outdated(mf.md_files) if fn not in fns]
+            logger.info('the theme is changed --> %i notes to compile' % len(outdated))
+            events = list(events) + [Event(MODIFIED, fn, None, None) for fn in outdated]
+            force = True
+            self.watch_deps(manifest.get_theme_files())  # the head can link to new files
+        anything_changed = False
+        compiled = []
+        notes = []
+        paths = []
+        for e in events:
+            paths.append(e.path)
+            if e.kind == RENAMED:
+                self.remove(e.old_fn)
+                paths.append(os.path.join(os.path.dirname(e.path), e.old_fn))
+                anything_changed = True
+            if os.path.isabs(e.fn):
+                continue  # a file included into notes, not a note
+            if e.kind == DELETED:
+                self.remove(e.fn)
+                anything_changed = True
+                continue
+            notes.append(e.fn)
+
+        # notes that include any of these files, their md is not changed, compile them anyway
+        dependents = [fn for fn in manifest.dependents(paths) if fn not in notes]
+        if dependents:
+            logger.info('included into --> %s' % ', '.join(dependents))
+
+        for fn in notes + dependents:
+            p = Page(fn)
+            if p.md is not None and (force or fn in dependents or p.is_changed()):
+                # if m is changed then (by using any of plugins working on markdown, run this
+                m = Md_update(fn)
+                changed = m.compile()
+                if changed:  # only if something is changed in md
+                    m.save()
+
+                p.compile()
+                p.save()
+                self.watch_deps(p.deps)
+                compiled.append(fn)
+                anything_changed = True
+
+        if anything_changed:
+            self.index.update(mf.md_files, changed=compiled, removed=removed)
+
+            # update search db if any of the files
+            # is changed, only notes from the events are parsed
+            make_db(changed=notes, removed=removed)
 
     def start(self):
         """Start the App.
@@ -102,110 +240,53 @@ class App(object):
         mf = MdFiles()
         logger.info('You have %i notes! Congrats, keep noting!' % len(mf.get_files()))
 
-        index = Index()
-        index.update(mf.get_files())
+        self.index.update(mf.get_files())
 
-        # yappi.start()
-        c = 0
-
-        ipynb_mtime = {}
-
-        while c < 10:  # for debugging
-            # check for ipython
-
-            # if not ipynb_mtime:
-            # notebook_files = os.listdir(PATH_TO_MD)
-            # for n in [n for n in notebook_files if n.endswith('.ipynb') and n.startswith('jupyter')]:
-            # cmd = "jupyter nbconvert " + PATH_TO_MD + os.sep + n + " --to markdown"
-            # print cmd
-            # os.system(cmd)
-            # ipynb_mtime[n] = os.path.getmtime(PATH_TO_MD + os.sep + n)
-            # else:
-            # notebook_files = os.listdir(PATH_TO_MD)
-            # for n in [n for n in notebook_files if n.endswith('.ipynb')]:
-            # if n in ipynb_mtime.keys():
-            # mt = os.path.getmtime(PATH_TO_MD + os.sep + n)
-            # if ipynb_mtime[n] < mt:
-            # cmd = "jupyter nbconvert " + PATH_TO_MD + os.sep + n + " --to markdown"
-            # print cmd
-            # os.system(cmd)
-            # ipynb_mtime[n] = mt
-            # else:
-            # mt = os.path.getmtime(PATH_TO_MD + os.sep + n)
-            # cmd = "jupyter nbconvert " + PATH_TO_MD + os.sep + n + " --to markdown"
-            # print cmd
-            # os.system(cmd)
-            # ipynb_mtime[n] = mt
-
-            # see what's new - diff between to folders your notes and orig files that keep copy of our notes
-            # grep -v removes things from your list, ~, # (and in mmagnus case org mode files)
-            cmd = "diff -u -r " + PATH_TO_MD + " " + PATH_TO_ORIG + \
-                " | grep -v '\.org' | grep -v 'flycheck_' | grep -v '~' | grep -v '#' | grep '\.md'".strip()
-            out = commands.getoutput(cmd)
-            # print out
-            files_changed = []
-
-            # pick all file names that are changed
-            for l in out.split('\n'):
-                # new notes
-                if l.startswith('Only in ' + PATH_TO_MD):
-                    files_changed.append(os.path.basename(l.split()[-1]))
-                # changes notes
-                if l.startswith('diff -u -r'):
-                    files_changed.append(os.path.basename(l.split()[-1]))
-
-            # if there are files change compile them
-            for f in files_changed:
-                m = Md_update(f)
-                p = Page(f)
-                if p.is_changed():
-                    # if m is changed then (by using any of plugins working on markdown, run this
-                    changed = m.compile()
-                    if changed:  # only if something is changed in md
-                        m.save()
-
-                    p.compile()
-                    p.save()
-
-                    index = Index()
-                    index.update(mf.get_files())
-
-                    # update search db if any of the files
-                    # is changed
-                    make_db()
-
-            if UPDATE:
-                for f in mf.get_files():
-                    if f == 'imgs':
-                        pass
-                    else:
-                        p = Page(f)
-                        p.compile()
-                        p.save()
-
-                sys.exit(0)
-
-            # dev -d <file>
-            if DEV:
-                # update index
-                index = Index()
-                index.update(mf.get_files())
-
-                # update this one picked note
-                m = Md_update(args.debug)
-                changed = m.compile()  # if changed MD
-                if changed:
-                    m.save()
+        if UPDATE:
+            files = [f for f in mf.get_files() if f != 'imgs']
+            if not self.args.force:
+                # compile only notes that are changed, or anything used to compile them
+                files = get_manifest().outdated(files)
+            failed = build(files, self.args.jobs)
+            sys.exit(1 if failed else 0)
 
-                p = Page(args.debug)
-                p.compile()
-                p.save()
+        # dev -d <file>
+        if DEV:
+            # update index
+            self.index.update(mf.get_files())
 
-                sys.exit(0)
+            # update this one picked note
+            m = Md_update(args.debug)
+            changed = m.compile()  # if changed MD
+            if changed:
+                m.save()
 
+            p = Page(args.debug)
+            p.compile()
+            p.save()
+
+            sys.exit(0)
+
+        # yappi.start()
+        # sleep until the kernel (or the stat poller) tells us that some notes changed
+        self.watcher = get_watcher(PATH_TO_MD)
+        logger.info('Watching your notes with %s' % self.watcher.__class__.__name__)
+        for deps in get_manifest().get_all_deps().values():
+            self.watch_deps(deps)
+        self.watch_deps(get_manifest().get_theme_files())  # a changed theme is compiled at once
+
+        # catch up with the changes made when the app was off (notes, the template, engine...),
+        # only stat for unchanged notes
+        files = mf.get_files()
+        outdated = get_manifest().outdated(files)
+        logger.info('%i of %i notes to compile since the last run' % (len(outdated), len(files)))
+        self.update([Event(MODIFIED, f, None, None) for f in outdated], mf, force=True)
+
+        while True:
+            events = self.watcher.wait()
+            if events:
+                self.update(events, mf)
             gc.collect()
-            time.sleep(1)  # if this is too big you have too wait for ii too long (!)
-            # off c += 1
 
         # yappi.stop()
         # stats = yappi.get_func_stats()
@@ -244,6 +325,10 @@ def get_parser():
     parser.add_argument('-d', '--debug', help='debug mode, run only for file,' +
                         'WARNING: use only name of the note, e.g. test.md, NOT notes/test.md')
     parser.add_argument('-u', '--update', help='updates all the pages', action='store_true')
+    parser.add_argument('-f', '--force', help='with --update, compile all notes, ' +
+                        'not only changed ones', action='store_true')
+    parser.add_argument('-j', '--jobs', help='with --update, compile notes in N processes, ' +
+                        '0 means one per CPU (default: 1)', type=int, default=1)
     parser.add_argument('-s', '--silent', help='dont bring up the Internet Browser', action='store_true')
     parser.add_argument('-n', '--notebook',
                         help='updates all jupiter notebooks!', action='store_true')
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""geekbookbench - how fast is geekbook?
+
+    ./geekbookbench.py markdown  # a new Markdown converter for every note vs one converter
+    ./geekbookbench.py memory    # memory of the search db: the old pickle vs loaded Db (in memory) vs mmap
+    ./geekbookbench.py load      # requests per second and p99 latency of flask (/view, /search)
+
+"""
+import os
+import sys
+import time
+import random
+import pickle
+import shutil
+import timeit
+import httplib
+import urlparse
+import argparse
+import tempfile
+import platform
+import resource
+import subprocess
+import multiprocessing
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(PATH))
+
+import markdown
+from mdx_gfm import GithubFlavoredMarkdownExtension
+
+from engine.backends import PythonMarkdown
+from engine.searcher import make_headers_objects_for_md, get_md
+from engine.search_index import write_index, IndexFile, SearchIndex
+
+NOTE = u"""# Title of a small note @todo
+
+Some *text* with a [link](http://geekbook.readthedocs.io) and `code`.
+
+- [ ] something to do
+- [x] something done
+
+```python
+print('hello')
+```
+"""
+
+
+def get_times(funcs, text, number, repeat=5):
+    """Get seconds per call of func(text) for every func, best of repeat. Funcs are timed
+    in turns, so they all get the same noise of the machine (gc is off while timing)."""
+    best = [None] * len(funcs)
+    for r in range(repeat):
+        for i, func in enumerate(funcs):
+            t = timeit.timeit(lambda: func(text), number=number) / number
+            if best[i] is None or t < best[i]:
+                best[i] = t
+    return best
+
+
+def new_converter(text):
+    return markdown.markdown(text, extensions=[GithubFlavoredMarkdownExtension()])
+
+
+ONE = PythonMarkdown()
+
+
+def one_converter(text):
+    return ONE.convert(text)
+
+
+def bench_markdown(args):
+    """Compile notes of different size with a new converter for every note (how it used to
+    be) and with one converter reset before every note (Page.get_html)."""
+    print('%-10s %10s %10s %12s %8s' % ('note', 'new (ms)', 'one (ms)', 'saved (ms)', 'speedup'))
+    for times in args.sizes:
+        text = NOTE * times
+        assert new_converter(text) == one_converter(text)
+        number = max(1, args.number // times)
+        new, one = [t * 1000 for t in get_times([new_converter, one_converter], text, number)]
+        name = '%i lines' % len(text.split('\n'))
+        print('%-10s %10.3f %10.3f %12.3f %7.1fx' % (name, new, one, new - one, new / one))
+
+
+class OldHeader:
+    """Header as it was pickled to engine/searchdb.pickle: a __dict__ and a copy of the note,
+    with a space before every line."""
+
+    def __init__(self, h):
+        self.name = h.name
+        self.name_dashed = h.name.replace(' ', '-')
+        self.level = h.level
+        self.child = []
+        self.note = ''.join(' ' + l + '\n' for l in h.note.split('\n')[:-1])
+        self.md = h.md
+
+
+def make_notes(path, notes, sections):
+    """Write notes with random words, sections per note."""
+    random.seed(1)
+    words = ['w%i' % i for i in range(20000)] + ['rna', 'structure', '@todo', 'python']
+    for n in range(notes):
+        lines = ['# Note %i' % n, '']
+        for s in range(sections):
+            if s:
+                lines.append('## Section %i %s' % (s, random.choice(words)))
+            for l in range(4):
+                lines.append(' '.join(random.choice(words) for w in range(12)))
+            lines.append('')
+        with open(os.path.join(path, 'note%05i.md' % n), 'w') as f:
+            f.write('\n'.join(lines))
+
+
+def get_rss():
+    """Get the resident memory of this process, in MB (on macOS the max so far)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024
+    except IOError:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024.0 / (1024 if platform.system() == 'Darwin' else 1)
+
+
+def measure(kind, path):
+    """Load the search db of notes in path, one kind, print MB and seconds (in a new process)."""
+    notes = sorted(os.path.join(path, fn) for fn in os.listdir(path) if fn.endswith('.md'))
+    rss = get_rss()
+    t = time.time()
+    if kind == 'pickle':
+        with open(os.path.join(path, 'searchdb.pickle'), 'rb') as f:
+            db = pickle.load(f)
+    elif kind == 'headers':
+        db = []
+        for fn in notes:
+            db.extend(make_headers_objects_for_md(fn))
+    elif kind == 'db':  # as Db.load without the index file: one read of a note, its Headers
+        db = SearchIndex()  # are offsets in it, all sections in the inverted index
+        for fn in notes:
+            for h in make_headers_objects_for_md(fn):
+                db.add(h)
+        db.prepare()
+        db.search('rna')
+    else:  # as Db.load with the index file: the mmap, hits are Headers with views on it
+        db = IndexFile(os.path.join(path, 'search.idx'))
+        db.prepare()
+        hits = db.search('rna')
+        assert all(h.note for score, h in hits)
+    print('%f %f' % (get_rss() - rss, time.time() - t))
+
+
+def bench_memory(args):
+    """Memory of the search db (all sections of notes) and time to get it: a pickle of
+    Headers with __dict__ and copies of notes (how it used to be), Headers with __slots__ and
+    notes as offsets, the same Headers in an inverted index (the Db loaded in memory), the
+    index file (opened with mmap, and searched)."""
+    if args.measure:
+        measure(*args.measure)
+        return
+    path = tempfile.mkdtemp()
+    try:
+        make_notes(path, args.notes, args.sections)
+        notes = sorted(os.path.join(path, fn) for fn in os.listdir(path))
+        headers = dict((get_md(fn), make_headers_objects_for_md(fn)) for fn in notes)
+        with open(os.path.join(path, 'searchdb.pickle'), 'wb') as f:
+            pickle.dump([OldHeader(h) for md in sorted(headers) for h in headers[md]], f)
+        write_index(os.path.join(path, 'search.idx'), sorted(headers.items()))
+        print('%i notes, %i sections' % (len(notes), sum(len(h) for h in headers.values())))
+        print('%-10s %10s %10s %10s' % ('db', 'file (MB)', 'RAM (MB)', 'time (s)'))
+        for kind, fn in [('pickle', 'searchdb.pickle'), ('headers', None), ('db', None),
+                         ('index', 'search.idx')]:
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'memory',
+                                           '--measure', kind, path])
+            rss, seconds = [float(x) for x in out.split()[-2:]]
+            size = os.path.getsize(os.path.join(path, fn)) / 1024.0 / 1024 if fn else 0
+            print('%-10s %10.1f %10.1f %10.3f' % (kind, size, rss, seconds))
+    finally:
+        shutil.rmtree(path)
+
+
+def get_latencies(job):
+    """Get paths one after another (at random) for some seconds, with one connection (kept
+    alive if the server can). Returns a list of (path, seconds, status), status 0 is an error."""
+    url, paths, seconds, seed = job
+    random.seed(seed)
+    host = urlparse.urlparse(url)
+    conn = None
+    out = []
+    end = time.time() + seconds
+    while time.time() < end:
+        path = random.choice(paths)
+        t = time.time()
+        try:
+            if conn is None:
+                conn = httplib.HTTPConnection(host.hostname, host.port or 80, timeout=30)
+            conn.request('GET', host.path.rstrip('/') + path, headers={'Accept-Encoding': 'gzip'})
+            r = conn.getresponse()
+            r.read()
+            status = r.status
+            if r.getheader('connection', '').lower() == 'close' or r.version == 10:
+                conn.close()
+                conn = None
+        except (httplib.HTTPException, IOError):
+            status = 0
+            conn = None
+        out.append((path, time.time() - t, status))
+    return out
+
+
+def get_percentile(sorted_values, p):
+    return sorted_values[int(round(p / 100.0 * (len(sorted_values) - 1)))]
+
+
+def start_server(server, workers, port):
+    """Start webserverflask.py with a server, wait until it answers."""
+    proc = subprocess.Popen([sys.executable, os.path.join(PATH, 'engine', 'webserverflask.py'),
+                             '--port', str(port), '--server', server, '--workers', str(workers)])
+    for i in range(300):
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/view/index.html')
+            conn.getresponse().read()
+            return proc
+        except (httplib.HTTPException, IOError):
+            if proc.poll() is not None:
+                raise RuntimeError('%s did not start' % server)
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError('%s does not answer' % server)
+
+
+def bench_load(args):
+    """Requests per second and latency of flask for /view and /search, with many clients at
+    once (processes, each one makes requests one after another)."""
+    proc = None
+    url = args.url
+    if args.server:
+        proc = start_server(args.server, args.workers, args.port)
+        url = 'http://127.0.0.1:%i' % args.port
+    try:
+        pool = multiprocessing.Pool(args.clients)
+        try:
+            jobs = [(url, args.paths, args.time, seed) for seed in range(args.clients)]
+            results = [x for out in pool.map(get_latencies, jobs) for x in out]
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+    print('%s, %i clients, %i s' % (args.server or url, args.clients, args.time))
+    print('%-30s %8s %7s %8s %10s %10s %10s' % ('path', 'requests', 'errors', 'rps',
+                                               'mean (ms)', 'p50 (ms)', 'p99 (ms)'))
+    for path in args.paths + ['all']:
+        rows = [r for r in results if path in ('all', r[0])]
+        times = sorted(r[1] * 1000 for r in rows if r[2] == 200 or r[2] == 304)
+        errors = len(rows) - len(times)
+        if not times:
+            print('%-30s %8i %7i' % (path, len(rows), errors))
+            continue
+        print('%-30s %8i %7i %8.1f %10.1f %10.1f %10.1f' % (
+            path, len(rows), errors, len(times) / float(args.time), sum(times) / len(times),
+            get_percentile(times, 50), get_percentile(times, 99)))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser('markdown', help=bench_markdown.__doc__.split('\n')[0])
+    p.add_argument('-n', '--number', type=int, default=200, help='notes to compile (for the smallest)')
+    p.add_argument('-s', '--sizes', type=int, nargs='+', default=[1, 4, 16, 64],
+                   help='sizes of notes, as copies of a small note')
+    p.set_defaults(func=bench_markdown)
+
+    p = subparsers.add_parser('memory', help=bench_memory.__doc__.split('\n')[0])
+    p.add_argument('-n', '--notes', type=int, default=1000, help='number of notes')
+    p.add_argument('-s', '--sections', type=int, default=20, help='sections per note')
+    p.add_argument('--measure', nargs=2, metavar=('KIND', 'PATH'), help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_memory)
+
+    p = subparsers.add_parser('load', help=bench_load.__doc__.split('\n')[0])
+    p.add_argument('-c', '--clients', type=int, default=8, help='clients at once')
+    p.add_argument('-t', '--time', type=int, default=10, help='seconds')
+    p.add_argument('-p', '--paths', nargs='+', default=['/view/test.html', '/search/test'],
+                   help='paths to get, at random')
+    p.add_argument('--url', default='http://127.0.0.1:5000', help='of a running server')
+    p.add_argument('--server', choices=['flask', 'waitress', 'gunicorn'],
+                   help='start webserverflask.py with this server (instead of --url)')
+    p.add_argument('-w', '--workers', type=int, default=4, help='of the server')
+    p.add_argument('--port', type=int, default=5077, help='of the server')
+    p.set_defaults(func=bench_load)
+    return parser
+
+
+# main
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    args.func(args)
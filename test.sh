@@ -1,2 +1,4 @@
 ./geekbookapp.py --update
 ./geekbookapp.py --debug test.md
+python -m engine.postprocessing
+python -m unittest discover -s engine -p 'test_*.py' -t .